@@ -0,0 +1,196 @@
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, has_app_context, jsonify
+from flask_login import current_user
+
+
+"""
+admission control for the AI endpoints, so one busy user can't tie up every worker with LLM chains.
+- token buckets: one per user (AI_USER_RATE requests/s, bursts of AI_USER_BURST) and one shared by
+  all non-admin users (AI_GLOBAL_RATE / AI_GLOBAL_BURST); admins skip the shared bucket
+- a bounded number of concurrent calls per branch (AI_BRANCH_LIMITS, e.g. "sql=8,web=4"),
+  plus AI_ADMIN_SLOTS extra slots per branch that only admins can use
+- a request that finds its branch full waits up to AI_QUEUE_TIMEOUT seconds in a queue of at most
+  AI_MAX_QUEUE requests, otherwise it is rejected with 429 and a Retry-After header
+limits are per worker process.
+"""
+BRANCHES = ("sql", "web", "habits", "recommendations", "insights")
+DEFAULT_BRANCH_LIMITS = "sql=8,web=4,habits=2,recommendations=2,insights=2"
+MAX_TRACKED_USERS = 10_000
+
+
+def _setting(name: str, default=None):
+    if has_app_context() and name in current_app.config:
+        return current_app.config[name]
+    return os.getenv(name, default)
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # takes one token; returns 0 on success, otherwise the seconds until one is available
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def parse_branch_limits(spec: str) -> dict:
+    limits = dict.fromkeys(BRANCHES, 1)
+    for part in spec.split(","):
+        if "=" in part:
+            branch, limit = part.split("=", 1)
+            limits[branch.strip()] = int(limit)
+    return limits
+
+
+class AdmissionController:
+    def __init__(self, user_rate: float, user_burst: float, global_rate: float, global_burst: float,
+                 branch_limits: dict, admin_slots: int, queue_timeout: float, max_queue: int):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.branch_limits = branch_limits
+        self.admin_slots = admin_slots
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+
+        self.user_buckets = OrderedDict()
+        self.in_flight = Counter()     # (branch, lane) -> running calls
+        self.waiting = Counter()       # branch -> queued requests
+        self.admitted = Counter()      # branch -> calls that got a slot
+        self.rejected = Counter()      # reason -> rejected requests
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+
+    @classmethod
+    def from_settings(cls) -> "AdmissionController":
+        return cls(
+            user_rate=float(_setting("AI_USER_RATE", 0.5)),
+            user_burst=float(_setting("AI_USER_BURST", 5)),
+            global_rate=float(_setting("AI_GLOBAL_RATE", 10)),
+            global_burst=float(_setting("AI_GLOBAL_BURST", 30)),
+            branch_limits=parse_branch_limits(_setting("AI_BRANCH_LIMITS", DEFAULT_BRANCH_LIMITS)),
+            admin_slots=int(_setting("AI_ADMIN_SLOTS", 2)),
+            queue_timeout=float(_setting("AI_QUEUE_TIMEOUT", 0.25)),
+            max_queue=int(_setting("AI_MAX_QUEUE", 16)),
+        )
+
+    def _reject(self, reason: str, retry_after: float):
+        self.rejected[reason] += 1
+        raise Rejected(reason, retry_after)
+
+    # charges one request to the user's bucket and, for non-admins, the shared bucket
+    def check_rate(self, user_id: int, is_admin: bool) -> None:
+        with self._lock:
+            bucket = self.user_buckets.pop(user_id, None) or TokenBucket(self.user_rate, self.user_burst)
+            self.user_buckets[user_id] = bucket
+            if len(self.user_buckets) > MAX_TRACKED_USERS:
+                self.user_buckets.popitem(last=False)
+
+            wait = bucket.take()
+            if wait:
+                self._reject("user_rate", wait)
+            if not is_admin:
+                wait = self.global_bucket.take()
+                if wait:
+                    bucket.tokens += 1    # not the user's fault, give their token back
+                    self._reject("global_rate", wait)
+
+    def _free_lane(self, branch: str, is_admin: bool) -> str | None:
+        if is_admin and self.in_flight[(branch, "admin")] < self.admin_slots:
+            return "admin"
+        if self.in_flight[(branch, "user")] < self.branch_limits.get(branch, 1):
+            return "user"
+        return None
+
+    # holds one of the branch's slots for the duration of the block
+    @contextmanager
+    def slot(self, branch: str, is_admin: bool):
+        deadline = time.monotonic() + self.queue_timeout
+        with self._lock:
+            lane = self._free_lane(branch, is_admin)
+            if lane is None:
+                if self.waiting[branch] >= self.max_queue:
+                    self._reject("queue_full", 1)
+                self.waiting[branch] += 1
+                try:
+                    while lane is None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("branch_busy", 1)
+                        self._slot_freed.wait(remaining)
+                        lane = self._free_lane(branch, is_admin)
+                finally:
+                    self.waiting[branch] -= 1
+            self.in_flight[(branch, lane)] += 1
+            self.admitted[branch] += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight[(branch, lane)] -= 1
+                self._slot_freed.notify_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": {branch: self.in_flight[(branch, "user")] + self.in_flight[(branch, "admin")]
+                              for branch in self.branch_limits},
+                "queue_depth": {branch: self.waiting[branch] for branch in self.branch_limits},
+                "admitted": dict(self.admitted),
+                "rejected": dict(self.rejected),
+                "limits": dict(self.branch_limits),
+            }
+
+
+def init_app(app) -> None:
+    with app.app_context():
+        app.extensions["admission"] = AdmissionController.from_settings()
+
+
+def controller() -> AdmissionController:
+    return current_app.extensions["admission"]
+
+
+# a slot of `branch` for the current user; raises Rejected when the branch stays full
+def slot(branch: str):
+    return controller().slot(branch, current_user.is_admin)
+
+
+# route decorator: rate-limits the current user and turns rejections anywhere in the route into a 429
+def admission_controlled(func):
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        try:
+            controller().check_rate(current_user.id, current_user.is_admin)
+            return func(*args, **kwargs)
+        except Rejected as e:
+            response = jsonify({"reply": "I'm getting a lot of questions right now. Please try again in a moment.",
+                                "reason": e.reason})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response
+
+    return decorated_function
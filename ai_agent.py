@@ -1,13 +1,12 @@
-import os
-from dotenv import load_dotenv
-from openai import OpenAI
-from prompt import SQL_PROMPT, ANSWER_PROMPT, RECOMMEND_PROMPT, ANSWER_OUTSIDE_SQL_PROMPT, INSIGHTS_PROMPT, READING_HABITS_PROMPT
+from llm import complete
+from prompt import SQL_ANSWER_PROMPT, ANSWER_PROMPT, RECOMMEND_PROMPT, ANSWER_OUTSIDE_SQL_PROMPT, INSIGHTS_PROMPT, READING_HABITS_PROMPT
+from singleflight import coalesced
+from disk_cache import web_cache, normalize_query
+import cancellation
+import chat_log
+import hashlib
 import json
-import requests
-
-load_dotenv()
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+import re
 
 
 
@@ -37,28 +36,84 @@ def _clean_sql(raw: str) -> str:
     return sql.strip()
 
 
-def ai_to_sql(user_question: str, current_user_id: int, is_admin: bool) -> str:
+"""
+one-shot SQL generation: a single call returns the SQL together with an answer template
+that the server fills from the result rows (see fill_answer_template).
+returns {"sql", "answer_template", "row_template", "empty_answer"}; if the model doesn't return
+valid JSON the output is treated as plain SQL and the answer is phrased separately.
+"""
+@coalesced
+def ai_to_sql_with_answer(user_question: str, current_user_id: int, is_admin: bool) -> dict:
     user_content = (
         f"CURRENT_USER_ID = {current_user_id}\n"
         f"IS_ADMIN = {1 if is_admin else 0}\n"
         f"QUESTION: {user_question}"
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SQL_PROMPT},
-            {"role": "user", "content": user_content},
-        ],
-        temperature=0,
-    )
+    raw = complete("sql_answer", [
+        {"role": "system", "content": SQL_ANSWER_PROMPT},
+        {"role": "user", "content": user_content},
+    ], temperature=0, json_mode=True)
+
+    try:
+        plan = json.loads(raw)
+        sql = plan["sql"]
+    except (ValueError, TypeError, KeyError):
+        return {"sql": _clean_sql(raw), "answer_template": None, "row_template": None, "empty_answer": None}
+
+    return {
+        "sql": _clean_sql(sql),
+        "answer_template": plan.get("answer_template"),
+        "row_template": plan.get("row_template"),
+        "empty_answer": plan.get("empty_answer"),
+    }
+
+
+PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip("0").rstrip(".")
+    return "" if value is None else str(value)
 
 
-    raw_sql = response.choices[0].message.content or ""
-    sql = _clean_sql(raw_sql)
-    return sql
+# replaces {name} placeholders from `values`; returns None if one of them is unknown
+def _fill(template: str, values: dict) -> str | None:
+    missing = [name for name in PLACEHOLDER.findall(template) if name not in values]
+    if missing:
+        return None
+    return PLACEHOLDER.sub(lambda m: _format_value(values[m.group(1)]), template)
 
 
+"""
+fills the answer template of a plan made by ai_to_sql_with_answer with the result rows.
+returns None when the template can't express the answer (no template, unknown placeholder),
+in which case the caller asks the LLM to phrase it instead.
+"""
+def fill_answer_template(plan: dict, rows: list[dict]) -> str | None:
+    if not rows:
+        return plan.get("empty_answer") or None
+
+    template = plan.get("answer_template")
+    if not template:
+        return None
+
+    values = {"row_count": len(rows), **rows[0]}
+
+    if "{rows}" in template:
+        row_template = plan.get("row_template")
+        if not row_template:
+            return None
+        lines = [_fill(row_template, row) for row in rows]
+        if any(line is None for line in lines):
+            return None
+        values["rows"] = "\n".join(f"- {line}" for line in lines)
+
+    return _fill(template, values)
+
+
+@coalesced
 def generate_natural_answer(user_question: str, sql_query: str, rows: list[dict], user_name: str, is_admin: bool) -> str:
     rows_json = json.dumps(rows, ensure_ascii=False)
 
@@ -70,47 +125,76 @@ def generate_natural_answer(user_question: str, sql_query: str, rows: list[dict]
         f"SQL result rows (JSON):\n{rows_json}"
     )
 
-    response = client.chat.completions.create(
-        model = "gpt-4o",
-        messages=[
-            {"role": "system", "content": ANSWER_PROMPT},
-            {"role": "user", "content": meta_info},
-        ],
-        temperature=0,
-    )
-
-    content = response.choices[0].message.content or ""
+    content = complete("answer", [
+        {"role": "system", "content": ANSWER_PROMPT},
+        {"role": "user", "content": meta_info},
+    ], temperature=0)
 
     return content.strip()
 
 
 # generates book recommendations given the user's reading history
-def recommend_books(requester_name: str, target_user_name: str, user_books: list[dict]
+@coalesced
+def recommend_books(requester_name: str, target_user_name: str, profile: dict
                     , is_admin: bool = False) -> str:
-    books_json = json.dumps(user_books, ensure_ascii=False)
+    profile_json = json.dumps(profile, ensure_ascii=False)
 
     user_content = (
         f"Requester name: {requester_name}\n"
         f"Target user name: {target_user_name}\n"
         f"Is requester admin: {is_admin}\n"
-        f"Target user's existing books (JSON):\n{books_json}"
+        f"Target user's reader profile (JSON):\n{profile_json}"
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": RECOMMEND_PROMPT},
-            {"role": "user", "content": user_content},
-        ],
-        temperature=0.7,
-    )
-
-    content = response.choices[0].message.content or ""
+    content = complete("recommend", [
+        {"role": "system", "content": RECOMMEND_PROMPT},
+        {"role": "user", "content": user_content},
+    ], temperature=0.7)
     return content.strip()
 
 
-# calls DuckDuckGo API
+RECOMMENDATION = re.compile(r"^\s*(?:[-*•]|\d+\.)\s+\*\*(.+?)\*\*")
+
+
+"""
+drops the bullets of a recommend_books reply whose **Title** the reader already owns: the prompt only
+shows their newest books, so the model can't know the rest. `owned(titles)` returns the owned ones.
+"""
+def drop_owned_recommendations(reply: str, owned) -> str:
+    lines = reply.splitlines()
+    titles = {index: match.group(1).strip() for index, line in enumerate(lines)
+              if (match := RECOMMENDATION.match(line))}
+    if not titles:
+        return reply
+
+    owned_titles = owned(set(titles.values()))
+    kept = [line for index, line in enumerate(lines) if titles.get(index) not in owned_titles]
+    if len(kept) == len(lines):
+        return reply
+    if len(lines) - len(kept) == len(titles):
+        kept.append("(Every book I came up with is already in the library; ask again for new ideas.)")
+    return "\n".join(kept)
+
+
+# how long web lookups stay cached (seconds); failures are cached briefly so outages don't hammer the API
+SEARCH_TTL = 7 * 24 * 3600
+EMPTY_SEARCH_TTL = 24 * 3600
+FAILED_SEARCH_TTL = 60
+WEB_ANSWER_TTL = 24 * 3600
+
+
+# calls DuckDuckGo API, through the persistent web cache
 def duckduckgo_search(query: str) -> str:
+    cache = web_cache()
+    key = "ddg:" + normalize_query(query)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    import requests    # slow to import, so only loaded by the first web search
+
+    cancellation.check()
     try:
         response = requests.get(
             "https://api.duckduckgo.com/",
@@ -125,7 +209,10 @@ def duckduckgo_search(query: str) -> str:
         response.raise_for_status()
         data = response.json()
     except Exception as e:
-        return f"(Web search failed: {e})"
+        failure = f"(Web search failed: {e})"
+        if cache is not None:
+            cache.set(key, failure, FAILED_SEARCH_TTL, is_error=True)
+        return failure
 
     snippets: list[str] = []
 
@@ -139,14 +226,30 @@ def duckduckgo_search(query: str) -> str:
             snippets.append(topic["Text"])
 
     if not snippets:
-        return "No matching results from web search."
+        result, ttl = "No matching results from web search.", EMPTY_SEARCH_TTL
+    else:
+        result, ttl = "\n".join(snippets), SEARCH_TTL
 
-    return "\n".join(snippets)
+    if cache is not None:
+        cache.set(key, result, ttl)
+    return result
 
 
 # DuckDuckGo and LLM are used to answer questions that are not related with the DB
+@coalesced
 def answers_from_web(user_question: str, user_books: list[dict], is_admin: bool = False) -> str:
-    titles = ", ".join({book["title"] for book in user_books if book.get("title")})
+    cache = web_cache()
+    books_key = sorted(json.dumps(book, sort_keys=True).lower() for book in user_books)
+    key = "web_answer:" + hashlib.sha256(
+        json.dumps([normalize_query(user_question), books_key, is_admin]).encode("utf-8")
+    ).hexdigest()
+    if cache is not None:
+        cached = cache.get(key)
+        chat_log.cache_status("web_answer", cached is not None)
+        if cached is not None:
+            return cached
+
+    titles = ", ".join(sorted({book["title"] for book in user_books if book.get("title")}))
 
     if titles:
         search_query = f"{user_question} Among these books: {titles}"
@@ -163,51 +266,43 @@ def answers_from_web(user_question: str, user_books: list[dict], is_admin: bool
         f"DuckDuckGo snippets:\n{search_snippets}"
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": ANSWER_OUTSIDE_SQL_PROMPT},
-            {"role": "user", "content": user_content},
-        ],
-        temperature=0.5,
-    )
+    content = complete("web_answer", [
+        {"role": "system", "content": ANSWER_OUTSIDE_SQL_PROMPT},
+        {"role": "user", "content": user_content},
+    ], temperature=0.5)
 
-    content = response.choices[0].message.content or ""
-    return content.strip()
+    answer = content.strip()
+    if cache is not None and not search_snippets.startswith("(Web search failed"):
+        cache.set(key, answer, WEB_ANSWER_TTL)
+    return answer
 
 
 
+@coalesced
 def insights_summary(metrics: dict) -> str:
     payload = json.dumps(metrics, ensure_ascii=False)
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": INSIGHTS_PROMPT},
-            {"role": "user", "content": f"METRICS_JSON:\n{payload}"},
-        ],
-        temperature=0.4,
-    )
+    content = complete("insights", [
+        {"role": "system", "content": INSIGHTS_PROMPT},
+        {"role": "user", "content": f"METRICS_JSON:\n{payload}"},
+    ], temperature=0.4)
 
-    return (response.choices[0].message.content or "").strip()
+    return content.strip()
 
 
 # deep analysis of a user's reading habits through a summary
-def analyze_reading_habits(requester_name: str, target_user_name: str, user_books: list[dict]) -> str:
-    books_json = json.dumps(user_books, ensure_ascii=False)
+@coalesced
+def analyze_reading_habits(requester_name: str, target_user_name: str, profile: dict) -> str:
+    profile_json = json.dumps(profile, ensure_ascii=False)
     user_content = (
         f"User name: {requester_name}\n"
         f"Target user name: {target_user_name}\n"
-        f"Their book collection (JSON):\n{books_json}"
+        f"Their reader profile (JSON):\n{profile_json}"
     )
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": READING_HABITS_PROMPT},
-            {"role": "user", "content": user_content},
-        ],
-        temperature=0.6,
-    )
+    content = complete("habits", [
+        {"role": "system", "content": READING_HABITS_PROMPT},
+        {"role": "user", "content": user_content},
+    ], temperature=0.6)
 
-    return (response.choices[0].message.content or "").strip()
\ No newline at end of file
+    return content.strip()
\ No newline at end of file
@@ -0,0 +1,138 @@
+import re
+import threading
+from collections import Counter
+
+
+"""
+deterministic phrasing of AI SQL results, so common result shapes don't need a second LLM call.
+recognized shapes:
+- empty:       no rows
+- scalar:      one row with one column (COUNT, a single genre, ...)
+- book_list:   rows with a title column (optionally author, genre, reading_status)
+- top_counts:  rows of one label column and one numeric column (top genres, users by book count, ...)
+- single_row:  one row with a few columns
+anything else is "other" and goes to the LLM.
+"""
+BOOK_COLUMNS = ("title", "author", "genre", "reading_status")
+MAX_LIST_ROWS = 25
+# a single top_counts row is only "the top" one when the query ranked and cut the results
+RANKED = re.compile(r"\border\s+by\b.*\bdesc\b.*\blimit\b", re.IGNORECASE | re.DOTALL)
+
+_lock = threading.Lock()
+avoided = Counter()      # LLM calls saved, per shape
+escalated = Counter()    # results handed to the LLM, per shape
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _label(column: str) -> str:
+    return column.replace("_", " ").strip()
+
+
+# "book_count" -> "books", "user_count" -> "users", "popularity" -> ""
+def _count_noun(column: str) -> str:
+    base = column.lower()
+    for suffix in ("_count", "_total", "_num"):
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            return base if base.endswith("s") else base + "s"
+    return base if base in ("books", "users") else ""
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip("0").rstrip(".")
+    return str(value)
+
+
+def classify_shape(rows: list[dict]) -> str:
+    if not rows:
+        return "empty"
+
+    columns = list(rows[0].keys())
+    if "title" in columns and set(columns) <= set(BOOK_COLUMNS) | {"id", "user_id"}:
+        return "book_list"
+    if len(rows) == 1 and len(columns) == 1:
+        return "scalar"
+    if len(columns) == 2:
+        values = list(rows[0].values())
+        if not _is_number(values[0]) and _is_number(values[1]):
+            return "top_counts"
+    if len(rows) == 1 and len(columns) <= 4:
+        return "single_row"
+    return "other"
+
+
+def _book_line(row: dict) -> str:
+    line = str(row["title"])
+    if row.get("author"):
+        line += f" by {row['author']}"
+    details = [str(row[column]) for column in ("genre", "reading_status") if row.get(column)]
+    if details:
+        line += f" ({', '.join(details)})"
+    return f"- {line}"
+
+
+def _render(shape: str, rows: list[dict], is_admin: bool, sql: str) -> str | None:
+    where = "the library" if is_admin else "your library"
+
+    if shape == "empty":
+        return f"I couldn't find anything matching that in {where}."
+
+    if shape == "scalar":
+        column, value = next(iter(rows[0].items()))
+        if _is_number(value):
+            amount = f"{_format(value)} {_count_noun(column)}".strip()
+            return f"That comes to {amount}{' across the library' if is_admin else ''}."
+        return f"The {_label(column)} is {_format(value)}."
+
+    if shape == "book_list":
+        if len(rows) > MAX_LIST_ROWS:
+            return None
+        intro = "Here's the book I found" if len(rows) == 1 else f"Here are the {len(rows)} books I found"
+        return f"{intro} in {where}:\n" + "\n".join(_book_line(row) for row in rows)
+
+    if shape == "top_counts":
+        if len(rows) > MAX_LIST_ROWS:
+            return None
+        label_column, count_column = list(rows[0].keys())
+        noun = _count_noun(count_column)
+        if len(rows) == 1:
+            label, count = rows[0][label_column], _format(rows[0][count_column])
+            if not RANKED.search(sql):
+                return f"{label}: {count} {noun}." if noun else f"{label}: {_label(count_column)} {count}."
+            if noun:
+                return f"{label} comes out on top with {count} {noun}."
+            return f"{label} comes out on top ({_label(count_column)}: {count})."
+        lines = [f"- {row[label_column]}: {_format(row[count_column])} {noun}".rstrip() for row in rows]
+        return f"Here's the breakdown by {_label(label_column)}:\n" + "\n".join(lines)
+
+    if shape == "single_row":
+        parts = [f"{_label(column)}: {_format(value)}" for column, value in rows[0].items()]
+        return "Here's what I found: " + ", ".join(parts) + "."
+
+    return None
+
+
+# phrases the result of `sql` locally, or returns None when the LLM should phrase it
+def render_answer(rows: list[dict], is_admin: bool, sql: str = "") -> str | None:
+    shape = classify_shape(rows)
+    answer = _render(shape, rows, is_admin, sql)
+
+    with _lock:
+        if answer is None:
+            escalated[shape] += 1
+        else:
+            avoided[shape] += 1
+
+    return answer
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            "llm_calls_avoided": dict(avoided),
+            "escalated_to_llm": dict(escalated),
+        }
@@ -0,0 +1,292 @@
+import base64
+import binascii
+import heapq
+import json
+from flask import Blueprint, abort, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import func, select
+from werkzeug.exceptions import HTTPException
+from app_factory import db, User, Books, Work, book_genre
+from cache import bump_versions, user_scope
+from database import read_session, run_write
+from routes import delete_books
+import metadata
+import profiles
+import reading_log
+import sharding
+import sketches
+
+
+"""
+versioned JSON API over books and users, for the mobile client and integrations.
+- keyset pagination: `limit` (default 50, at most 500) and the `cursor` returned as next_cursor by the previous page
+- sparse fields: `fields=id,title` selects only those columns; rows are serialized straight from the result
+  tuples, no ORM objects are built
+- filters on books: `status` and `genre`
+- bulk writes: POST, PATCH and DELETE /books take up to 500 items and commit them in one transaction
+authentication is the login session; users see their own books, admins the books of every non-admin user.
+with DB_SHARDS an admin's book list is merged from every shard in id order, one page per shard at most.
+"""
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+MAX_BULK = 500
+STATUSES = ("Reading", "Completed")
+
+BOOK_FIELDS = {
+    "id": Books.id,
+    "user_id": Books.user_id,
+    "title": Work.title,
+    "author": Work.author,
+    "genre": book_genre().label("genre"),
+    "reading_status": Books.reading_status,
+}
+USER_FIELDS = {
+    "id": User.id,
+    "name": User.name,
+    "email": User.email,
+    "book_count": select(func.count(Books.id)).where(Books.user_id == User.id).scalar_subquery(),
+}
+DEFAULT_USER_FIELDS = ("id", "name", "email")
+
+
+@api.errorhandler(HTTPException)
+def json_error(e):
+    return jsonify({"error": e.description}), e.code
+
+
+def _fields(available: dict, default) -> list[str]:
+    requested = request.args.get("fields")
+    if not requested:
+        return list(default)
+    fields = [field.strip() for field in requested.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in available]
+    if unknown or not fields:
+        abort(400, f"unknown fields: {', '.join(unknown)}; available: {', '.join(available)}")
+    return fields
+
+
+def _encode_cursor(after: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": after}).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> int:
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["after"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        abort(400, "invalid cursor")
+    if not isinstance(after, int):
+        abort(400, "invalid cursor")
+    return after
+
+
+# one page of `query` in `key` order, the rows serialized as {field: value}; every_shard merges all shards
+def _page(query, key, fields: list[str], every_shard: bool = False, session=None):
+    limit = request.args.get("limit", DEFAULT_LIMIT, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        abort(400, f"limit must be between 1 and {MAX_LIMIT}")
+    if cursor := request.args.get("cursor"):
+        query = query.where(key > _decode_cursor(cursor))
+
+    query = query.add_columns(key).order_by(key).limit(limit + 1)
+    if every_shard:
+        per_shard = sharding.gather(lambda shard_session: shard_session.execute(query).all())
+        rows = list(heapq.merge(*per_shard, key=lambda row: row[-1]))[:limit + 1]
+    else:
+        rows = (session or read_session()).execute(query).all()
+    next_cursor = _encode_cursor(rows[limit - 1][-1]) if len(rows) > limit else None
+    return jsonify({"data": [dict(zip(fields, row)) for row in rows[:limit]], "next_cursor": next_cursor})
+
+
+# the books the current user may see and change
+def _visible(query):
+    if not current_user.is_admin:
+        return query.where(Books.user_id == current_user.id)
+
+    query = query.join(User, Books.user_id == User.id).where(User.is_admin == False)
+    if (user_id := request.args.get("user_id", type=int)) is not None:
+        query = query.where(Books.user_id == user_id)
+    return query
+
+
+def _book_query(fields: list[str]):
+    return _visible(select(*[BOOK_FIELDS[field] for field in fields]).select_from(Books).join(Work))
+
+
+@api.route("/books")
+@login_required
+def list_books():
+    fields = _fields(BOOK_FIELDS, BOOK_FIELDS)
+    query = _book_query(fields)
+    if status := request.args.get("status"):
+        query = query.where(Books.reading_status == status)
+    if genre := request.args.get("genre"):
+        query = query.where(book_genre() == genre.strip().title())
+    return _page(query, Books.id, fields, every_shard=current_user.is_admin)
+
+
+@api.route("/books/<int:book_id>")
+@login_required
+def get_book(book_id):
+    fields = _fields(BOOK_FIELDS, BOOK_FIELDS)
+    with sharding.use(sharding.book_shard(book_id) if current_user.is_admin else sharding.current()):
+        row = read_session().execute(_book_query(fields).where(Books.id == book_id)).first()
+    if row is None:
+        abort(404, "book not found")
+    return jsonify({"data": dict(zip(fields, row))})
+
+
+@api.route("/users")
+@login_required
+def list_users():
+    if not current_user.is_admin:
+        abort(403, "admins only")
+    fields = _fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    query = select(*[USER_FIELDS[field] for field in fields]).where(User.is_admin == False)
+    # book_count reads the books of every shard
+    return _page(query, User.id, fields, session=sharding.library_session() if "book_count" in fields else None)
+
+
+@api.route("/users/me")
+@login_required
+def get_me():
+    fields = _fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    row = read_session().execute(select(*[USER_FIELDS[field] for field in fields])
+                                 .where(User.id == current_user.id)).one()
+    return jsonify({"data": dict(zip(fields, row))})
+
+
+def _items() -> list:
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        abort(400, "expected a non-empty JSON list")
+    if len(items) > MAX_BULK:
+        abort(400, f"at most {MAX_BULK} items per request")
+    return items
+
+
+# validated and normalized (like the book forms) title/author/genre/reading_status of one item
+def _book_values(item, index: int, partial: bool) -> dict:
+    if not isinstance(item, dict):
+        abort(400, f"item {index}: expected an object")
+    values = {}
+    for field in ("title", "author", "genre"):
+        value = item.get(field)
+        if value is None and partial:
+            continue
+        if not isinstance(value, str) or not value.strip():
+            abort(400, f"item {index}: {field} is required")
+        values[field] = value.strip().title()
+    status = item.get("reading_status")
+    if status is not None or not partial:
+        if status not in STATUSES:
+            abort(400, f"item {index}: reading_status must be one of {', '.join(STATUSES)}")
+        values["reading_status"] = status
+    return values
+
+
+# the owner of a new book: users add to their own library, admins name a non-admin user_id
+def _owner(item: dict, index: int) -> int:
+    if not current_user.is_admin:
+        if item.get("user_id", current_user.id) != current_user.id:
+            abort(403, f"item {index}: cannot add books for another user")
+        return current_user.id
+    if not isinstance(item.get("user_id"), int):
+        abort(400, f"item {index}: user_id is required")
+    return item["user_id"]
+
+
+def _visible_ids(book_ids: list) -> set[int]:
+    if not all(isinstance(book_id, int) for book_id in book_ids):
+        abort(400, "book ids must be integers")
+    query = _visible(select(Books.id)).where(Books.id.in_(book_ids))
+    if current_user.is_admin:
+        found = set().union(*sharding.gather(lambda session: session.scalars(query).all()))
+    else:
+        found = set(db.session.scalars(query))
+    missing = [book_id for book_id in book_ids if book_id not in found]
+    if missing:
+        abort(404, f"books not found: {', '.join(map(str, missing))}")
+    return found
+
+
+@api.route("/books", methods=["POST"])
+@login_required
+def create_books():
+    items = _items()
+    new_books = [(_owner(item, index), _book_values(item, index, partial=False)) for index, item in enumerate(items)]
+
+    owner_ids = {owner for owner, _ in new_books}
+    valid = set(db.session.scalars(select(User.id).where(User.id.in_(owner_ids), User.is_admin == False)))
+    if current_user.is_admin and owner_ids - valid:
+        abort(400, f"unknown users: {', '.join(map(str, sorted(owner_ids - valid)))}")
+
+    def write():
+        books = [None] * len(new_books)
+        for shard, shard_owners in sharding.group_users(owner_ids).items():
+            with sharding.use(shard):
+                indexes = [index for index, (owner, _) in enumerate(new_books) if owner in shard_owners]
+                for index in indexes:
+                    owner, values = new_books[index]
+                    books[index] = Books(user_id=owner, **values)
+                shard_books = [books[index] for index in indexes]
+                db.session.add_all(shard_books)
+                db.session.flush()
+                reading_log.books_added(shard_books)
+                sketches.books_added(shard_books)
+                profiles.books_added(shard_books)
+        bump_versions(*[user_scope(owner) for owner in owner_ids])
+        return [book.id for book in books]
+
+    book_ids = run_write(write)
+    for title, author in {(values["title"], values["author"]) for _, values in new_books}:
+        metadata.enrich_later(title, author)
+    return jsonify({"data": [{"id": book_id} for book_id in book_ids]}), 201
+
+
+@api.route("/books", methods=["PATCH"])
+@login_required
+def update_books():
+    items = _items()
+    changes = {}
+    for index, item in enumerate(items):
+        values = _book_values(item, index, partial=True)
+        if not isinstance(item.get("id"), int):
+            abort(400, f"item {index}: id is required")
+        changes[item["id"]] = values
+    _visible_ids(list(changes))
+
+    def write():
+        owners, updated = set(), 0
+        for shard, book_ids in sharding.locate_books(list(changes)).items():
+            with sharding.use(shard):
+                books = db.session.scalars(select(Books).where(Books.id.in_(book_ids))).all()
+                edits = []
+                for book in books:
+                    values = changes[book.id]
+                    old_status, old_values = book.reading_status, sketches.book_values(book)
+                    if {"title", "author", "genre"} & values.keys():
+                        book.set_work(values.get("title", book.title), values.get("author", book.author),
+                                      values.get("genre", book.genre))
+                    book.reading_status = values.get("reading_status", book.reading_status)
+                    reading_log.status_changed(book, old_status)
+                    edits.append((old_values, book))
+                    owners.add(book.user_id)
+                sketches.books_changed(edits)
+                profiles.books_changed(edits)
+                updated += len(books)
+        bump_versions(*{user_scope(user_id) for user_id in owners})
+        return updated
+
+    return jsonify({"updated": run_write(write)})
+
+
+@api.route("/books", methods=["DELETE"])
+@login_required
+def delete_books_in_bulk():
+    book_ids = (request.get_json(silent=True) or {}).get("ids")
+    if not isinstance(book_ids, list) or not book_ids or len(book_ids) > MAX_BULK:
+        abort(400, f"expected {{\"ids\": [...]}} with 1 to {MAX_BULK} book ids")
+    visible = _visible_ids(book_ids)
+    return jsonify({"deleted": run_write(lambda: delete_books(list(visible)))})
@@ -1,9 +1,12 @@
-from flask import Flask
+from flask import Flask, current_app, has_app_context
 from flask_bootstrap import Bootstrap5
 from flask_login import LoginManager, UserMixin
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Boolean
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import Integer, String, Boolean, Float, Text, LargeBinary, UniqueConstraint, DDL, event, func, select
 from dotenv import load_dotenv
 import os
 
@@ -15,7 +18,29 @@ class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+"""
+db.session picks the database of every statement and flushed row through the shard router (see sharding.py)
+when DB_SHARDS is configured; without shards it is the plain Flask-SQLAlchemy session.
+"""
+class RoutingSession(FlaskSession):
+    def _router(self):
+        return current_app.extensions.get("sharding") if has_app_context() else None
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and (router := self._router()) is not None:
+            return router.bind_for(mapper, clause)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    # rows are flushed to the shard they were loaded from or added on, whatever shard is current at the flush
+    @property
+    def connection_callable(self):
+        router = self._router()
+        if router is None:
+            return None
+        return lambda mapper, instance: router.connection_for(self, mapper, instance)
+
+
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 login_manager = LoginManager()
 
 
@@ -24,26 +49,247 @@ class User(UserMixin, db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(100))
     email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
+    password: Mapped[str] = mapped_column(String(255))
 
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
 
     # One user can have multiple books
-    books: Mapped[list["Books"]] = relationship("Books", back_populates="user", cascade="all, delete-orphan")
+    # the database deletes a user's books (ON DELETE CASCADE), the ORM never loads them just to delete them
+    books: Mapped[list["Books"]] = relationship("Books", back_populates="user", cascade="all, delete-orphan",
+                                                passive_deletes=True)
 
 
-class Books(db.Model):
-    __tablename__ = "books"
+# catalog key of a title or author: the same work typed with different case or spacing is one row
+def catalog_key(value: str | None) -> str:
+    return (value or "").strip().lower()
+
+
+# canonical catalog entry, shared by every user that owns a copy of the book
+class Work(db.Model):
+    __tablename__ = "works"
+    __table_args__ = (UniqueConstraint("title_key", "author_key"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"), nullable=False)
-    author: Mapped[str] = mapped_column(String(100))
+    title_key: Mapped[str] = mapped_column(String(100), nullable=False)
+    author_key: Mapped[str] = mapped_column(String(100), nullable=False)
     title: Mapped[str] = mapped_column(String(100), nullable=False)
-    genre: Mapped[str] = mapped_column(String(100), nullable=False)
+    author: Mapped[str] = mapped_column(String(100), nullable=False)
+    genre: Mapped[str] = mapped_column(String(100), nullable=False, index=True)
+
+    # finds the work for a title and author, creating it on first use
+    @classmethod
+    def resolve(cls, title: str, author: str, genre: str) -> "Work":
+        title_key, author_key = catalog_key(title), catalog_key(author)
+        query = select(cls).where(cls.title_key == title_key, cls.author_key == author_key)
+
+        work = db.session.execute(query).scalar()
+        if work is not None:
+            return work
+
+        work = cls(title_key=title_key, author_key=author_key, title=title.strip(), author=(author or "").strip(),
+                   genre=genre)
+        try:
+            with db.session.begin_nested():
+                db.session.add(work)
+        except IntegrityError:
+            # another request created the same work in the meantime
+            work = db.session.execute(query).scalar_one()
+        return work
+
+
+"""
+one user's copy of a work. title and author live on the shared Work and are still readable (and usable in
+queries) as attributes of the book. the genre is the work's unless this copy has its own (own_genre), so one
+user's genre never changes another user's copy; user edits never change a catalog row.
+the `books` view keeps the old flat shape for the AI-generated SQL.
+"""
+class Books(db.Model):
+    __tablename__ = "user_books"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False,
+                                         index=True)
+    work_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("works.id"), nullable=False, index=True)
     reading_status: Mapped[str] = mapped_column(String(100), nullable=False)
+    own_genre: Mapped[str | None] = mapped_column("genre", String(100))    # NULL: the work's genre
 
     # Relationship to User
     user: Mapped["User"] = relationship("User", back_populates="books")
+    work: Mapped["Work"] = relationship("Work", lazy="joined")
+
+    def __init__(self, title: str | None = None, author: str | None = None, genre: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        if title is not None:
+            self.set_work(title, author, genre)
+
+    # points this copy at the work for title/author; a genre other than the work's is kept on this copy only
+    def set_work(self, title: str, author: str, genre: str) -> None:
+        self.work = Work.resolve(title, author, genre)
+        self.own_genre = genre if genre and genre != self.work.genre else None
+
+    @hybrid_property
+    def title(self) -> str:
+        return self.work.title
+
+    @title.inplace.expression
+    @classmethod
+    def _title_expression(cls):
+        return select(Work.title).where(Work.id == cls.work_id).scalar_subquery()
 
+    @hybrid_property
+    def author(self) -> str:
+        return self.work.author
+
+    @author.inplace.expression
+    @classmethod
+    def _author_expression(cls):
+        return select(Work.author).where(Work.id == cls.work_id).scalar_subquery()
+
+    @hybrid_property
+    def genre(self) -> str:
+        return self.own_genre or self.work.genre
+
+    @genre.inplace.expression
+    @classmethod
+    def _genre_expression(cls):
+        return func.coalesce(cls.own_genre, select(Work.genre).where(Work.id == cls.work_id).scalar_subquery())
+
+
+# a book's genre in queries that already join works
+def book_genre():
+    return func.coalesce(Books.own_genre, Work.genre)
+
+
+# flat view with the pre-catalog `books` columns, queried by the AI-generated SQL
+BOOKS_VIEW = """
+CREATE VIEW books AS
+SELECT user_books.id AS id, user_books.user_id AS user_id, works.author AS author, works.title AS title,
+       COALESCE(user_books.genre, works.genre) AS genre, user_books.reading_status AS reading_status,
+       user_books.work_id AS work_id
+FROM user_books JOIN works ON works.id = user_books.work_id
+"""
+
+# Postgres refuses to drop tables a view depends on
+event.listen(db.metadata, "before_drop", DDL("DROP VIEW IF EXISTS books"))
+
+
+# facts about a book looked up outside the library (shared by every copy of the same title and author)
+class BookMetadata(db.Model):
+    __tablename__ = "book_metadata"
+    __table_args__ = (UniqueConstraint("title_key", "author_key"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    title_key: Mapped[str] = mapped_column(String(100), nullable=False, index=True)
+    author_key: Mapped[str] = mapped_column(String(100), nullable=False)
+    title: Mapped[str] = mapped_column(String(100), nullable=False)
+    author: Mapped[str] = mapped_column(String(100), nullable=False)
+    pages: Mapped[int | None] = mapped_column(Integer, index=True)
+    publication_year: Mapped[int | None] = mapped_column(Integer, index=True)
+    price: Mapped[float | None] = mapped_column(Float, index=True)
+    rating: Mapped[float | None] = mapped_column(Float, index=True)
+    synopsis: Mapped[str | None] = mapped_column(Text)
+    source: Mapped[str] = mapped_column(String(50), nullable=False)
+    fetched_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+# append-only log of library changes; user and book ids are kept after those rows are deleted
+class ReadingEvent(db.Model):
+    __tablename__ = "reading_events"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    book_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    work_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    event_type: Mapped[str] = mapped_column(String(20), nullable=False)    # added, status_changed, deleted
+    old_status: Mapped[str | None] = mapped_column(String(100))
+    new_status: Mapped[str | None] = mapped_column(String(100))
+    created_at: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+
+
+# event counters per user and day/week/month, updated with every event so trends never scan the log
+class ReadingRollup(db.Model):
+    __tablename__ = "reading_rollups"
+    __table_args__ = (UniqueConstraint("period", "period_start", "user_id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    period: Mapped[str] = mapped_column(String(10), nullable=False)          # day, week, month
+    period_start: Mapped[str] = mapped_column(String(10), nullable=False)    # YYYY-MM-DD (UTC)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    added: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    completed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    deleted: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    status_changes: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    completion_seconds: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    timed_completions: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+# one reader's library summarized in fixed-size form, kept up to date by profiles.py on every book write
+class ReaderProfile(db.Model):
+    __tablename__ = "reader_profiles"
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    total_books: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    status_counts: Mapped[str] = mapped_column(Text, nullable=False, default="{}")     # JSON {status: books}
+    genre_counts: Mapped[str] = mapped_column(Text, nullable=False, default="{}")      # JSON {genre: books}
+    author_counts: Mapped[str] = mapped_column(Text, nullable=False, default="{}")     # JSON {author: books}
+    recent_books: Mapped[str] = mapped_column(Text, nullable=False, default="[]")      # JSON, newest first
+    completion_rate: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    genre_diversity: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    author_diversity: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    features: Mapped[str] = mapped_column(Text, nullable=False, default="[]")          # JSON list of floats
+    updated_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+# serialized analytics sketches (see sketches.py), one row per sketch
+class AnalyticsSketch(db.Model):
+    __tablename__ = "analytics_sketches"
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+# sketch updates appended by the book writes (on the book's shard), folded into analytics_sketches now and then
+class SketchDelta(db.Model):
+    __tablename__ = "sketch_deltas"
+    __table_args__ = {"sqlite_autoincrement": True}    # ids of folded (and pruned) deltas are never reused
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    sketch: Mapped[str] = mapped_column(String(50), nullable=False)
+    item: Mapped[str] = mapped_column(Text, nullable=False)
+    count: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+# one version counter per cached data scope ("library", "user:<id>"), bumped on every write
+class DataVersion(db.Model):
+    __tablename__ = "data_versions"
+    scope: Mapped[str] = mapped_column(String(100), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+# append-only log of version bumps; every worker tails it to keep its in-process caches coherent
+class CacheInvalidation(db.Model):
+    __tablename__ = "cache_invalidations"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    scope: Mapped[str] = mapped_column(String(100), nullable=False)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_at: Mapped[float] = mapped_column(Float, nullable=False, index=True)
+
+
+# the shard holding a user's books and history (see sharding.py); users without a row live on shard 0
+class UserShard(db.Model):
+    __tablename__ = "user_shards"
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    shard: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+
+
+# a users/book_metadata change a shard missed (see sharding.py): the row to copy again from shard 0,
+# or with no table the whole shard, when a replayed statement failed
+class ReplicationRetry(db.Model):
+    __tablename__ = "replication_retries"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    shard: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    table_name: Mapped[str | None] = mapped_column(String(100))
+    row_id: Mapped[int | None] = mapped_column(Integer)
+    created_at: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+# next free id per table on one shard, so ids stay unique across shards (see sharding.ID_RANGE)
+class ShardSequence(db.Model):
+    __tablename__ = "shard_sequences"
+    name: Mapped[str] = mapped_column(String(100), primary_key=True)
+    next_id: Mapped[int] = mapped_column(Integer, nullable=False)
 
 
 def create_app(test_config=None):
@@ -54,17 +300,99 @@ def create_app(test_config=None):
     if test_config:
         app.config.update(test_config)
 
+    # pool profile and optional read replica have to be in the config before the engines are created
+    import database
+    database.configure_database(app)
+
+    # DB_SHARDS adds one bind per shard, so it also has to run before the engines are created
+    import sharding
+    sharding.configure(app)
+
     Bootstrap5(app)
     db.init_app(app)
+    # the replica has the primary's tables; the empty metadata Flask-SQLAlchemy keeps for its bind (on the
+    # db object, shared by every app) would make db.create_all() expect a replica bind in other apps
+    db.metadatas.pop(database.REPLICA_BIND, None)
+    app.teardown_appcontext(database.close_read_session)
+    database.enable_sqlite_foreign_keys(app)
+    database.init_sqlite_mode(app)
+    sharding.init_app(app)
 
     login_manager.init_app(app)
     login_manager.login_view = "blueprint.login"
 
+    # in-memory cache of rendered pages, keyed by ETag
+    import cache
+    cache.init_app(app)
+
+    # per-worker L1 cache, kept coherent across workers through the cache_invalidations log
+    import cache_bus
+    cache_bus.init_app(app)
+
+    # results of the AI chat's read-only SQL, shared by every user asking the same query
+    import sql_cache
+    sql_cache.init_app(app)
+
+    # persistent cache of web lookups, shared by the workers of this host
+    import disk_cache
+    disk_cache.init_app(app)
+
+    # identical concurrent LLM calls share one upstream call, also across the workers of this host
+    import singleflight
+    singleflight.init_app(app)
+
+    # background enrichment of book_metadata
+    import metadata
+    metadata.init_app(app)
+
+    # rate limits and concurrency slots for the AI chat
+    import admission
+    admission.init_app(app)
+
+    # on-demand request profiles for admins (?profile=1 or the X-Profile header)
+    import profiler
+    profiler.init_app(app)
+
+    # append-only log of the chat questions (`flask chat-report` summarizes it)
+    import chat_log
+    chat_log.init_app(app)
+
     # register routes with the blueprint endpoint
     from routes import blueprint
     app.register_blueprint(blueprint)
 
-    with app.app_context():
+    # versioned JSON API; it answers 401 instead of redirecting to the login page
+    from api import api
+    app.register_blueprint(api)
+    login_manager.blueprint_login_views["api"] = None
+
+    # `flask warm-caches`, the cache warm-up gunicorn runs in every worker with CACHE_WARMUP=1
+    import warmup
+    warmup.init_app(app)
+
+    # create_all also creates the `books` view over the works catalog (migrating the old books table once)
+    # and widens the password column of an older database
+    import catalog
+
+    # the analytics sketches are built once the schema exists, never by a request
+    import sketches
+    sketches.init_app(app)
+
+    @app.cli.command("migrate")
+    def migrate():
+        """Create missing tables and run the data migrations."""
         db.create_all()
+        sharding.create_all()
+        sketches.ensure_built()
+        print("Database schema is up to date.")
+
+    # in production run `flask --app main migrate` once per deploy and set DB_AUTO_MIGRATE=0,
+    # so booting a worker never touches the schema
+    auto_migrate = app.config.get("DB_AUTO_MIGRATE", os.getenv("DB_AUTO_MIGRATE", "1"))
+    if str(auto_migrate).strip().lower() in ("1", "true", "yes", "on"):
+        with app.app_context():
+            db.create_all()
+            sharding.create_all()
+            sketches.ensure_built()
 
     return app
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""
+compares reading a whole library through the JSON API with rendering it as HTML.
+
+    python benchmarks/api_throughput.py --books 1000 10000 --rounds 5
+
+for every library size it times, as an admin:
+- "html": GET /admin/books with the page and fragment caches emptied first, so the page is really rendered
+- "html (cached)": the same page served from the page cache
+- "api": every page of GET /api/v1/books?limit=500, following next_cursor
+- "api (sparse)": the same with fields=id,title
+- "api first page": one GET /api/v1/books (50 books), what the mobile client loads first
+plus, for writes, one bulk POST /api/v1/books of 500 books against 500 POSTs of the add-book form.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("FLASK_SECRET_KEY", "benchmark")
+
+from werkzeug.security import generate_password_hash
+from app_factory import create_app, db, User, Books, Work
+
+
+def _seed(books: int) -> int:
+    admin = User(name="Admin", email="admin@bench.com", password=generate_password_hash("x"), is_admin=True)
+    user = User(name="Bench", email="bench@bench.com", password=generate_password_hash("x"))
+    db.session.add_all([admin, user])
+    works = [Work(title_key=f"book {i}", author_key=f"author {i % 50}", title=f"Book {i}",
+                  author=f"Author {i % 50}", genre=f"Genre {i % 20}") for i in range(books)]
+    db.session.add_all(works)
+    db.session.flush()
+    db.session.add_all(Books(user_id=user.id, work_id=work.id, reading_status="Reading") for work in works)
+    db.session.commit()
+    return user.id
+
+
+def _timed(rounds: int, fn) -> float:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 1)
+
+
+def run(books: int, rounds: int) -> dict:
+    db_fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(db_fd)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path, "METADATA_SOURCE": "",
+                      "WTF_CSRF_ENABLED": False})
+    with app.app_context():
+        user_id = _seed(books)
+
+    client = app.test_client()
+    client.post("/login", data={"email": "admin@bench.com", "password": "x"})
+
+    def html():
+        app.extensions["page_cache"].clear()
+        app.extensions["fragment_cache"].clear()
+        assert client.get("/admin/books").status_code == 200
+
+    def api(fields=None):
+        cursor, total = None, 0
+        while True:
+            query = {"limit": 500, **({"fields": fields} if fields else {}), **({"cursor": cursor} if cursor else {})}
+            page = client.get("/api/v1/books", query_string=query).get_json()
+            total += len(page["data"])
+            if not (cursor := page["next_cursor"]):
+                break
+        assert total >= books
+
+    def form_posts():
+        for i in range(500):
+            client.post(f"/admin/users/{user_id}/books/add", data={"title": f"Form {i}", "author": "A",
+                                                                    "genre": "G", "reading_status": "Reading"})
+
+    def bulk_post():
+        r = client.post("/api/v1/books", json=[{"user_id": user_id, "title": f"Bulk {i}", "author": "A",
+                                                "genre": "G", "reading_status": "Reading"} for i in range(500)])
+        assert r.status_code == 201
+
+    html()
+    results = {
+        "html": _timed(rounds, html),
+        "html (cached)": _timed(rounds, lambda: client.get("/admin/books")),
+        "api": _timed(rounds, api),
+        "api (sparse)": _timed(rounds, lambda: api("id,title")),
+        "api first page": _timed(rounds, lambda: client.get("/api/v1/books")),
+        "500 form posts": _timed(1, form_posts),
+        "1 bulk post of 500": _timed(1, bulk_post),
+    }
+
+    with app.app_context():
+        db.engine.dispose()
+    os.unlink(db_path)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    for books in args.books:
+        results = run(books, args.rounds)
+        print(f"{books:>7} books: " + ", ".join(f"{name}={ms}ms" for name, ms in results.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+measures how long deleting a user takes as their library grows.
+
+    python benchmarks/bulk_delete.py --sizes 100 1000 10000
+
+"orm" deletes the way admin_delete_user used to (load every book, one DELETE per row),
+"set-based" uses routes.delete_users (one DELETE, the books go through ON DELETE CASCADE).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from app_factory import create_app, db, User, Books, Work
+from routes import delete_users
+
+
+def _add_works(size: int) -> list[int]:
+    works = [Work(title_key=f"book {i}", author_key="a", title=f"Book {i}", author="A", genre=f"G{i % 20}")
+             for i in range(size)]
+    db.session.add_all(works)
+    db.session.commit()
+    return [work.id for work in works]
+
+
+def _add_user(work_ids: list[int]) -> int:
+    user = User(name="Bench", email=f"bench-{time.perf_counter_ns()}@test.com", password="x")
+    db.session.add(user)
+    db.session.flush()
+    db.session.add_all(Books(user_id=user.id, work_id=work_id, reading_status="Reading") for work_id in work_ids)
+    db.session.commit()
+    return user.id
+
+
+# a loaded collection is still deleted row by row, which is what the ORM cascade used to do
+def _orm_delete(user_id: int) -> None:
+    user = db.session.get(User, user_id)
+    len(user.books)
+    db.session.delete(user)
+    db.session.commit()
+
+
+def _set_based_delete(user_id: int) -> None:
+    delete_users([user_id])
+    db.session.commit()
+
+
+def run(size: int) -> dict:
+    db_fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(db_fd)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path, "METADATA_SOURCE": ""})
+
+    results = {}
+    with app.app_context():
+        work_ids = _add_works(size)
+        for name, delete in (("orm", _orm_delete), ("set-based", _set_based_delete)):
+            user_id = _add_user(work_ids)
+            db.session.remove()
+
+            start = time.perf_counter()
+            delete(user_id)
+            results[name] = round((time.perf_counter() - start) * 1000, 1)
+
+            assert db.session.scalar(db.select(db.func.count(Books.id)).where(Books.user_id == user_id)) == 0
+            db.session.remove()
+        db.engine.dispose()
+
+    os.unlink(db_path)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        results = run(size)
+        print(f"{size:>7} books: orm={results['orm']}ms, set-based={results['set-based']}ms")
+
+
+if __name__ == "__main__":
+    main()
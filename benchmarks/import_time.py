@@ -0,0 +1,79 @@
+"""
+measures the cold start of a worker (`import main`, which builds the app) and fails past a budget.
+
+    python benchmarks/import_time.py --runs 5 --budget-ms 1500
+
+every run is a fresh interpreter with DB_AUTO_MIGRATE=0, like a production worker.
+exits with status 1 when the median is over budget or a lazily loaded module was imported at startup.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must only be imported on first use
+LAZY_MODULES = ("requests", "openai")
+
+PROBE = "import sys, main; print(','.join(m for m in {lazy!r} if m in sys.modules))"
+
+
+def cold_start(env: dict) -> tuple[float, str]:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", PROBE.format(lazy=LAZY_MODULES)], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return (time.perf_counter() - start) * 1000, result.stdout.strip()
+
+
+# the slowest imports of one run, from python -X importtime
+def slowest_imports(env: dict, top: int = 10) -> list[tuple[int, str]]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            timings.append((int(cumulative), name.strip()))
+    return sorted(timings, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", 1500)))
+    args = parser.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(db_fd)
+    env = dict(os.environ, DB_AUTO_MIGRATE="0", DB_URI="sqlite:///" + db_path,
+               FLASK_SECRET_KEY=os.getenv("FLASK_SECRET_KEY", "benchmark"))
+
+    try:
+        runs = [cold_start(env) for _ in range(args.runs)]
+        top = slowest_imports(env)
+    finally:
+        os.unlink(db_path)
+
+    median = statistics.median(ms for ms, _ in runs)
+    eager = runs[0][1]
+    print(f"cold start: median={median:.0f}ms, min={min(ms for ms, _ in runs):.0f}ms, budget={args.budget_ms:.0f}ms")
+    print("slowest imports (cumulative):")
+    for micros, name in top:
+        print(f"  {micros / 1000:8.1f}ms  {name}")
+
+    failed = False
+    if eager:
+        print(f"FAIL: imported at startup instead of on first use: {eager}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"FAIL: cold start over budget by {median - args.budget_ms:.0f}ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
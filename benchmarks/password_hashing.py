@@ -0,0 +1,35 @@
+"""
+times password verification for the legacy methods and the candidate policies on this machine,
+and recommends a PASSWORD_HASH_METHOD for a target budget.
+
+    python benchmarks/password_hashing.py --target-ms 80
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import DEFAULT_METHOD, calibrate, time_method
+
+
+CANDIDATES = [
+    ("legacy register (pbkdf2, Werkzeug default iterations)", "pbkdf2:sha256"),
+    ("legacy admin edit (Werkzeug default scrypt)", "scrypt:32768:8:1"),
+    ("current default", DEFAULT_METHOD),
+    ("pbkdf2 100k", "pbkdf2:sha256:100000"),
+    ("scrypt n=8192", "scrypt:8192:8:1"),
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target-ms", type=float, default=80)
+    args = parser.parse_args()
+
+    for label, method in CANDIDATES:
+        print(f"{method:>22}  {time_method(method):8.1f} ms  ({label})")
+
+    print()
+    print(f"recommended scrypt for {args.target_ms:g} ms: PASSWORD_HASH_METHOD={calibrate(args.target_ms)}")
+    print(f"recommended pbkdf2 for {args.target_ms:g} ms: PASSWORD_HASH_METHOD={calibrate(args.target_ms, 'pbkdf2')}")
@@ -0,0 +1,104 @@
+"""
+compares book write throughput on one database with the same load spread over DB_SHARDS.
+
+    python benchmarks/shard_writes.py --shards 4 --threads 8 --ops 200
+
+every thread is one reader adding books (through run_write, like the routes do) on their own shard,
+in SQLite performance mode, so each database file has its own single-writer queue.
+the readers are placed by sharding.place_user, as on registration, against fresh temporary databases.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from app_factory import create_app, db, User, Books
+from database import run_write
+import sharding
+
+
+def run(shards: int, threads: int, ops: int) -> dict:
+    directory = tempfile.mkdtemp()
+    shard_paths = [os.path.join(directory, f"shard{shard}.db") for shard in range(1, shards)]
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "main.db"),
+        "DB_SHARDS": ",".join("sqlite:///" + path for path in shard_paths),
+        "SQLITE_PERFORMANCE_MODE": True,
+        "DB_POOL_PROFILE": "high-concurrency",
+        "METADATA_SOURCE": "",
+        "SKETCH_FOLD_INTERVAL": 0,
+        "CHAT_LOG_PATH": "",
+    })
+
+    placed = []
+    with app.app_context():
+        for n in range(threads):
+            user = User(name=f"Bench {n}", email=f"bench{n}@test.com", password="x")
+            db.session.add(user)
+            db.session.flush()
+            placed.append((user.id, sharding.place_user(user)))
+        db.session.commit()
+
+    timings = {"writes": 0.0, "errors": 0}
+    lock = threading.Lock()
+
+    def worker(n, user_id, shard):
+        write_time = 0.0
+        errors = 0
+        with app.app_context(), sharding.use(shard):
+            for i in range(ops):
+                start = time.perf_counter()
+                try:
+                    run_write(lambda: db.session.add(Books(user_id=user_id, title=f"Book {n}-{i}", author="A",
+                                                           genre="G", reading_status="Reading")))
+                except Exception:
+                    db.session.rollback()
+                    errors += 1
+                write_time += time.perf_counter() - start
+                db.session.remove()
+
+        with lock:
+            timings["writes"] += write_time
+            timings["errors"] += errors
+
+    workers = [threading.Thread(target=worker, args=(n, user_id, shard))
+               for n, (user_id, shard) in enumerate(placed)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+    total = threads * ops
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "writes_per_s": round(total / elapsed, 1),
+        "write_ms": round(timings["writes"] / total * 1000, 3),
+        "errors": timings["errors"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=4, help="databases to spread the readers over")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=200, help="writes per thread")
+    args = parser.parse_args()
+
+    for shards in sorted({1, args.shards}):
+        result = run(shards, args.threads, args.ops)
+        print(f"{shards:>2} shard(s): " + ", ".join(f"{k}={v}" for k, v in result.items()))
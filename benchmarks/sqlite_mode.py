@@ -0,0 +1,99 @@
+"""
+compares SQLite read/write throughput with and without SQLITE_PERFORMANCE_MODE.
+
+    python benchmarks/sqlite_mode.py --threads 8 --ops 200
+
+every thread alternates between adding a book (through run_write, like the routes do)
+and reading the library-wide book count, against a fresh temporary database per mode.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from sqlalchemy import func
+from app_factory import create_app, db, User, Books
+from database import run_write
+
+
+def run(performance_mode: bool, threads: int, ops: int) -> dict:
+    db_fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(db_fd)
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path,
+        "SQLITE_PERFORMANCE_MODE": performance_mode,
+        "DB_POOL_PROFILE": "high-concurrency",
+    })
+
+    with app.app_context():
+        user = User(name="Bench", email="bench@test.com", password="x")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    timings = {"writes": 0.0, "reads": 0.0, "errors": 0}
+    lock = threading.Lock()
+
+    def worker(n):
+        write_time = read_time = 0.0
+        errors = 0
+        with app.app_context():
+            for i in range(ops):
+                start = time.perf_counter()
+                try:
+                    run_write(lambda: db.session.add(Books(user_id=user_id, title=f"Book {n}-{i}", author="A",
+                                                           genre="G", reading_status="Reading")))
+                except Exception:
+                    db.session.rollback()
+                    errors += 1
+                write_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                db.session.scalar(db.select(func.count(Books.id)))
+                read_time += time.perf_counter() - start
+                db.session.remove()
+
+        with lock:
+            timings["writes"] += write_time
+            timings["reads"] += read_time
+            timings["errors"] += errors
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        db.engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
+
+    total = threads * ops
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "ops_per_s": round(2 * total / elapsed, 1),
+        "write_ms": round(timings["writes"] / total * 1000, 3),
+        "read_ms": round(timings["reads"] / total * 1000, 3),
+        "errors": timings["errors"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=200, help="writes and reads per thread")
+    args = parser.parse_args()
+
+    for label, enabled in [("default", False), ("performance mode", True)]:
+        result = run(enabled, args.threads, args.ops)
+        print(f"{label:>17}: " + ", ".join(f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,253 @@
+import hashlib
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+from flask import current_app, g, request, make_response
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import delete, select
+from app_factory import db, DataVersion, CacheInvalidation
+from database import dialect_insert
+import sharding
+
+
+LIBRARY_SCOPE = "library"
+INVALIDATION_RETENTION = 3600    # seconds of cache_invalidations that are kept
+INVALIDATION_PRUNE_CHANCE = 0.01
+
+
+# scope key for everything shown about one user (their profile and their books)
+def user_scope(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+# thread-safe LRU map bounded by entry count and (optionally) by the total size of the stored values
+class LRUCache:
+    def __init__(self, max_entries: int = 256, max_bytes: int | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        size = len(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return    # would evict everything else, never worth caching
+
+        with self._lock:
+            if key in self._data:
+                self.size_bytes -= len(self._data[key])
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self.size_bytes += size
+
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.size_bytes > self.max_bytes):
+                _, evicted = self._data.popitem(last=False)
+                self.size_bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+"""
+jinja tag for caching rendered template fragments:
+
+    {% cache "manage-books:rows", scopes=["library"] %} ... {% endcache %}
+
+the positional arguments make up the fragment key; the block is re-rendered only
+when the version of one of its scopes changes, otherwise it comes from the fragment cache.
+"""
+class FragmentCacheExtension(Extension):
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = []
+        scopes = nodes.List([])
+
+        while parser.stream.current.type != "block_end":
+            if key_parts or scopes.items:
+                parser.stream.expect("comma")
+            if parser.stream.current.test("name:scopes") and parser.stream.look().test("assign"):
+                parser.stream.skip(2)
+                scopes = parser.parse_expression()
+            else:
+                key_parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        call = self.call_method("_render_fragment", [nodes.List(key_parts), scopes])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, key_parts, scopes, caller):
+        versions = get_versions(list(scopes))
+        key = "|".join([str(part) for part in key_parts] +
+                       [f"{scope}={versions[scope]}" for scope in sorted(versions)])
+
+        fragment_cache = current_app.extensions["fragment_cache"]
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            fragment_cache.set(key, fragment)
+
+        return Markup(fragment)
+
+
+# every app gets its own page cache, so pages rendered against one database are never served for another
+def init_app(app) -> None:
+    app.extensions["page_cache"] = LRUCache(max_entries=app.config.get("PAGE_CACHE_SIZE", 256))
+    app.extensions["fragment_cache"] = LRUCache(max_entries=app.config.get("FRAGMENT_CACHE_SIZE", 1024),
+                                                max_bytes=app.config.get("FRAGMENT_CACHE_BYTES", 16 * 1024 * 1024))
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+
+"""
+bumps the version of the given scopes inside the current session,
+so the bump is committed in the same transaction as the write itself.
+the library scope is always bumped because every write changes library-wide pages.
+with DB_SHARDS the counters live on the current shard, next to the rows that were written.
+"""
+def bump_versions(*scopes: str) -> None:
+    scopes = sorted({LIBRARY_SCOPE, *scopes})
+    # one upsert, so two transactions creating the same scope at once both count instead of one failing
+    statement = dialect_insert(db.session.get_bind(DataVersion))(DataVersion).values(
+        [{"scope": scope, "version": 1} for scope in scopes])
+    db.session.execute(statement.on_conflict_do_update(index_elements=[DataVersion.scope],
+                                                       set_={"version": DataVersion.version + 1}))
+
+    publish_versions(scopes)
+    g.pop("data_versions", None)
+
+
+"""
+appends the new versions of `scopes` to cache_invalidations, the log every worker tails (see cache_bus).
+the shards and ids are kept in session.info, so after the commit this worker knows about its own write right away.
+old entries are pruned now and then; a worker that fell that far behind drops its whole L1 cache.
+"""
+def publish_versions(scopes) -> None:
+    now = time.time()
+    rows = db.session.execute(select(DataVersion.scope, DataVersion.version)
+                              .where(DataVersion.scope.in_(scopes))).all()
+    entries = [CacheInvalidation(scope=scope, version=version, created_at=now) for scope, version in rows]
+    db.session.add_all(entries)
+    db.session.flush()
+    db.session.info.setdefault("published_versions", []).extend(
+        (sharding.current(), entry.id, entry.scope, entry.version) for entry in entries)
+
+    if random.random() < INVALIDATION_PRUNE_CHANCE:
+        db.session.execute(delete(CacheInvalidation)
+                           .where(CacheInvalidation.created_at < now - INVALIDATION_RETENTION))
+
+
+# bumps the scopes of one user (and the library) after their books or profile changed
+def touch_user(user_id: int) -> None:
+    bump_versions(user_scope(user_id))
+
+
+"""
+the stored version of every scope (unknown scopes are 0), read through `session` (db.session by default).
+with DB_SHARDS a scope's version is the sum of its counters on all shards, which are read in parallel.
+"""
+def read_versions(scopes: list[str], session=None) -> dict:
+    query = select(DataVersion.scope, DataVersion.version).where(DataVersion.scope.in_(scopes))
+    if sharding.enabled():
+        totals = Counter()
+        for rows in sharding.gather(lambda shard_session: shard_session.execute(query).all()):
+            totals.update(dict(rows))
+    else:
+        totals = Counter(dict((session or db.session).execute(query).all()))
+    return {scope: totals[scope] for scope in scopes}
+
+
+"""
+returns the current version of every scope (unknown scopes are 0).
+versions are remembered for the rest of the request, so the page ETag and all
+cached fragments on that page share a single counter lookup.
+"""
+def get_versions(scopes: list[str]) -> dict:
+    known = g.setdefault("data_versions", {})
+    missing = [scope for scope in scopes if scope not in known]
+
+    if missing:
+        known.update(read_versions(missing))
+
+    return {scope: known[scope] for scope in scopes}
+
+
+# strong ETag built from the page identity, the viewer and the versions of the scopes it shows
+def make_etag(versions: dict) -> str:
+    parts = [request.endpoint or "", request.full_path, str(current_user.get_id())]
+    parts += [f"{scope}={versions[scope]}" for scope in sorted(versions)]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:32]
+
+
+"""
+view decorator for read-only pages:
+- derives a strong ETag from the version counters of the scopes returned by `scopes_for`
+- answers 304 Not Modified when the browser already has that version
+- otherwise serves the rendered page from memory, rendering it only on a cache miss
+"""
+def conditional_page(scopes_for):
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if g.get("profiling"):
+                return view(*args, **kwargs)    # a profiled request always does the real work
+
+            # the page is stored under versions read from the primary, so its body is read there too
+            g.read_primary = True
+            versions = get_versions(scopes_for(**kwargs))
+            etag = make_etag(versions)
+
+            page_cache = current_app.extensions["page_cache"]
+
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                body = page_cache.get(etag)
+                if body is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    page_cache.set(etag, response.get_data())
+                else:
+                    response = make_response(body)
+
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,161 @@
+import copy
+import os
+import threading
+import time
+from flask import current_app, has_app_context, has_request_context, request, session
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from app_factory import db, DataVersion, CacheInvalidation
+from cache import LRUCache, INVALIDATION_RETENTION
+import sharding
+
+
+"""
+coherent in-process (L1) caches across gunicorn workers.
+every version bump is appended to cache_invalidations in the write's own transaction (cache.publish_versions),
+so the log is the invalidation bus. with DB_SHARDS every shard has its own log and counters, and the
+version of a scope is the sum of its counters on all shards. each worker keeps:
+- the version it knows for every scope on every shard, brought up to date by reading the new log entries
+  at most every CACHE_BUS_INTERVAL seconds, and right away for the commits it made itself
+- an L1 cache of computed values stamped with the versions of the scopes they were computed from;
+  an entry is only served while all of those versions are unchanged
+read-your-writes: after a write the user's session remembers the newest log id this worker published on
+each shard, and any worker that has not read a log that far catches up before answering from its L1 cache.
+"""
+SEEN_KEY = "cache_seen"
+
+
+class InvalidationBus:
+    def __init__(self, interval: float = 1.0, max_entries: int = 512):
+        self.interval = interval
+        self.entries = LRUCache(max_entries=max_entries)
+        self.versions = {}        # scope -> {shard: newest version this worker knows of}
+        self.read_ids = None      # shard -> last cache_invalidations id read, None until the first read
+        self.written_ids = {}     # shard -> newest id published by this worker
+        self.read_at = 0.0
+        self.polls = 0
+        self._lock = threading.Lock()
+
+    def _reset(self) -> None:
+        last_ids = {}
+        for shard in sharding.shards():
+            with sharding.use(shard):
+                last_ids[shard] = db.session.scalar(select(func.max(CacheInvalidation.id))) or 0
+        with self._lock:
+            self.entries.clear()
+            self.versions.clear()
+            self.read_ids = last_ids
+            self.read_at = time.monotonic()
+
+    def _apply(self, rows) -> None:
+        for shard, _, scope, version in rows:
+            known = self.versions.setdefault(scope, {})
+            if version > known.get(shard, -1):
+                known[shard] = version
+
+    # reads the log entries other workers appended since the last read
+    def poll(self, min_ids: dict[int, int] | None = None) -> None:
+        now = time.monotonic()
+        if self.read_ids is None or now - self.read_at > INVALIDATION_RETENTION / 2:
+            self._reset()    # first use, or so far behind that pruned entries may have been missed
+            return
+        caught_up = all(self.read_ids.get(shard, 0) >= min_id for shard, min_id in (min_ids or {}).items())
+        if caught_up and now - self.read_at < self.interval:
+            return
+
+        rows = []
+        for shard in sharding.shards():
+            with sharding.use(shard):
+                rows += [(shard, *row) for row in db.session.execute(
+                    select(CacheInvalidation.id, CacheInvalidation.scope, CacheInvalidation.version)
+                    .where(CacheInvalidation.id > self.read_ids.get(shard, 0)).order_by(CacheInvalidation.id)
+                )]
+        with self._lock:
+            self._apply(rows)
+            for shard, entry_id, _, _ in rows:
+                self.read_ids[shard] = max(self.read_ids.get(shard, 0), entry_id)
+            self.read_at = now
+            self.polls += 1
+
+    # versions committed by this worker, known before the next poll
+    def observe(self, rows) -> None:
+        with self._lock:
+            self._apply(rows)
+            for shard, entry_id, _, _ in rows:
+                self.written_ids[shard] = max(self.written_ids.get(shard, 0), entry_id)
+
+    def current_versions(self, scopes: list[str]) -> dict:
+        missing = [scope for scope in scopes if scope not in self.versions]
+        if missing:
+            rows = []
+            for shard in sharding.shards():
+                with sharding.use(shard):
+                    found = dict(db.session.execute(select(DataVersion.scope, DataVersion.version)
+                                                    .where(DataVersion.scope.in_(missing))).all())
+                rows += [(shard, None, scope, found.get(scope, 0)) for scope in missing]
+            with self._lock:
+                self._apply(rows)
+        return {scope: sum(self.versions[scope].values()) for scope in scopes}
+
+    # the cached value of `key` while `scopes` are unchanged, otherwise compute() (stored for next time)
+    def cached(self, key, scopes: list[str], compute):
+        seen = _seen() if has_request_context() else {}
+        self.poll(min_ids={int(shard): entry_id for shard, entry_id in seen.items()})
+        stamp = self.current_versions(scopes)
+
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            return copy.deepcopy(entry[1])
+
+        value = compute()
+        self.entries.set(key, (stamp, value))
+        return copy.deepcopy(value)
+
+    def stats(self) -> dict:
+        return {**self.entries.stats(), "read_ids": self.read_ids, "written_ids": self.written_ids,
+                "polls": self.polls, "scopes": len(self.versions)}
+
+
+def bus() -> InvalidationBus:
+    return current_app.extensions["cache_bus"]
+
+
+def cached(key, scopes: list[str], compute):
+    return bus().cached(key, scopes, compute)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(db_session) -> None:
+    published = db_session.info.pop("published_versions", None)
+    if published and has_app_context() and "cache_bus" in current_app.extensions:
+        bus().observe(published)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(db_session) -> None:
+    db_session.info.pop("published_versions", None)
+
+
+# {shard: log id} this user's session has seen written; a cookie from before DB_SHARDS holds one id for shard 0
+def _seen() -> dict:
+    seen = session.get(SEEN_KEY, {})
+    return seen if isinstance(seen, dict) else {"0": seen}
+
+
+# after a write, the session cookie tells every worker how far it has to read each log for this user
+def _remember_writes(response):
+    if request.method not in ("GET", "HEAD", "OPTIONS"):
+        seen = _seen()
+        written = {str(shard): max(entry_id, seen.get(str(shard), 0))
+                   for shard, entry_id in bus().written_ids.items()}
+        if {**seen, **written} != seen:
+            session[SEEN_KEY] = {**seen, **written}
+    return response
+
+
+def init_app(app) -> None:
+    app.extensions["cache_bus"] = InvalidationBus(
+        interval=float(app.config.get("CACHE_BUS_INTERVAL", os.getenv("CACHE_BUS_INTERVAL", 1.0))),
+        max_entries=int(app.config.get("L1_CACHE_SIZE", os.getenv("L1_CACHE_SIZE", 512))),
+    )
+    app.after_request(_remember_writes)
@@ -0,0 +1,128 @@
+import os
+import re
+import select
+import socket
+import tempfile
+import time
+from functools import wraps
+from flask import g, has_app_context, jsonify, request
+from flask_login import current_user
+
+
+"""
+cancellation of abandoned AI chat requests.
+a request is cancelled when the browser aborts it and posts to /ai-chat/cancel (which may reach another
+worker, so cancellations are marker files in CANCEL_DIR), or when gunicorn's socket shows the client is gone.
+long-running steps call check() / cancelled() and stop early: the LLM stream is closed,
+web searches are skipped and AI-generated SQL is interrupted.
+"""
+CHECK_INTERVAL = 0.05    # seconds between two looks at the marker file and the socket
+PRUNE_AFTER = 3600
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9-]{1,64}$")
+
+
+# a BaseException (like asyncio.CancelledError), so the routes' `except Exception` fallbacks don't swallow it
+class Cancelled(BaseException):
+    pass
+
+
+def _cancel_dir() -> str:
+    return os.getenv("CANCEL_DIR", os.path.join(tempfile.gettempdir(), "library-cancel"))
+
+
+def _marker(user_id: int, request_id: str) -> str:
+    return os.path.join(_cancel_dir(), f"{user_id}-{request_id}")
+
+
+# True when the client closed the connection (gunicorn sync workers expose the socket in the environ)
+def client_disconnected(environ: dict) -> bool:
+    sock = environ.get("gunicorn.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+
+class CancelToken:
+    def __init__(self, marker: str | None, environ: dict):
+        self.marker = marker
+        self.environ = environ
+        self._cancelled = False
+        self._checked_at = 0.0
+
+    def cancelled(self) -> bool:
+        now = time.monotonic()
+        if self._cancelled or now - self._checked_at < CHECK_INTERVAL:
+            return self._cancelled
+
+        self._checked_at = now
+        self._cancelled = bool(self.marker and os.path.exists(self.marker)) or client_disconnected(self.environ)
+        return self._cancelled
+
+    def check(self) -> None:
+        if self.cancelled():
+            raise Cancelled()
+
+    def close(self) -> None:
+        if self.marker:
+            try:
+                os.unlink(self.marker)
+            except OSError:
+                pass
+
+
+# route decorator: the request can be cancelled through the "request_id" in its JSON body
+def cancellable(func):
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        request_id = (request.get_json(silent=True) or {}).get("request_id")
+        marker = _marker(current_user.id, request_id) if _REQUEST_ID.match(str(request_id or "")) else None
+        g.cancel_token = CancelToken(marker, request.environ)
+        try:
+            return func(*args, **kwargs)
+        except Cancelled:
+            return jsonify({"reply": "Cancelled."}), 499    # nobody is listening any more
+        finally:
+            g.pop("cancel_token").close()
+
+    return decorated_function
+
+
+# marks a request of this user as cancelled; old markers are cleaned up on the way
+def cancel(user_id: int, request_id: str) -> bool:
+    if not _REQUEST_ID.match(request_id or ""):
+        return False
+
+    directory = _cancel_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(_marker(user_id, request_id), "w"):
+        pass
+
+    cutoff = time.time() - PRUNE_AFTER
+    for entry in os.scandir(directory):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+    return True
+
+
+# the token of the current request, None outside a cancellable request
+def current() -> CancelToken | None:
+    return g.get("cancel_token") if has_app_context() else None
+
+
+def cancelled() -> bool:
+    token = current()
+    return token is not None and token.cancelled()
+
+
+def check() -> None:
+    token = current()
+    if token is not None:
+        token.check()
@@ -0,0 +1,81 @@
+from sqlalchemy import event, inspect, text
+from app_factory import db, BOOKS_VIEW, User
+
+
+# the catalog key in SQL, identical to app_factory.catalog_key
+def _key(column: str) -> str:
+    return f"LOWER(TRIM(COALESCE({column}, '')))"
+
+
+"""
+moves a pre-catalog database (one wide `books` table) to works + user_books:
+- one work per distinct (title, author), compared case- and whitespace-insensitively;
+  the first spelling and genre seen win
+- every book row becomes a user_books row with the same id, so existing links keep working;
+  a book whose genre differs from its work's keeps it as its own genre
+- the old table is dropped and replaced by the `books` view
+"""
+def migrate_legacy_books(connection) -> int:
+    connection.execute(text(f"""
+        INSERT INTO works (title_key, author_key, title, author, genre)
+        SELECT {_key("b.title")}, {_key("b.author")}, TRIM(b.title), TRIM(COALESCE(b.author, '')), b.genre
+        FROM books b
+        WHERE b.id IN (SELECT MIN(id) FROM books GROUP BY {_key("title")}, {_key("author")})
+          AND NOT EXISTS (SELECT 1 FROM works w
+                          WHERE w.title_key = {_key("b.title")} AND w.author_key = {_key("b.author")})
+    """))
+    copied = connection.execute(text(f"""
+        INSERT INTO user_books (id, user_id, work_id, reading_status, genre)
+        SELECT b.id, b.user_id, w.id, b.reading_status, CASE WHEN b.genre = w.genre THEN NULL ELSE b.genre END
+        FROM books b JOIN works w ON w.title_key = {_key("b.title")} AND w.author_key = {_key("b.author")}
+    """)).rowcount
+
+    if connection.dialect.name == "postgresql":
+        # ids were copied explicitly, so the sequence has to catch up
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('user_books', 'id'), COALESCE(MAX(id), 1)) FROM user_books"
+        ))
+
+    connection.execute(text("DROP TABLE books"))
+    return copied
+
+
+"""
+gives user_books of an older catalog its per-copy genre column (NULL: the work's genre) and
+recreates the `books` view, which has to read the genre from there.
+"""
+def add_copy_genre(connection) -> None:
+    connection.execute(text("ALTER TABLE user_books ADD COLUMN genre VARCHAR(100)"))
+    # on Postgres the sharded library views depend on it; sharding.create_all() recreates them
+    cascade = " CASCADE" if connection.dialect.name == "postgresql" else ""
+    connection.execute(text(f"DROP VIEW IF EXISTS books{cascade}"))
+
+
+"""
+widens users.password of an older database to the model's length: scrypt hashes are longer than the
+old 100 characters, and a legacy hash is replaced on the next login. SQLite doesn't enforce the length.
+"""
+def widen_password_column(connection) -> bool:
+    length = User.__table__.c.password.type.length
+    column = next(column for column in inspect(connection).get_columns("users") if column["name"] == "password")
+    if connection.dialect.name == "sqlite" or (column["type"].length or length) >= length:
+        return False
+    connection.execute(text(f"ALTER TABLE users ALTER COLUMN password TYPE VARCHAR({length})"))
+    return True
+
+
+# runs after every create_all: migrates the old `books` table if it is still there, then creates the view
+@event.listens_for(db.metadata, "after_create")
+def ensure_catalog(target, connection, **kw) -> None:
+    inspector = inspect(connection)
+    if widen_password_column(connection):
+        print("Schema migration: widened users.password")
+    if "books" in inspector.get_table_names():
+        copied = migrate_legacy_books(connection)
+        print(f"Catalog migration: moved {copied} books into works/user_books")
+    if "genre" not in {column["name"] for column in inspector.get_columns("user_books")}:
+        add_copy_genre(connection)
+        print("Catalog migration: added user_books.genre")
+    inspector.clear_cache()
+    if "books" not in inspector.get_view_names():
+        connection.execute(text(BOOKS_VIEW))
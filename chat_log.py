@@ -0,0 +1,264 @@
+import json
+import os
+import queue
+import re
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import wraps
+import click
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask_login import current_user
+from disk_cache import normalize_query
+
+
+"""
+append-only log of the questions asked through /ai-chat, one compact JSON line per question:
+  ts, user_id, admin, question (normalized), branch, status, ms (latency), tokens ([prompt, completion]),
+  cache ({"sql": "hit", ...}), answer (how a SQL answer was phrased) and sql (the SQL that ran)
+lines are queued and written by a background thread, so a request never waits for the disk; when the
+queue is full the line is dropped and counted. the log is CHAT_LOG_PATH (empty disables it) and is
+rotated to <path>.1 once it grows past CHAT_LOG_MAX_BYTES.
+`flask chat-report` mines it offline, warmup.py uses it to decide what to pre-warm.
+"""
+QUEUE_SIZE = 10_000
+BATCH = 500
+_NUMBER = re.compile(r"\b\d+\b")
+_QUOTED = re.compile(r"'[^']*'")
+
+
+class ChatLog:
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024, queue_size: int = QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.queue_size = queue_size
+        self.written = 0
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    # the queue and writer thread of this process (a forked worker starts its own)
+    def _writer_queue(self) -> queue.Queue:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                threading.Thread(target=self._run, args=(self._queue,), name="chat-log", daemon=True).start()
+            return self._queue
+
+    def append(self, entry: dict) -> None:
+        try:
+            self._writer_queue().put_nowait(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    # blocks until every queued line is on disk
+    def flush(self) -> None:
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def _run(self, lines: queue.Queue) -> None:
+        while True:
+            batch = [lines.get()]
+            while len(batch) < BATCH:
+                try:
+                    batch.append(lines.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print("Chat log error:", repr(e))
+            finally:
+                for _ in batch:
+                    lines.task_done()
+
+    def _write(self, batch: list[str]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except FileNotFoundError:
+            pass
+        # one write per batch; O_APPEND keeps the lines of different workers whole
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(batch) + "\n")
+        with self._lock:
+            self.written += len(batch)
+
+    def stats(self) -> dict:
+        pending = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+        return {"path": self.path, "written": self.written, "dropped": self.dropped, "pending": pending}
+
+
+def init_app(app) -> None:
+    path = app.config.get("CHAT_LOG_PATH",
+                          os.getenv("CHAT_LOG_PATH", os.path.join(app.instance_path, "chat_log.jsonl")))
+    max_bytes = int(app.config.get("CHAT_LOG_MAX_BYTES", os.getenv("CHAT_LOG_MAX_BYTES", 50 * 1024 * 1024)))
+    app.extensions["chat_log"] = ChatLog(path, max_bytes) if path else None
+    app.cli.add_command(chat_report)
+
+
+def log() -> ChatLog | None:
+    return current_app.extensions.get("chat_log")
+
+
+# route decorator: logs the question, branch, latency and status of every chat request
+def logged(view):
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        chat_log = log()
+        question = normalize_query((request.get_json(silent=True) or {}).get("message") or "")
+        if chat_log is None or not question:
+            return view(*args, **kwargs)
+
+        entry = {"ts": round(time.time(), 3), "user_id": current_user.id, "admin": int(current_user.is_admin),
+                 "question": question, "branch": None, "status": 500, "tokens": [0, 0], "cache": {}}
+        g.chat_entry = entry
+        started = time.perf_counter()
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+            entry["status"] = response.status_code
+            return response
+        finally:
+            entry["ms"] = round((time.perf_counter() - started) * 1000, 1)
+            chat_log.append(g.pop("chat_entry"))
+
+    return decorated_function
+
+
+def _entry() -> dict | None:
+    return g.get("chat_entry") if has_request_context() else None
+
+
+# adds fields (branch, answer, sql, ...) to the log line of the current chat request, if there is one
+def note(**fields) -> None:
+    if (entry := _entry()) is not None:
+        entry.update(fields)
+
+
+def cache_status(name: str, hit: bool) -> None:
+    if (entry := _entry()) is not None:
+        entry["cache"][name] = "hit" if hit else "miss"
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int) -> None:
+    if (entry := _entry()) is not None:
+        entry["tokens"][0] += prompt_tokens or 0
+        entry["tokens"][1] += completion_tokens or 0
+
+
+# entries of the log and its rotated predecessor, oldest first; unreadable lines are skipped
+def read_entries(path: str, since: float = 0):
+    for file_path in (path + ".1", path):
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and entry.get("ts", 0) >= since:
+                    yield entry
+
+
+# "books by stephen king added in 2021" and "... in 2023" share a shape
+def shape(question: str) -> str:
+    return _NUMBER.sub("#", _QUOTED.sub("'…'", question))
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+"""
+summary of the logged questions: volume, latency, tokens and cache hit rates per branch, the most frequent
+question shapes, and what warmup.py replays: the SQL run most often and the (non-admin) users who ask most.
+"""
+def analyze(entries, top: int = 20) -> dict:
+    by_branch = defaultdict(lambda: {"count": 0, "ms": [], "tokens": 0})
+    shapes = defaultdict(lambda: {"count": 0, "branches": Counter(), "ms": [], "tokens": 0, "example": None})
+    caches = defaultdict(Counter)
+    sql_runs = Counter()
+    users = Counter()
+    total = 0
+
+    for entry in entries:
+        total += 1
+        branch = entry.get("branch") or "none"
+        tokens = sum(entry.get("tokens") or [0, 0])
+        stats = by_branch[branch]
+        stats["count"] += 1
+        stats["ms"].append(entry.get("ms", 0))
+        stats["tokens"] += tokens
+
+        question_shape = shapes[shape(entry.get("question", ""))]
+        question_shape["count"] += 1
+        question_shape["branches"][branch] += 1
+        question_shape["ms"].append(entry.get("ms", 0))
+        question_shape["tokens"] += tokens
+        question_shape["example"] = question_shape["example"] or entry.get("question")
+
+        if not entry.get("admin"):
+            users[entry.get("user_id")] += 1
+        for name, status in (entry.get("cache") or {}).items():
+            caches[name][status] += 1
+        if branch == "sql" and entry.get("sql") and entry.get("status") == 200:
+            sql_runs[(entry["sql"], entry.get("user_id"), bool(entry.get("admin")))] += 1
+
+    most_common = sorted(shapes.items(), key=lambda item: item[1]["count"], reverse=True)[:top]
+    return {
+        "questions": total,
+        "branches": {
+            branch: {"count": stats["count"], "p50_ms": round(statistics.median(stats["ms"]), 1),
+                     "p95_ms": round(_percentile(stats["ms"], 0.95), 1),
+                     "avg_tokens": round(stats["tokens"] / stats["count"], 1)}
+            for branch, stats in sorted(by_branch.items(), key=lambda item: -item[1]["count"])
+        },
+        "caches": {
+            name: {**counts, "hit_rate": round(counts["hit"] / sum(counts.values()) * 100, 1)}
+            for name, counts in caches.items()
+        },
+        "top_shapes": [
+            {"shape": question_shape, "count": stats["count"], "branch": stats["branches"].most_common(1)[0][0],
+             "p50_ms": round(statistics.median(stats["ms"]), 1), "avg_tokens": round(stats["tokens"] / stats["count"], 1),
+             "example": stats["example"]}
+            for question_shape, stats in most_common
+        ],
+        "top_sql": [{"sql": sql, "user_id": user_id, "admin": admin, "count": count}
+                    for (sql, user_id, admin), count in sql_runs.most_common(top)],
+        "top_users": [{"user_id": user_id, "count": count} for user_id, count in users.most_common(top)],
+    }
+
+
+@click.command("chat-report")
+@click.option("--top", default=20, show_default=True, help="Number of question shapes to list.")
+@click.option("--hours", default=0.0, help="Only the last N hours (default: the whole log).")
+@click.option("--path", default=None, help="Log file (default: CHAT_LOG_PATH).")
+@click.option("--as-json", is_flag=True, help="Print the report as JSON.")
+def chat_report(top, hours, path, as_json):
+    """Summarize the chat query log: branches, latency, tokens, cache hits, frequent questions."""
+    path = path or (log().path if has_app_context() and log() else None)
+    if not path:
+        raise click.ClickException("the chat log is disabled (CHAT_LOG_PATH is empty)")
+
+    report = analyze(read_entries(path, since=time.time() - hours * 3600 if hours else 0), top=top)
+    if as_json:
+        click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    click.echo(f"{report['questions']} questions")
+    for branch, stats in report["branches"].items():
+        click.echo(f"  {branch:<16} {stats['count']:>7}  p50 {stats['p50_ms']:>8}ms  p95 {stats['p95_ms']:>8}ms  "
+                   f"{stats['avg_tokens']:>7} tokens")
+    for name, stats in report["caches"].items():
+        click.echo(f"  cache {name:<10} {stats['hit_rate']:>5}% hits")
+    click.echo("most frequent questions:")
+    for stats in report["top_shapes"]:
+        click.echo(f"  {stats['count']:>7}  {stats['branch']:<16} {stats['p50_ms']:>8}ms  {stats['shape']}")
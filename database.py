@@ -0,0 +1,336 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from flask import current_app, g
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from app_factory import db
+import cancellation
+
+
+"""
+connection-pool settings per deployment profile (DB_POOL_PROFILE).
+sizes are per gunicorn worker, so the total number of connections is workers * (pool_size + max_overflow).
+"""
+POOL_PROFILES = {
+    # local development, few connections and no recycling
+    "development": {"pool_size": 5, "max_overflow": 5, "pool_timeout": 30, "pool_pre_ping": True},
+    # small managed Postgres plans with a low connection limit
+    "small": {"pool_size": 2, "max_overflow": 2, "pool_timeout": 10, "pool_recycle": 300, "pool_pre_ping": True},
+    # gunicorn sync workers in production
+    "web": {"pool_size": 5, "max_overflow": 10, "pool_timeout": 10, "pool_recycle": 1800, "pool_pre_ping": True},
+    # threaded workers or many concurrent AI requests per worker
+    "high-concurrency": {"pool_size": 10, "max_overflow": 20, "pool_timeout": 5, "pool_recycle": 1800,
+                         "pool_pre_ping": True},
+}
+
+REPLICA_BIND = "replica"
+
+# pragmas applied to every new SQLite connection in performance mode
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",          # readers no longer block on the writer
+    "synchronous": "NORMAL",        # safe with WAL, fsync only at checkpoints
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,       # negative means KiB, so 64 MiB of page cache
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,           # wait for another worker's write instead of failing with "database is locked"
+}
+
+
+# QueuePool that records how long callers waited for a connection
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._wait_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.wait_count += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+# engine options for one database URI under the given profile
+def engine_options(uri: str, profile: str) -> dict:
+    if profile not in POOL_PROFILES:
+        raise ValueError(f"Unknown DB_POOL_PROFILE {profile!r}, expected one of {sorted(POOL_PROFILES)}")
+
+    # in-memory SQLite must keep its single static connection
+    if uri.startswith("sqlite") and (":memory:" in uri or uri.rstrip("/") == "sqlite:"):
+        return {}
+
+    options = dict(POOL_PROFILES[profile])
+    if uri.startswith("sqlite"):
+        # SQLite has no server-side idle timeout, recycling only costs reconnects
+        options.pop("pool_recycle", None)
+
+    options["poolclass"] = TimedQueuePool
+    return options
+
+
+"""
+applies the pool profile and the optional read replica to the app config.
+must run before db.init_app(app); explicit SQLALCHEMY_ENGINE_OPTIONS in the config win over the profile.
+"""
+def configure_database(app) -> None:
+    profile = app.config.get("DB_POOL_PROFILE") or os.getenv("DB_POOL_PROFILE", "development")
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+
+    options = engine_options(uri, profile)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    replica_uri = app.config.get("DB_REPLICA_URI") or os.getenv("DB_REPLICA_URI")
+    if replica_uri:
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds[REPLICA_BIND] = {"url": replica_uri, **engine_options(replica_uri, profile)}
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+
+# engine used for read-only traffic: the replica when configured, the primary otherwise
+def read_engine():
+    return db.engines.get(REPLICA_BIND) or db.engine
+
+
+"""
+request-scoped session for read-only queries (dashboards, metrics, AI-generated SQL).
+without a replica this is simply db.session, so reads also see the request's own writes.
+pages cached by version (cache.conditional_page) read the primary, where their versions come from,
+so a lagging replica's page is never cached under a newer version.
+"""
+def read_session():
+    if REPLICA_BIND not in db.engines or g.get("read_primary"):
+        return db.session
+
+    if "read_session" not in g:
+        g.read_session = Session(bind=read_engine())
+    return g.read_session
+
+
+"""
+runs a read-only statement and returns its rows, interrupting it when the current request is cancelled:
+SQLite through a progress handler, Postgres by cancelling the backend query from a watcher thread.
+"""
+def execute_cancellable(session, statement) -> list:
+    token = cancellation.current()
+    if token is None:
+        return session.execute(statement).fetchall()
+
+    connection = session.connection()
+    dbapi_connection = connection.connection.dbapi_connection
+    try:
+        if connection.dialect.name == "sqlite":
+            dbapi_connection.set_progress_handler(lambda: int(token.cancelled()), 10_000)
+            try:
+                return session.execute(statement).fetchall()
+            finally:
+                dbapi_connection.set_progress_handler(None, 0)
+
+        done = threading.Event()
+
+        def watch():
+            while not done.wait(cancellation.CHECK_INTERVAL):
+                if token.cancelled():
+                    dbapi_connection.cancel()
+                    return
+
+        watcher = threading.Thread(target=watch, name="sql-cancel-watcher", daemon=True)
+        watcher.start()
+        try:
+            return session.execute(statement).fetchall()
+        finally:
+            done.set()
+    except OperationalError:
+        token.check()
+        raise
+
+
+# INSERT of the dialect of `bind` (an engine or connection), for INSERT ... ON CONFLICT upserts
+def dialect_insert(bind):
+    return postgresql.insert if bind.dialect.name == "postgresql" else sqlite.insert
+
+
+def close_read_session(exception=None) -> None:
+    session = g.pop("read_session", None)
+    if session is not None:
+        session.close()
+
+
+# checked-out connections, overflow and wait times for every engine
+def pool_metrics() -> dict:
+    metrics = {}
+    for name, engine in db.engines.items():
+        pool = engine.pool
+        stats = {"pool": type(pool).__name__}
+
+        if isinstance(pool, QueuePool):
+            stats.update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            })
+
+        if isinstance(pool, TimedQueuePool):
+            stats.update({
+                "waits": pool.wait_count,
+                "wait_avg_ms": round(pool.wait_total / pool.wait_count * 1000, 3) if pool.wait_count else 0,
+                "wait_max_ms": round(pool.wait_max * 1000, 3),
+            })
+
+        metrics[name or "primary"] = stats
+    return metrics
+
+
+def _is_enabled(value) -> bool:
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def _enable_foreign_keys(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# SQLite ignores foreign keys (and ON DELETE CASCADE) unless every connection turns them on
+def enable_sqlite_foreign_keys(app) -> None:
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == "sqlite":
+                event.listen(engine, "connect", _enable_foreign_keys)
+
+
+"""
+runs write jobs on one background thread so a worker never has two SQLite writers competing for the lock.
+jobs that arrive together are committed as one batch (one fsync); if the batch fails,
+each job is retried in its own transaction so only the failing one reports an error.
+with DB_SHARDS every shard has its own queue, so writes to different shard files don't wait for each other.
+"""
+class SQLiteWriteQueue:
+    def __init__(self, app, shard: int = 0, max_batch: int = 50, batch_window: float = 0.002):
+        self.app = app
+        self.shard = shard
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    # queues a job (a callable that writes through db.session) and returns a Future for its result
+    def submit(self, job) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((job, future))
+        return future
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"sqlite-writer-{self.shard}", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                try:
+                    results = [job() for job, _ in batch]
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    results = None
+
+                if results is not None:
+                    for (_, future), result in zip(batch, results):
+                        future.set_result(result)
+                else:
+                    for job, future in batch:
+                        try:
+                            result = job()
+                            db.session.commit()
+                            future.set_result(result)
+                        except Exception as e:
+                            db.session.rollback()
+                            future.set_exception(e)
+
+                db.session.remove()
+
+            self.batches += 1
+            self.jobs += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "shard": self.shard,
+            "pending": self._queue.qsize(),
+            "jobs": self.jobs,
+            "batches": self.batches,
+            "avg_batch": round(self.jobs / self.batches, 2) if self.batches else 0,
+        }
+
+
+"""
+SQLite production mode (SQLITE_PERFORMANCE_MODE=1): WAL and tuned pragmas on every connection,
+plus a single-writer queue per database file (the main one and each shard) for book writes.
+must run after db.init_app(app).
+"""
+def init_sqlite_mode(app) -> None:
+    enabled = app.config.get("SQLITE_PERFORMANCE_MODE", os.getenv("SQLITE_PERFORMANCE_MODE", ""))
+    if not _is_enabled(enabled) or not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == "sqlite":
+                event.listen(engine, "connect", _apply_sqlite_pragmas)
+
+    shards = 1 + len(app.config.get("DB_SHARDS") or [])
+    app.extensions["write_queues"] = [SQLiteWriteQueue(app, shard) for shard in range(shards)]
+
+
+"""
+commits a write job: through the current shard's single-writer queue in SQLite performance mode,
+otherwise directly in the request's session. returns the job's result either way.
+"""
+def run_write(job):
+    write_queues = current_app.extensions.get("write_queues")
+    if not write_queues:
+        result = job()
+        db.session.commit()
+        return result
+
+    # the writer thread runs the job on the caller's current shard, and records it in the caller's profile
+    import profiler
+    import sharding
+    return write_queues[sharding.current()].submit(profiler.bound(sharding.bound(job))).result()
@@ -0,0 +1,120 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from flask import current_app, has_app_context
+
+
+# lower-cases, drops punctuation and collapses whitespace: "Price of The Shining?" == "price of the shining"
+def normalize_query(text: str) -> str:
+    text = re.sub(r"[^\w\s']", " ", (text or "").lower())
+    return " ".join(text.split())
+
+
+"""
+persistent key-value cache in a SQLite file with a TTL per entry.
+- survives restarts and is shared by all gunicorn workers on the host (WAL + busy_timeout)
+- reads never write; when the cache grows past max_entries the entries closest to expiry are evicted
+- failures can be cached too ("negative caching") by storing them with a short TTL
+"""
+class DiskCache:
+    def __init__(self, path: str, max_entries: int = 10_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, is_error INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_expires_at ON cache_entries (expires_at)")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self._connection().execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float, is_error: bool = False) -> None:
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at, is_error) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time() + ttl, int(is_error)),
+        )
+
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.evict()
+
+    # drops expired entries, then the ones closest to expiry until the cache fits max_entries
+    def evict(self) -> None:
+        conn = self._connection()
+        conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        excess = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM cache_entries WHERE key IN "
+                "(SELECT key FROM cache_entries ORDER BY expires_at LIMIT ?)", (excess,)
+            )
+
+    def stats(self) -> dict:
+        entries, errors = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(is_error), 0) FROM cache_entries WHERE expires_at > ?", (time.time(),)
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "negative_entries": errors,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0,
+        }
+
+
+# every app gets its own web cache, at WEB_CACHE_PATH (default <instance>/web_cache.db, empty disables it)
+def init_app(app) -> None:
+    path = app.config.get("WEB_CACHE_PATH",
+                          os.getenv("WEB_CACHE_PATH", os.path.join(app.instance_path, "web_cache.db")))
+    max_entries = int(app.config.get("WEB_CACHE_MAX_ENTRIES", os.getenv("WEB_CACHE_MAX_ENTRIES", 10_000)))
+    app.extensions["web_cache"] = DiskCache(path, max_entries=max_entries) if path else None
+
+
+_web_cache = None
+_web_cache_lock = threading.Lock()
+
+
+# the app's web cache; outside an app only an explicit WEB_CACHE_PATH is used
+def web_cache() -> DiskCache | None:
+    global _web_cache
+    if has_app_context() and "web_cache" in current_app.extensions:
+        return current_app.extensions["web_cache"]
+
+    path = os.getenv("WEB_CACHE_PATH")
+    if not path:
+        return None
+    with _web_cache_lock:
+        if _web_cache is None or _web_cache.path != path:
+            _web_cache = DiskCache(path, max_entries=int(os.getenv("WEB_CACHE_MAX_ENTRIES", 10_000)))
+        return _web_cache
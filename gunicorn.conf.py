@@ -0,0 +1,41 @@
+"""
+gunicorn settings (picked up automatically from the working directory).
+
+GUNICORN_PRELOAD=1 loads the app once in the master and forks the workers from it:
+workers start faster and share the imported code, but need a reload of the master to pick up new code.
+"""
+import gc
+import os
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+# with preload_app the lazily imported modules are loaded in the master too, so every worker shares them
+def when_ready(server):
+    if preload_app:
+        import requests    # noqa: F401  (used by web search)
+        import openai      # noqa: F401  (used by the LLM provider)
+
+
+# keeps the preloaded objects out of the garbage collector, so it doesn't copy their pages into every worker
+def pre_fork(server, worker):
+    if preload_app:
+        gc.freeze()
+
+
+# connections opened in the master must not be shared with the workers
+def post_fork(server, worker):
+    if preload_app:
+        from main import app
+        from app_factory import db
+
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+# CACHE_WARMUP=1 fills every worker's in-memory caches from the chat log after it boots (see warmup.py)
+def post_worker_init(worker):
+    if os.getenv("CACHE_WARMUP", "").strip().lower() in ("1", "true", "yes", "on"):
+        import warmup
+        warmup.warm_in_background(worker.wsgi)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from flask import current_app, has_app_context
+import cancellation
+import chat_log
+import profiler
+
+
+"""
+model per task, cheapest first. the first model is used and the rest are fallbacks
+tried in order when a call fails. override with LLM_MODEL_<TASK>, e.g. LLM_MODEL_SQL_ANSWER="gpt-4o-mini,gpt-4o".
+"""
+TASK_MODELS = {
+    "sql_answer": ["gpt-4o-mini", "gpt-4o"],
+    "answer": ["gpt-4o-mini", "gpt-4o"],
+    "recommend": ["gpt-4o", "gpt-4o-mini"],
+    "web_answer": ["gpt-4o", "gpt-4o-mini"],
+    "insights": ["gpt-4o", "gpt-4o-mini"],
+    "habits": ["gpt-4o", "gpt-4o-mini"],
+}
+
+
+def _setting(name: str, default=None):
+    if has_app_context() and name in current_app.config:
+        return current_app.config[name]
+    return os.getenv(name, default)
+
+
+# stable key of one request, used to record and replay responses
+def request_key(task: str, messages: list[dict]) -> str:
+    payload = json.dumps({"task": task, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# the real thing; the OpenAI client is only created on the first call
+class OpenAIProvider:
+    name = "openai"
+
+    def __init__(self, api_key: str | None = None):
+        self.api_key = api_key
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from openai import OpenAI
+                self._client = OpenAI(api_key=self.api_key or os.getenv("OPENAI_API_KEY"))
+            return self._client
+
+    def complete(self, task: str, model: str, messages: list[dict], temperature: float,
+                 json_mode: bool = False) -> str:
+        extra = {"response_format": {"type": "json_object"}} if json_mode else {}
+        token = cancellation.current()
+        if token is None:
+            response = self.client.chat.completions.create(model=model, messages=messages,
+                                                           temperature=temperature, **extra)
+            if response.usage:
+                chat_log.record_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+            return response.choices[0].message.content or ""
+
+        # streamed, so closing the stream stops the generation as soon as the request is cancelled
+        stream = self.client.chat.completions.create(model=model, messages=messages, temperature=temperature,
+                                                     stream=True, stream_options={"include_usage": True}, **extra)
+        parts = []
+        try:
+            for chunk in stream:
+                token.check()
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                if chunk.usage:    # the last chunk, after the content
+                    chat_log.record_tokens(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+        finally:
+            stream.close()
+        return "".join(parts)
+
+
+"""
+deterministic offline provider for tests, load tests and offline development.
+serves responses recorded by RecordingProvider (a JSONL file of {"key", "task", "response"}),
+and falls back to a canned response per task. `latency_ms` simulates upstream latency.
+"""
+class FakeProvider:
+    name = "fake"
+
+    def __init__(self, replay_file: str | None = None, latency_ms: float = 0):
+        self.latency_ms = latency_ms
+        self.recorded = {}
+        self.calls = 0
+
+        if replay_file and os.path.exists(replay_file):
+            with open(replay_file, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.recorded[entry["key"]] = entry["response"]
+
+    def complete(self, task: str, model: str, messages: list[dict], temperature: float,
+                 json_mode: bool = False) -> str:
+        self.calls += 1
+        deadline = time.monotonic() + self.latency_ms / 1000
+        while (remaining := deadline - time.monotonic()) > 0:
+            cancellation.check()
+            time.sleep(min(remaining, cancellation.CHECK_INTERVAL))
+
+        key = request_key(task, messages)
+        response = self.recorded[key] if key in self.recorded else self.canned_response(task, messages)
+        # rough token counts (about 4 characters per token), so load tests see token usage
+        chat_log.record_tokens(sum(len(message["content"]) for message in messages) // 4 + 1,
+                               len(response) // 4 + 1)
+        return response
+
+    @staticmethod
+    def canned_response(task: str, messages: list[dict]) -> str:
+        user_content = messages[-1]["content"]
+
+        if task == "sql_answer":
+            match = re.search(r"CURRENT_USER_ID = (\d+)", user_content)
+            user_id = match.group(1) if match else "0"
+            sql = f"SELECT title, author, genre, reading_status FROM books WHERE user_id = {user_id};"
+            return json.dumps({
+                "sql": sql,
+                "answer_template": "Here are the {row_count} books I found:\n{rows}",
+                "row_template": "{title} by {author} ({reading_status})",
+                "empty_answer": "I couldn't find any matching books.",
+            })
+
+        return f"(offline {task} response)"
+
+
+# wraps another provider and appends every response to a JSONL file the FakeProvider can replay
+class RecordingProvider:
+    def __init__(self, provider, record_file: str):
+        self.provider = provider
+        self.name = f"recording:{provider.name}"
+        self.record_file = record_file
+        self._lock = threading.Lock()
+
+    def complete(self, task: str, model: str, messages: list[dict], temperature: float,
+                 json_mode: bool = False) -> str:
+        response = self.provider.complete(task, model, messages, temperature, json_mode=json_mode)
+        entry = {"key": request_key(task, messages), "task": task, "model": model, "response": response}
+        with self._lock, open(self.record_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return response
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+"""
+provider selected by LLM_PROVIDER ("openai" or "fake"), created once per configuration.
+LLM_REPLAY_FILE / LLM_FAKE_LATENCY_MS configure the fake provider, LLM_RECORD_FILE records real responses.
+"""
+def get_provider():
+    name = _setting("LLM_PROVIDER", "openai")
+    replay_file = _setting("LLM_REPLAY_FILE")
+    latency_ms = float(_setting("LLM_FAKE_LATENCY_MS", 0) or 0)
+    record_file = _setting("LLM_RECORD_FILE")
+    config_key = (name, replay_file, latency_ms, record_file)
+
+    with _providers_lock:
+        if config_key not in _providers:
+            if name == "openai":
+                provider = OpenAIProvider()
+            elif name == "fake":
+                provider = FakeProvider(replay_file, latency_ms)
+            else:
+                raise ValueError(f"Unknown LLM_PROVIDER {name!r}, expected 'openai' or 'fake'")
+
+            if record_file:
+                provider = RecordingProvider(provider, record_file)
+            _providers[config_key] = provider
+
+        return _providers[config_key]
+
+
+# models to try for a task: LLM_MODEL_<TASK> (comma separated) or, when that names none, the TASK_MODELS default
+def models_for(task: str) -> list[str]:
+    configured = _setting(f"LLM_MODEL_{task.upper()}") or ""
+    return [model.strip() for model in configured.split(",") if model.strip()] or TASK_MODELS[task]
+
+
+# runs one chat completion for `task`, falling back to the next model when a call fails
+def complete(task: str, messages: list[dict], temperature: float = 0, json_mode: bool = False) -> str:
+    provider = get_provider()
+    last_error = None
+
+    for model in models_for(task):
+        cancellation.check()
+        started = time.perf_counter()
+        try:
+            response = provider.complete(task, model, messages, temperature, json_mode=json_mode)
+            profiler.record_llm_call(task, model, time.perf_counter() - started, ok=True)
+            return response
+        except Exception as e:
+            profiler.record_llm_call(task, model, time.perf_counter() - started, ok=False)
+            print(f"LLM error ({task}, {model}):", repr(e))
+            last_error = e
+
+    raise last_error
@@ -0,0 +1,271 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from flask import current_app
+from app_factory import db, BookMetadata
+from database import run_write
+from disk_cache import normalize_query
+
+
+REFRESH_AFTER = 30 * 24 * 3600    # re-fetch metadata (including "nothing found") after 30 days
+
+# which metadata column answers a web-style question, by keyword (same keywords as routes.web_answers)
+ATTRIBUTE_KEYWORDS = {
+    "price": ["price", "expensive", "cheapest", "cost", "worth", "value", "how much does", "how much is"],
+    "pages": ["pages", "page count", "how many pages", "longest", "shortest"],
+    "publication_year": ["year published", "publication year", "release year", "when was", "published"],
+    "rating": ["rating", "goodreads", "amazon rating", "best rated", "highest rated"],
+    "synopsis": ["summary", "synopsis", "plot", "about"],
+}
+HIGHEST_WORDS = ("most", "highest", "expensive", "longest", "best", "newest", "latest")
+LOWEST_WORDS = ("least", "lowest", "cheapest", "shortest", "worst", "oldest", "earliest")
+# "which of my books ...", "... in our library", "the books i own": the question is about the books in scope
+LIBRARY_REFERENCE = re.compile(r"\b(my|our|these|the library'?s?)\b.*\b(books?|library|collection|titles?)\b"
+                               r"|\b(books?|titles?) (i|we) (own|have|read|am reading|are reading)\b")
+
+_lock = threading.Lock()
+counts = Counter()
+
+
+def metadata_key(title: str, author: str) -> tuple[str, str]:
+    return normalize_query(title), normalize_query(author)
+
+
+"""
+local stand-in source for tests and offline development: a JSON list of
+{"title", "author", "pages", "publication_year", "price", "rating", "synopsis"} records.
+"""
+class FileMetadataSource:
+    name = "file"
+
+    def __init__(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            records = json.load(f)
+        self.records = {metadata_key(r["title"], r.get("author", "")): r for r in records}
+
+    def fetch(self, title: str, author: str) -> dict | None:
+        return self.records.get(metadata_key(title, author))
+
+
+# looks the book up through the (cached) DuckDuckGo search and extracts what it can from the snippets
+class DuckDuckGoMetadataSource:
+    name = "duckduckgo"
+
+    def fetch(self, title: str, author: str) -> dict | None:
+        from ai_agent import duckduckgo_search
+
+        text = duckduckgo_search(f"{title} {author} book")
+        if text.startswith("(Web search failed") or text.startswith("No matching results"):
+            return None
+
+        pages = re.search(r"\b(\d{2,4})\s+pages\b", text)
+        year = re.search(r"\b(?:published|released)\b[^.]*?\b(1[5-9]\d\d|20[0-4]\d)\b", text, re.IGNORECASE)
+        return {
+            "synopsis": text.split("\n")[0],
+            "pages": int(pages.group(1)) if pages else None,
+            "publication_year": int(year.group(1)) if year else None,
+        }
+
+
+# METADATA_SOURCE: "duckduckgo" (default), "file:<path>", or "" to disable enrichment
+def get_source():
+    spec = current_app.config.get("METADATA_SOURCE", os.getenv("METADATA_SOURCE", "duckduckgo"))
+    if not spec:
+        return None
+    if spec == "duckduckgo":
+        return DuckDuckGoMetadataSource()
+    if spec.startswith("file:"):
+        return FileMetadataSource(spec[len("file:"):])
+    raise ValueError(f"Unknown METADATA_SOURCE {spec!r}")
+
+
+# fetches one book from the source and upserts its row; a row without facts records "nothing found"
+def enrich(title: str, author: str, source) -> None:
+    facts = source.fetch(title, author) or {}
+    # only the upsert goes through run_write, so the writer queue never waits for the source
+    run_write(lambda: _store(title, author, facts, source.name))
+
+
+def _store(title: str, author: str, facts: dict, source_name: str) -> None:
+    title_key, author_key = metadata_key(title, author)
+    row = db.session.execute(db.select(BookMetadata).where(BookMetadata.title_key == title_key,
+                                                           BookMetadata.author_key == author_key)).scalar()
+    if row is None:
+        row = BookMetadata(title_key=title_key, author_key=author_key, title=title, author=author)
+        db.session.add(row)
+
+    for column in ATTRIBUTE_KEYWORDS:
+        setattr(row, column, facts.get(column))
+    row.source = source_name
+    row.fetched_at = time.time()
+
+
+"""
+background worker that fills book_metadata without blocking requests.
+one per worker process; duplicate requests for the same book are skipped while it is queued.
+"""
+class EnrichmentWorker:
+    def __init__(self, app, source):
+        self.app = app
+        self.source = source
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, title: str, author: str) -> None:
+        key = metadata_key(title, author)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="metadata-enrichment", daemon=True)
+                self._thread.start()
+        self._queue.put((title, author))
+
+    def _run(self) -> None:
+        while True:
+            title, author = self._queue.get()
+            with self.app.app_context():
+                try:
+                    enrich(title, author, self.source)
+                except Exception as e:
+                    db.session.rollback()
+                    print("Metadata enrichment error:", repr(e))
+                finally:
+                    db.session.remove()
+
+            with self._lock:
+                self._pending.discard(metadata_key(title, author))
+            self._queue.task_done()
+
+    def join(self) -> None:
+        self._queue.join()
+
+
+# queues a book for enrichment unless its metadata is fresh or enrichment is disabled
+def enrich_later(title: str, author: str) -> None:
+    worker = current_app.extensions.get("metadata_worker")
+    if worker is None:
+        return
+
+    title_key, author_key = metadata_key(title, author)
+    fetched_at = db.session.execute(db.select(BookMetadata.fetched_at).where(
+        BookMetadata.title_key == title_key, BookMetadata.author_key == author_key)).scalar()
+    if fetched_at is None or fetched_at < time.time() - REFRESH_AFTER:
+        worker.enqueue(title, author)
+
+
+def init_app(app) -> None:
+    with app.app_context():
+        source = get_source()
+    if source is not None:
+        app.extensions["metadata_worker"] = EnrichmentWorker(app, source)
+
+
+def _attribute_for(question: str) -> str | None:
+    for attribute, keywords in ATTRIBUTE_KEYWORDS.items():
+        if any(keyword in question for keyword in keywords):
+            return attribute
+    return None
+
+
+def _describe(attribute: str, row: BookMetadata) -> str:
+    if attribute == "pages":
+        return f"{row.title} has {row.pages} pages."
+    if attribute == "publication_year":
+        return f"{row.title} was first published in {row.publication_year}."
+    if attribute == "price":
+        return f"{row.title} usually costs around ${row.price:.2f} (prices vary by edition and seller)."
+    if attribute == "rating":
+        return f"{row.title} has an average rating of {row.rating:g}/5."
+    return f"{row.title}: {row.synopsis}"
+
+
+def _names(title: str, text: str) -> bool:
+    return bool(title) and re.search(rf"\b{re.escape(title)}\b", text) is not None
+
+
+"""
+the books whose whole title appears in the (normalized) question. a title that only appears as part of
+a longer matching title ("dune" in "dune messiah") doesn't count; None when a named title belongs to
+several different books, which the question can't tell apart.
+"""
+def _named_books(normalized: str, user_books: list[dict]) -> list[dict] | None:
+    titles = {normalize_query(book["title"]) for book in user_books}
+    named = {title for title in titles if _names(title, normalized)}
+    named = {title for title in named if not any(other != title and _names(title, other) for other in named)}
+
+    books = [book for book in user_books if normalize_query(book["title"]) in named]
+    authors = {}
+    for book in books:
+        authors.setdefault(normalize_query(book["title"]), set()).add(normalize_query(book.get("author", "")))
+    if any(len(names) > 1 for names in authors.values()):
+        return None
+    return books
+
+
+"""
+answers a web-style question from book_metadata when every book it needs has that fact.
+returns None on a miss (and queues the missing books for enrichment), so the caller falls back to the web.
+"""
+def answer_from_metadata(question: str, user_books: list[dict]) -> str | None:
+    normalized = normalize_query(question)
+    attribute = _attribute_for(question.lower())
+    if attribute is None or not user_books:
+        return None
+
+    words = normalized.split()
+    wants_highest = any(word in words for word in HIGHEST_WORDS)
+    wants_lowest = any(word in words for word in LOWEST_WORDS)
+
+    # books named in the question; every book in scope only for a superlative over the library
+    # ("which of my books is the longest?"), anything else is about a book we don't hold and goes to the web
+    books = _named_books(normalized, user_books)
+    if books is None:
+        return None
+    if not books:
+        if attribute == "synopsis" or not (wants_highest or wants_lowest) or not LIBRARY_REFERENCE.search(normalized):
+            return None
+        books = user_books
+    keys = {metadata_key(book["title"], book.get("author", "")) for book in books}
+
+    rows = db.session.execute(db.select(BookMetadata).where(
+        BookMetadata.title_key.in_({title for title, _ in keys}))).scalars().all()
+    found = {(row.title_key, row.author_key): row for row in rows
+             if (row.title_key, row.author_key) in keys and getattr(row, attribute) is not None}
+
+    missing = [book for book in books if metadata_key(book["title"], book.get("author", "")) not in found]
+    if missing:
+        with _lock:
+            counts["misses"] += 1
+        for book in missing:
+            enrich_later(book["title"], book.get("author", ""))
+        return None
+
+    with _lock:
+        counts["hits"] += 1
+
+    rows = sorted(found.values(), key=lambda row: row.title)
+    if len(rows) > 1 and attribute != "synopsis" and (wants_highest or wants_lowest):
+        pick = max if wants_highest else min
+        best = pick(rows, key=lambda row: getattr(row, attribute))
+        return f"Of these books, {_describe(attribute, best)}"
+
+    return "\n".join(_describe(attribute, row) for row in rows)
+
+
+def stats() -> dict:
+    with _lock:
+        lookups = counts["hits"] + counts["misses"]
+        return {
+            "hits": counts["hits"],
+            "misses": counts["misses"],
+            "coverage_rate": round(counts["hits"] / lookups * 100, 1) if lookups else 0,
+            "rows": db.session.scalar(db.select(db.func.count(BookMetadata.id))),
+        }
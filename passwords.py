@@ -0,0 +1,103 @@
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, has_app_context
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+"""
+password hashing policy (Werkzeug method strings):
+- PASSWORD_HASH_METHOD, e.g. "scrypt:16384:8:1" or "pbkdf2:sha256:100000"
+- PASSWORD_SALT_LENGTH, salt characters per hash
+- PASSWORD_HASH_WORKERS, how many hashes one worker process may compute at the same time
+
+the default keeps one verification under ~100 ms on small instances;
+run benchmarks/password_hashing.py to pick a method for a different budget.
+"""
+DEFAULT_METHOD = "scrypt:16384:8:1"
+DEFAULT_SALT_LENGTH = 16
+DEFAULT_WORKERS = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _setting(name: str, default):
+    if has_app_context() and name in current_app.config:
+        return current_app.config[name]
+    return os.getenv(name, default)
+
+
+def hash_method() -> str:
+    return _setting("PASSWORD_HASH_METHOD", DEFAULT_METHOD)
+
+
+def salt_length() -> int:
+    return int(_setting("PASSWORD_SALT_LENGTH", DEFAULT_SALT_LENGTH))
+
+
+# hashing is CPU-bound (hashlib releases the GIL), so a small pool caps how many cores logins can take
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(_setting("PASSWORD_HASH_WORKERS", DEFAULT_WORKERS))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        return _executor
+
+
+# hashes a password with the current policy
+def hash_password(password: str) -> str:
+    return _pool().submit(generate_password_hash, password, method=hash_method(),
+                          salt_length=salt_length()).result()
+
+
+# checks a password against a stored hash of any supported method
+def verify_password(stored_hash: str, password: str) -> bool:
+    return _pool().submit(check_password_hash, stored_hash, password).result()
+
+
+# True when a stored hash was made with another method or salt length than the current policy
+def needs_rehash(stored_hash: str) -> bool:
+    parts = (stored_hash or "").split("$")
+    if len(parts) != 3:
+        return True
+
+    method, salt, _ = parts
+    return method != hash_method() or len(salt) != salt_length()
+
+
+# median time in ms to verify one password hashed with `method`
+def time_method(method: str, rounds: int = 3) -> float:
+    hashed = generate_password_hash("benchmark-password", method=method, salt_length=DEFAULT_SALT_LENGTH)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        check_password_hash(hashed, "benchmark-password")
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+"""
+returns the strongest method whose verification fits into target_ms on this machine.
+scrypt doubles its work factor per step; pbkdf2 scales iterations linearly from one measurement.
+"""
+def calibrate(target_ms: float, algorithm: str = "scrypt") -> str:
+    if algorithm == "pbkdf2":
+        sample = 50_000
+        per_iteration = time_method(f"pbkdf2:sha256:{sample}") / sample
+        iterations = max(10_000, int(target_ms / per_iteration) // 10_000 * 10_000)
+        return f"pbkdf2:sha256:{iterations}"
+
+    if algorithm != "scrypt":
+        raise ValueError(f"Unsupported algorithm {algorithm!r}, expected 'scrypt' or 'pbkdf2'")
+
+    best = "scrypt:4096:8:1"
+    for exponent in range(12, 18):
+        method = f"scrypt:{2 ** exponent}:8:1"
+        if time_method(method) > target_ms:
+            break
+        best = method
+    return best
@@ -0,0 +1,266 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from flask import current_app, g, request
+from flask_login import current_user
+from sqlalchemy import event
+from app_factory import db
+
+
+"""
+on-demand profiling of single requests, for admins.
+add `?profile=1` (or the header `X-Profile: 1`) to any URL to sample the request's stacks every few ms,
+or `profile=cprofile` to run it under cProfile. each capture is stored in PROFILE_DIR:
+- <id>.json      the request, its SQL statements with timings and its LLM calls with timings
+- <id>.folded    collapsed stacks (flamegraph.pl / speedscope input), or <id>.prof for cProfile
+requests without the flag pay nothing: the SQL listeners only exist while a capture is running.
+"""
+SAMPLE_INTERVAL = 0.005
+MAX_STATEMENTS = 500
+
+_local = threading.local()
+_listeners_lock = threading.Lock()
+_running = 0
+
+
+def _profile_dir() -> str:
+    return current_app.config.get("PROFILE_DIR") or os.getenv(
+        "PROFILE_DIR", os.path.join(current_app.instance_path, "profiles"))
+
+
+def _keep() -> int:
+    return int(current_app.config.get("PROFILE_KEEP", os.getenv("PROFILE_KEEP", 50)))
+
+
+# samples the stack of one thread and counts identical stacks
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Capture:
+    def __init__(self, mode: str):
+        self.id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.statements = []
+        self.llm_calls = []
+        if mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = StackSampler(threading.get_ident())
+            self.profiler.start()
+
+    def finish(self, status_code: int) -> dict:
+        duration = time.perf_counter() - self.started
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            stats_text = io.StringIO()
+            pstats.Stats(self.profiler, stream=stats_text).sort_stats("cumulative").print_stats(40)
+            profile = {"extension": "prof", "summary": stats_text.getvalue()}
+        else:
+            profile = {"extension": "folded", "data": self.profiler.stop()}
+
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": status_code,
+            "user": current_user.email,
+            "created_at": time.time(),
+            "duration_ms": round(duration * 1000, 1),
+            "sql_ms": round(sum(s["ms"] for s in self.statements), 1),
+            "llm_ms": round(sum(c["ms"] for c in self.llm_calls), 1),
+            "statements": self.statements,
+            "llm_calls": self.llm_calls,
+            "profile": profile,
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, "capture", None) is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    capture = getattr(_local, "capture", None)
+    started = conn.info.get("profile_started")
+    if capture is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if len(capture.statements) < MAX_STATEMENTS:
+        capture.statements.append({"sql": statement, "ms": round(elapsed * 1000, 3)})
+
+
+# SQL listeners are attached while at least one capture is running, and removed after the last one
+def _attach_listeners(app, delta: int) -> None:
+    global _running
+    with _listeners_lock:
+        before, _running = _running, _running + delta
+        if (before == 0) == (_running == 0):
+            return
+        change = event.listen if _running else event.remove
+        with app.app_context():
+            for engine in db.engines.values():
+                change(engine, "before_cursor_execute", _before_cursor_execute)
+                change(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# called by llm.complete for every model call; a no-op unless the current thread is being profiled
+# (or runs a write job of a profiled request, see bound)
+def record_llm_call(task: str, model: str, seconds: float, ok: bool) -> None:
+    capture = getattr(_local, "capture", None)
+    if capture is not None:
+        capture.llm_calls.append({"task": task, "model": model, "ms": round(seconds * 1000, 1), "ok": ok})
+
+
+# the job with the current thread's capture, for running it on another thread (the SQLite write queue)
+def bound(job):
+    capture = getattr(_local, "capture", None)
+    if capture is None:
+        return job
+
+    def run():
+        previous, _local.capture = getattr(_local, "capture", None), capture
+        try:
+            return job()
+        finally:
+            _local.capture = previous
+
+    return run
+
+
+def _requested_mode() -> str | None:
+    flag = request.args.get("profile") or request.headers.get("X-Profile")
+    if not flag or not current_user.is_authenticated or not current_user.is_admin:
+        return None
+    return "cprofile" if flag == "cprofile" else "sample"
+
+
+def _start() -> None:
+    if "profile" not in request.args and "X-Profile" not in request.headers:
+        return
+    mode = _requested_mode()
+    if mode is None or (request.endpoint or "").startswith("blueprint.admin_profile"):
+        return
+
+    _attach_listeners(current_app._get_current_object(), +1)
+    _local.capture = Capture(mode)
+    g.profiling = True    # page caches are bypassed, so the capture shows the real work
+
+
+def _finish(response):
+    capture = getattr(_local, "capture", None)
+    if capture is None:
+        return response
+
+    _local.capture = None
+    _attach_listeners(current_app._get_current_object(), -1)
+    try:
+        save(capture.finish(response.status_code), capture)
+        response.headers["X-Profile-Id"] = capture.id
+    except Exception as e:
+        print("Profile error:", repr(e))
+    return response
+
+
+# makes sure a capture doesn't outlive a request that failed before after_request
+def _cleanup(exception=None) -> None:
+    if getattr(_local, "capture", None) is not None:
+        capture, _local.capture = _local.capture, None
+        _attach_listeners(current_app._get_current_object(), -1)
+        if capture.mode == "cprofile":
+            capture.profiler.disable()
+        else:
+            capture.profiler.stop()
+
+
+def save(record: dict, capture: Capture) -> None:
+    directory = _profile_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    profile = record.pop("profile")
+    record["profile_file"] = f"{record['id']}.{profile['extension']}"
+    if profile["extension"] == "prof":
+        capture.profiler.dump_stats(os.path.join(directory, record["profile_file"]))
+        record["summary"] = profile["summary"]
+    else:
+        with open(os.path.join(directory, record["profile_file"]), "w", encoding="utf-8") as f:
+            f.write(profile["data"])
+        record["top_stacks"] = profile["data"].splitlines()[:15]
+
+    with open(os.path.join(directory, f"{record['id']}.json"), "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False)
+
+    # only the most recent captures are kept
+    captures = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    for name in captures[:-_keep()]:
+        for extension in (".json", ".folded", ".prof"):
+            try:
+                os.unlink(os.path.join(directory, name[:-len(".json")] + extension))
+            except OSError:
+                pass
+
+
+# the stored captures, newest first
+def list_captures() -> list[dict]:
+    directory = _profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    captures = []
+    for name in sorted((n for n in os.listdir(directory) if n.endswith(".json")), reverse=True):
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            captures.append(json.load(f))
+    return captures
+
+
+def load_capture(capture_id: str) -> dict | None:
+    if not capture_id.replace("-", "").isalnum():
+        return None
+    path = os.path.join(_profile_dir(), f"{capture_id}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def profile_path(record: dict) -> str:
+    return os.path.join(_profile_dir(), record["profile_file"])
+
+
+def init_app(app) -> None:
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_cleanup)
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import math
+import time
+from collections import Counter, defaultdict
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from app_factory import db, Books, Work, ReaderProfile, book_genre, catalog_key
+from database import read_session, run_write
+import sharding
+
+
+"""
+reader profiles: a fixed-size picture of every reader for the AI features and the insights page.
+the full status/genre/author counts are stored so that book writes adjust them in place, and the
+derived values (completion rate, diversity, feature vector, newest books) are refreshed with them.
+what `get()` hands out is bounded (top genres/authors, RECENT_BOOKS books), so prompts stay the same
+size however large a library grows, and reading a profile is one primary-key lookup.
+a profile is built from the user's books the first time it is needed and then follows every write;
+the functions that update it write through db.session and are meant to run inside the book write job.
+"""
+TOP = 5
+RECENT_BOOKS = 15
+FEATURE_BUCKETS = 16
+COMPLETED = "Completed"
+
+
+# 0 when everything is in one category, 1 when books are spread evenly (normalized Shannon entropy)
+def diversity(counts: dict) -> float:
+    values = [count for count in counts.values() if count > 0]
+    total = sum(values)
+    if len(values) < 2:
+        return 0.0
+    entropy = -sum(count / total * math.log(count / total) for count in values)
+    return round(entropy / math.log(len(values)), 4)
+
+
+"""
+compact vector for comparing readers: the genre shares hashed into FEATURE_BUCKETS buckets,
+then completion rate, genre and author diversity and the library size (log-scaled to 0..1).
+"""
+def feature_vector(total: int, completion_rate: float, genres: dict, genre_diversity: float,
+                   author_diversity: float) -> list[float]:
+    buckets = [0.0] * FEATURE_BUCKETS
+    for genre, count in genres.items():
+        bucket = int.from_bytes(hashlib.blake2b(genre.lower().encode("utf-8"), digest_size=4).digest(), "big")
+        buckets[bucket % FEATURE_BUCKETS] += count / total
+    size = min(1.0, math.log1p(total) / math.log1p(1000))
+    return [round(value, 4) for value in [*buckets, completion_rate, genre_diversity, author_diversity, size]]
+
+
+def _entry(book: Books) -> dict:
+    return {"id": book.id, "title": book.title, "author": book.author, "genre": book.genre,
+            "reading_status": book.reading_status}
+
+
+def _newest_books(user_id: int, exclude: set[int] = frozenset()) -> list[dict]:
+    books = db.session.scalars(select(Books).where(Books.user_id == user_id, Books.id.not_in(exclude))
+                               .order_by(Books.id.desc()).limit(RECENT_BOOKS)).all()
+    return [_entry(book) for book in books]
+
+
+def _store(profile: ReaderProfile, statuses: Counter, genres: Counter, authors: Counter, recent: list[dict]) -> None:
+    statuses, genres, authors = (+statuses, +genres, +authors)    # unary + drops counts that reached zero
+    total = sum(statuses.values())
+    completion_rate = statuses[COMPLETED] / total if total else 0.0
+    profile.total_books = total
+    profile.status_counts = json.dumps(statuses, ensure_ascii=False)
+    profile.genre_counts = json.dumps(genres, ensure_ascii=False)
+    profile.author_counts = json.dumps(authors, ensure_ascii=False)
+    profile.recent_books = json.dumps(recent[:RECENT_BOOKS], ensure_ascii=False)
+    profile.completion_rate = round(completion_rate, 4)
+    profile.genre_diversity = diversity(genres)
+    profile.author_diversity = diversity(authors)
+    profile.features = json.dumps(feature_vector(total, completion_rate, genres, profile.genre_diversity,
+                                                 profile.author_diversity) if total else [])
+    profile.updated_at = time.time()
+
+
+# builds (or rebuilds) a profile from the user's books
+def rebuild(user_id: int) -> ReaderProfile:
+    statuses, genres, authors = Counter(), Counter(), Counter()
+    rows = db.session.execute(
+        select(Books.reading_status, book_genre(), Work.author, func.count(Books.id)).join(Work)
+        .where(Books.user_id == user_id).group_by(Books.reading_status, book_genre(), Work.author)
+    )
+    for status, genre, author, count in rows:
+        statuses[status] += count
+        genres[genre] += count
+        authors[author] += count
+
+    profile = db.session.get(ReaderProfile, user_id)
+    if profile is None:
+        profile = ReaderProfile(user_id=user_id)
+        try:
+            with db.session.begin_nested():
+                _store(profile, statuses, genres, authors, _newest_books(user_id))
+                db.session.add(profile)
+            return profile
+        except IntegrityError:
+            # built by another request in the meantime
+            profile = db.session.get(ReaderProfile, user_id)
+    _store(profile, statuses, genres, authors, _newest_books(user_id))
+    return profile
+
+
+# applies count deltas and book list changes to one user's profile
+def _update(user_id: int, deltas: dict[str, Counter], added: list[dict] = (), changed: dict[int, dict] = None,
+            removed: set[int] = frozenset()) -> None:
+    profile = db.session.scalar(select(ReaderProfile).where(ReaderProfile.user_id == user_id).with_for_update())
+    if profile is None:
+        if not removed:
+            rebuild(user_id)    # the tables already include this change
+        return
+
+    statuses = Counter(json.loads(profile.status_counts))
+    genres = Counter(json.loads(profile.genre_counts))
+    authors = Counter(json.loads(profile.author_counts))
+    statuses.update(deltas["statuses"])
+    genres.update(deltas["genres"])
+    authors.update(deltas["authors"])
+
+    changed = changed or {}
+    recent = [changed.get(entry["id"], entry) for entry in json.loads(profile.recent_books)
+              if entry["id"] not in removed]
+    recent = [*reversed(added), *recent]
+    if len(recent) < min(RECENT_BOOKS, sum((+statuses).values())):
+        recent = _newest_books(user_id, exclude=removed)
+    _store(profile, statuses, genres, authors, recent)
+
+
+def _deltas() -> dict[str, Counter]:
+    return {"statuses": Counter(), "genres": Counter(), "authors": Counter()}
+
+
+# new books; they must be flushed so they have ids
+def books_added(books: list[Books]) -> None:
+    per_user = defaultdict(list)
+    for book in books:
+        per_user[book.user_id].append(book)
+
+    for user_id, user_books in per_user.items():
+        deltas = _deltas()
+        for book in user_books:
+            deltas["statuses"][book.reading_status] += 1
+            deltas["genres"][book.genre] += 1
+            deltas["authors"][book.author] += 1
+        _update(user_id, deltas, added=[_entry(book) for book in user_books])
+
+
+# edits as (sketches.book_values() before the edit, edited book) pairs
+def books_changed(changes: list[tuple[dict, Books]]) -> None:
+    per_user = defaultdict(list)
+    for old_values, book in changes:
+        per_user[book.user_id].append((old_values, book))
+
+    for user_id, user_changes in per_user.items():
+        deltas = _deltas()
+        for old_values, book in user_changes:
+            for name, old, new in (("statuses", old_values["statuses"], book.reading_status),
+                                   ("genres", old_values["genres"], book.genre),
+                                   ("authors", old_values["authors"], book.author)):
+                deltas[name][old] -= 1
+                deltas[name][new] += 1
+        _update(user_id, deltas, changed={book.id: _entry(book) for _, book in user_changes})
+
+
+# removes every book matching `where` (a condition on Books); call it before the DELETE
+def books_deleted(where) -> None:
+    rows = db.session.execute(select(Books.user_id, Books.id, Books.reading_status, book_genre().label("genre"),
+                                     Work.author).join(Work).where(where)).all()
+    per_user = defaultdict(list)
+    for row in rows:
+        per_user[row.user_id].append(row)
+
+    for user_id, user_rows in per_user.items():
+        deltas = _deltas()
+        for row in user_rows:
+            deltas["statuses"][row.reading_status] -= 1
+            deltas["genres"][row.genre] -= 1
+            deltas["authors"][row.author] -= 1
+        _update(user_id, deltas, removed={row.id for row in user_rows})
+
+
+def export(profile: ReaderProfile) -> dict:
+    statuses = Counter(json.loads(profile.status_counts))
+    return {
+        "total_books": profile.total_books,
+        "completed": statuses[COMPLETED],
+        "reading": profile.total_books - statuses[COMPLETED],
+        "completion_rate": round(profile.completion_rate * 100, 1),
+        "top_genres": Counter(json.loads(profile.genre_counts)).most_common(TOP),
+        "top_authors": Counter(json.loads(profile.author_counts)).most_common(TOP),
+        "genre_diversity": profile.genre_diversity,
+        "author_diversity": profile.author_diversity,
+        "recent_books": json.loads(profile.recent_books),
+        "features": json.loads(profile.features),
+    }
+
+
+# the user's profile as a dict of fixed size, built on first use
+def get(user_id: int) -> dict:
+    with sharding.use_user(user_id):
+        profile = read_session().get(ReaderProfile, user_id)
+        if profile is None:
+            return run_write(lambda: export(rebuild(user_id)))
+        return export(profile)
+
+
+# which of `titles` the user already owns: one lookup per title on the works catalog key
+def owned_titles(user_id: int, titles: set[str]) -> set[str]:
+    by_key = {catalog_key(title): title for title in titles}
+    if not by_key:
+        return set()
+    with sharding.use_user(user_id):
+        keys = read_session().scalars(select(Work.title_key).join(Books).where(
+            Books.user_id == user_id, Work.title_key.in_(by_key)))
+        return {by_key[key] for key in keys}
+
+
+# the profile without the feature vector, which means nothing to a language model
+def for_prompt(profile: dict) -> dict:
+    return {key: value for key, value in profile.items() if key != "features"}
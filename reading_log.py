@@ -0,0 +1,162 @@
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, insert, literal, select
+from app_factory import db, User, Books, ReadingEvent, ReadingRollup
+from database import dialect_insert, read_session
+import sharding
+
+
+"""
+reading history: every add, status change and delete is appended to reading_events,
+and the matching day/week/month rows of reading_rollups are incremented in the same transaction.
+trend metrics read the rollups, so they cost O(periods) no matter how large the library is.
+`completed` counts books, not re-reads: a book counts when it first reaches Completed (also when it is
+added as Completed), and going back to Reading and finishing it again doesn't count it a second time.
+all functions here write through db.session and are meant to run inside the book write job.
+"""
+PERIODS = ("day", "week", "month")
+COMPLETED = "Completed"
+
+
+# start date (UTC) of the day, week (Monday) and month containing `at`
+def period_starts(at: float) -> dict:
+    day = datetime.fromtimestamp(at, timezone.utc).date()
+    return {
+        "day": day.isoformat(),
+        "week": (day - timedelta(days=day.weekday())).isoformat(),
+        "month": day.replace(day=1).isoformat(),
+    }
+
+
+# one upsert for all periods, so two transactions opening the same period at once both count instead of one failing
+def _bump_rollups(user_id: int, at: float, **counts) -> None:
+    statement = dialect_insert(db.session.get_bind(ReadingRollup))(ReadingRollup).values(
+        [{"period": period, "period_start": period_start, "user_id": user_id, **counts}
+         for period, period_start in period_starts(at).items()])
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[ReadingRollup.period, ReadingRollup.period_start, ReadingRollup.user_id],
+        set_={column: getattr(ReadingRollup, column) + amount for column, amount in counts.items()},
+    ))
+
+
+# logs a new book; the book must be flushed so it has an id
+def book_added(book: Books) -> None:
+    books_added([book])
+
+
+# logs new books with one rollup bump per owner
+def books_added(books: list[Books]) -> None:
+    at = time.time()
+    db.session.add_all(ReadingEvent(user_id=book.user_id, book_id=book.id, work_id=book.work_id, event_type="added",
+                                    new_status=book.reading_status, created_at=at) for book in books)
+    completed = Counter(book.user_id for book in books if book.reading_status == COMPLETED)
+    for user_id, count in Counter(book.user_id for book in books).items():
+        _bump_rollups(user_id, at, added=count, **({"completed": completed[user_id]} if completed[user_id] else {}))
+
+
+# logs a status change; completing a book for the first time also records how long it took since it was added
+def status_changed(book: Books, old_status: str) -> None:
+    if old_status == book.reading_status:
+        return
+
+    first_completion = False
+    if book.reading_status == COMPLETED:
+        added_at, completions = db.session.execute(select(
+            func.min(ReadingEvent.created_at).filter(ReadingEvent.event_type == "added"),
+            func.count(ReadingEvent.id).filter(ReadingEvent.new_status == COMPLETED),
+        ).where(ReadingEvent.book_id == book.id)).one()
+        first_completion = not completions
+
+    at = time.time()
+    db.session.add(ReadingEvent(user_id=book.user_id, book_id=book.id, work_id=book.work_id,
+                                event_type="status_changed", old_status=old_status,
+                                new_status=book.reading_status, created_at=at))
+
+    counts = {"status_changes": 1}
+    if first_completion:
+        counts["completed"] = 1
+        if added_at is not None:
+            counts["completion_seconds"] = at - added_at
+            counts["timed_completions"] = 1
+    _bump_rollups(book.user_id, at, **counts)
+
+
+# logs the deletion of every book matching `where` (a condition on Books); call it before the DELETE
+def books_deleted(where) -> None:
+    at = time.time()
+    db.session.execute(insert(ReadingEvent).from_select(
+        ["user_id", "book_id", "work_id", "event_type", "old_status", "created_at"],
+        select(Books.user_id, Books.id, Books.work_id, literal("deleted"), Books.reading_status, literal(at))
+        .where(where),
+    ))
+
+    per_user = db.session.execute(select(Books.user_id, func.count(Books.id)).where(where)
+                                  .group_by(Books.user_id)).all()
+    for user_id, count in per_user:
+        _bump_rollups(user_id, at, deleted=count)
+
+
+def _rollups(period: str, user_id: int | None):
+    query = select(ReadingRollup.period_start).where(ReadingRollup.period == period)
+    if user_id is not None:
+        return query.where(ReadingRollup.user_id == user_id)
+    # library-wide trends leave admin accounts out, like the other library metrics
+    admins = select(User.id).where(User.is_admin == True)
+    return query.where(ReadingRollup.user_id.not_in(admins))
+
+
+# rows of a rollup query: the user's shard for one user, every shard (in parallel) for the whole library
+def _rows(query, user_id: int | None) -> list:
+    if user_id is not None:
+        return read_session().execute(query).all()
+    return [row for rows in sharding.gather(lambda session: session.execute(query).all()) for row in rows]
+
+
+# [("YYYY-MM", books completed)] for the last `months` months with any activity, oldest first
+def completed_per_month(user_id: int | None = None, months: int = 12) -> list[tuple[str, int]]:
+    completed = Counter()
+    for period_start, count in _rows(
+            _rollups("month", user_id).add_columns(func.sum(ReadingRollup.completed))
+            .group_by(ReadingRollup.period_start).order_by(ReadingRollup.period_start.desc()).limit(months),
+            user_id):
+        completed[period_start] += int(count or 0)
+    return [(period_start[:7], completed[period_start]) for period_start in sorted(completed)[-months:]]
+
+
+# average days from adding a book to completing it, None until a completion has been timed
+def average_days_to_complete(user_id: int | None = None) -> float | None:
+    rows = _rows(_rollups("month", user_id).with_only_columns(func.sum(ReadingRollup.completion_seconds),
+                                                              func.sum(ReadingRollup.timed_completions)), user_id)
+    seconds = sum(row[0] or 0 for row in rows)
+    count = sum(row[1] or 0 for row in rows)
+    if not count:
+        return None
+    return round(seconds / count / 86400, 1)
+
+
+# [(week start, users with any add/status change/delete that week)] for the last `weeks` active weeks;
+# a user's rollups are all on one shard, so the per-shard reader counts add up
+def active_readers(weeks: int = 8) -> list[tuple[str, int]]:
+    readers = Counter()
+    for period_start, count in _rows(
+            _rollups("week", None).add_columns(func.count(ReadingRollup.user_id.distinct()))
+            .group_by(ReadingRollup.period_start).order_by(ReadingRollup.period_start.desc()).limit(weeks),
+            None):
+        readers[period_start] += int(count)
+    return [(period_start, readers[period_start]) for period_start in sorted(readers)[-weeks:]]
+
+
+def user_trends(user_id: int) -> dict:
+    return {
+        "completed_per_month": completed_per_month(user_id),
+        "avg_days_to_complete": average_days_to_complete(user_id),
+    }
+
+
+def library_trends() -> dict:
+    return {
+        "completed_per_month": completed_per_month(),
+        "avg_days_to_complete": average_days_to_complete(),
+        "active_readers_per_week": active_readers(),
+    }
@@ -1,13 +1,33 @@
+import heapq
 import os
 from collections import Counter
 from functools import wraps
-from flask import Blueprint, abort, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, current_app, abort, render_template, redirect, url_for, flash, request, jsonify, send_file
 from flask_login import login_user, current_user, logout_user, login_required
-from sqlalchemy import func, text    # `text()` is used to execute raw SQL safely via SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from forms import RegisterForm, LoginForm, AddBooks, EditUser
-from ai_agent import ai_to_sql, generate_natural_answer, recommend_books, answers_from_web, insights_summary, analyze_reading_habits
-from app_factory import db, User, Books, login_manager
+from ai_agent import ai_to_sql_with_answer, fill_answer_template, generate_natural_answer, recommend_books, drop_owned_recommendations, answers_from_web, insights_summary, analyze_reading_habits
+from app_factory import db, User, Books, Work, login_manager, book_genre
+import singleflight
+from disk_cache import web_cache
+import answers
+import metadata
+import reading_log
+import sketches
+import admission
+import cache_bus
+import sql_cache
+import profiles
+import profiler
+import chat_log
+import sharding
+from admission import admission_controlled
+from cancellation import cancellable
+import cancellation
+from passwords import hash_password, verify_password, needs_rehash
+from database import read_session, pool_metrics, run_write
+from cache import conditional_page, touch_user, bump_versions, user_scope, LIBRARY_SCOPE
 import re
 
 
@@ -29,73 +49,105 @@ def web_answers(user_text: str) -> bool:
     return any(word in lower_user_text for word in keywords)
 
 
-# computes summary metrics for one specific user
+# computes summary metrics for one specific user, cached per worker until the user's data changes
 def compute_user_metrics(user_id: int) -> dict:
     if user_id is None:
         raise ValueError("user_id must not be None")
 
-    user = User.query.get_or_404(user_id)
-    books = Books.query.filter_by(user_id=user_id).all()
+    with sharding.use_user(user_id):
+        return cache_bus.cached(("user-metrics", user_id), [user_scope(user_id)], lambda: _user_metrics(user_id))
 
-    statuses = Counter([book.reading_status for book in books])
-    genres = Counter([book.genre for book in books])
-    authors = Counter([book.author for book in books])
 
-    total = len(books)
-    completed = statuses.get("Completed", 0)
-    reading = statuses.get("Reading", 0)
-    completion_rate = (completed/total) if total else 0
+def _user_metrics(user_id: int) -> dict:
+    user = read_session().get(User, user_id)
+    if user is None:
+        abort(404)
+    profile = profiles.get(user_id)
 
     return {
         "scope": "user",
         "user": {"id": user.id, "name": user.name, "email": user.email},
-        "totals": {"books": total, "completed": completed, "reading": reading},
-        "completion_rate": round(completion_rate * 100, 1),
-        "top_genres": genres.most_common(5),
-        "top_authors": authors.most_common(5),
+        "totals": {"books": profile["total_books"], "completed": profile["completed"], "reading": profile["reading"]},
+        "completion_rate": profile["completion_rate"],
+        "top_genres": profile["top_genres"],
+        "top_authors": profile["top_authors"],
+        "diversity": {"genres": profile["genre_diversity"], "authors": profile["author_diversity"]},
+        "trends": reading_log.user_trends(user_id),
     }
 
 
-# computes metrics for the entire library (excluding admin accounts)
-def compute_library_metrics() -> dict:
-    total_users = db.session.query(User).filter(User.is_admin == False).count()
-    total_books = (
-        db.session.query(Books).join(User, Books.user_id == User.id)
-        .filter(User.is_admin == False).count()
-    )
+# computes metrics for the entire library (excluding admin accounts), cached per worker like the user metrics;
+# approximate=True reads the sketches instead
+def compute_library_metrics(approximate: bool = False) -> dict:
+    if approximate:
+        metrics = sketches.library_metrics()
+        metrics["trends"] = reading_log.library_trends()
+        return metrics
 
-    # Top user by book count
-    top_user = (
-        db.session.query(User, func.count(Books.id)).join(Books)
-        .filter(User.is_admin == False).group_by(User.id)
-        .order_by(func.count(Books.id).desc()).first()
-    )
+    return cache_bus.cached(("library-metrics",), [LIBRARY_SCOPE], _library_metrics)
 
-    # Top genre
-    top_genre = (
-        db.session.query(Books.genre, func.count(Books.id)).join(User, Books.user_id == User.id)
-        .filter(User.is_admin == False).group_by(Books.genre)
-        .order_by(func.count(Books.id).desc()).first()
-    )
 
-    # status breakdown and genre distribution
-    all_books = (
-        db.session.query(Books).join(User, Books.user_id == User.id)
-        .filter(User.is_admin == False).all()
-    )
-    statuses = Counter([book.reading_status for book in all_books])
-    genres = Counter([book.genre for book in all_books])
+"""
+book counts of the non-admin library, counted on every shard in parallel and merged:
+total books, the top reader as (user id, books), and Counters of genres and statuses.
+a user's books are all on one shard, so the top reader of some shard is the top reader overall.
+"""
+def _library_counts() -> dict:
+    def count(session):
+        non_admin = User.is_admin == False
+        return {
+            "books": session.scalar(db.select(func.count(Books.id)).join(User).where(non_admin)),
+            "top_user": session.execute(db.select(Books.user_id, func.count(Books.id)).join(User).where(non_admin)
+                                        .group_by(Books.user_id).order_by(func.count(Books.id).desc())
+                                        .limit(1)).first(),
+            "genres": session.execute(db.select(book_genre(), func.count(Books.id)).select_from(Books).join(Work)
+                                      .join(User).where(non_admin).group_by(book_genre())
+                                      .order_by(func.count(Books.id).desc())).all(),
+            "statuses": session.execute(db.select(Books.reading_status, func.count(Books.id)).join(User)
+                                        .where(non_admin).group_by(Books.reading_status)).all(),
+        }
+
+    shards = sharding.gather(count)
+    genres, statuses = Counter(), Counter()
+    for shard in shards:
+        genres.update(dict(shard["genres"]))
+        statuses.update(dict(shard["statuses"]))
+    return {
+        "books": sum(shard["books"] for shard in shards),
+        "top_user": max((shard["top_user"] for shard in shards if shard["top_user"]), key=lambda row: row[1],
+                        default=None),
+        "genres": genres,
+        "statuses": statuses,
+    }
+
+
+def _library_metrics() -> dict:
+    session = read_session()
+    total_users = session.scalar(db.select(func.count(User.id)).where(User.is_admin == False))
+    counts = _library_counts()
+    top_user = counts["top_user"]
+    top_user_name = session.get(User, top_user[0]).name if top_user else None
+    top_genres = counts["genres"].most_common(8)
 
     return {
         "scope": "library",
-        "totals": {"users": total_users, "books": total_books},
-        "top_user": {"name": top_user[0].name, "count": int(top_user[1])} if top_user else None,
-        "top_genre": {"genre": top_genre[0], "count": int(top_genre[1])} if top_genre else None,
-        "status_breakdown": dict(statuses),
-        "top_genres": genres.most_common(8),
+        "totals": {"users": total_users, "books": counts["books"]},
+        "top_user": {"name": top_user_name, "count": int(top_user[1])} if top_user else None,
+        "top_genre": {"genre": top_genres[0][0], "count": int(top_genres[0][1])} if top_genres else None,
+        "status_breakdown": dict(counts["statuses"]),
+        "top_genres": top_genres,
+        "trends": reading_log.library_trends(),
     }
 
 
+# every non-admin book ordered by title, merged from all shards (the owner is loaded with each book)
+def _library_books() -> list[Books]:
+    per_shard = sharding.gather(lambda session: session.scalars(
+        db.select(Books).join(Books.work).join(User).where(User.is_admin == False)
+        .options(joinedload(Books.user)).order_by(Work.title)).all())
+    return list(heapq.merge(*per_shard, key=lambda book: book.title))
+
+
 # route decorator: only allows authenticated admin users
 def admin_only(func):
     @wraps(func)
@@ -127,11 +179,7 @@ def register():
             flash("You have already signed up with that email. Please log in instead.")
             return redirect(url_for("blueprint.login"))
 
-        hashed_password = generate_password_hash(
-            register_form.password.data,
-            method="pbkdf2:sha256",
-            salt_length=4
-        )
+        hashed_password = hash_password(register_form.password.data)
 
         # assigns the admin when first registering
         admin_email = (os.getenv("ADMIN_EMAIL") or "").strip().lower()
@@ -144,6 +192,9 @@ def register():
         )
 
         db.session.add(new_user)
+        db.session.flush()
+        sharding.place_user(new_user)
+        bump_versions()
         db.session.commit()
 
         login_user(new_user)
@@ -163,10 +214,15 @@ def login():
         if not user:
             flash("That email does not exist, please try again.")
             return redirect(url_for("blueprint.login"))
-        elif not check_password_hash(user.password, password):
+        elif not verify_password(user.password, password):
             flash("Incorrect password.")
             return redirect(url_for("blueprint.login"))
         else:
+            # transparently moves legacy hashes to the current policy while the plain password is known
+            if needs_rehash(user.password):
+                user.password = hash_password(password)
+                db.session.commit()
+
             login_user(user)
 
             return redirect(url_for("blueprint.home"))
@@ -187,23 +243,18 @@ def logout():
 # main landing page: Admins see admin dashboard, regular users see their book list
 @blueprint.route("/")
 @login_required
+@conditional_page(lambda: [LIBRARY_SCOPE] if current_user.is_admin else [user_scope(current_user.id)])
 def home():
     # Admin Dashboard
     if current_user.is_admin:
-        total_users = db.session.scalar(db.select(func.count(User.id)).where(User.is_admin == False))
-        total_books = db.session.scalar(db.select(func.count(Books.id)).join(User).where(User.is_admin == False))
-
-        top_user_row = db.session.execute(db.select(User, func.count(Books.id).label("book_count"))
-                                          .join(Books, isouter=True).where(User.is_admin == False).group_by(User.id)
-                                          .order_by(func.count(Books.id).desc()).limit(1)).first()
-
-        top_genre_row = db.session.execute(db.select(Books.genre, func.count(Books.id).label("cnt")).join(User)
-        .where(User.is_admin == False)
-        .group_by(Books.genre).order_by(func.count(Books.id).desc()).limit(
-            1)).first()
+        session = read_session()
+        total_users = session.scalar(db.select(func.count(User.id)).where(User.is_admin == False))
+        counts = _library_counts()
+        top_user_row = (session.get(User, counts["top_user"][0]), counts["top_user"][1]) if counts["top_user"] else None
+        top_genre_row = counts["genres"].most_common(1)[0] if counts["genres"] else None
 
         return render_template("admin-dashboard.html", total_users=total_users,
-                               total_books=total_books, top_user=top_user_row, top_genre=top_genre_row,
+                               total_books=counts["books"], top_user=top_user_row, top_genre=top_genre_row,
                                logged_in=current_user.is_authenticated)
 
     # User Dashboard
@@ -216,10 +267,14 @@ def home():
 @blueprint.route("/admin/users")
 @login_required
 @admin_only
+@conditional_page(lambda: [LIBRARY_SCOPE])
 def manage_users():
-    users = db.session.execute(db.select(User, func.count(Books.id).label("book_count"))
-                               .join(Books, isouter=True).where(User.is_admin == False)
-                               .group_by(User.id).order_by(User.name)).all()
+    users = db.session.scalars(db.select(User).where(User.is_admin == False).order_by(User.name)).all()
+    book_counts = Counter()
+    for rows in sharding.gather(lambda session: session.execute(db.select(Books.user_id, func.count(Books.id))
+                                                                .group_by(Books.user_id)).all()):
+        book_counts.update(dict(rows))
+    users = [(user, book_counts[user.id]) for user in users]
 
     return render_template("manage-users.html", users=users, logged_in=current_user.is_authenticated)
 
@@ -229,6 +284,8 @@ def manage_users():
 @blueprint.route("/admin/users/<int:user_id>/books")
 @login_required
 @admin_only
+@conditional_page(lambda user_id: [user_scope(user_id)])
+@sharding.routed(lambda user_id: sharding.shard_for(user_id))
 def view_books(user_id):
     user = db.get_or_404(User, user_id)
 
@@ -246,9 +303,9 @@ def view_books(user_id):
 @blueprint.route("/admin/books")
 @login_required
 @admin_only
+@conditional_page(lambda: [LIBRARY_SCOPE])
 def manage_books():
-    books = db.session.execute(db.select(Books).join(User).where(User.is_admin == False)
-                               .order_by(Books.title)).scalars().all()
+    books = _library_books()
 
     return render_template("manage-books.html", books=books,
                            logged_in=current_user.is_authenticated)
@@ -261,16 +318,25 @@ def manage_books():
 def add_book():
     addbook_form = AddBooks()
     if addbook_form.validate_on_submit():
-        new_book = Books(
+        user_id = current_user.id
+        new_book = dict(
             title=addbook_form.title.data.strip().title(),
             author=addbook_form.author.data.title(),
             genre=addbook_form.genre.data.title(),
             reading_status=addbook_form.reading_status.data,
-            user=current_user
         )
 
-        db.session.add(new_book)
-        db.session.commit()
+        def write():
+            book = Books(user_id=user_id, **new_book)
+            db.session.add(book)
+            db.session.flush()
+            reading_log.book_added(book)
+            sketches.book_added(book)
+            profiles.books_added([book])
+            touch_user(user_id)
+
+        run_write(write)
+        metadata.enrich_later(new_book["title"], new_book["author"])
         return redirect(url_for("blueprint.home"))
     return render_template("add-books.html", form=addbook_form, is_edit=False, logged_in=current_user.is_authenticated)
 
@@ -279,6 +345,7 @@ def add_book():
 # user edits an existing book
 @blueprint.route("/books/<int:book_id>/edit", methods=["GET", "POST"])
 @login_required
+@sharding.routed(lambda book_id: sharding.book_shard(book_id))
 def edit_book(book_id):
     book = db.get_or_404(Books, book_id)
     edit_form = AddBooks(
@@ -290,12 +357,24 @@ def edit_book(book_id):
     edit_form.submit.label.text = "Save"
 
     if edit_form.validate_on_submit():
-        book.title = edit_form.title.data.strip().title()
-        book.author = edit_form.author.data
-        book.genre = edit_form.genre.data
-        book.reading_status = edit_form.reading_status.data
+        changes = dict(
+            title=edit_form.title.data.strip().title(),
+            author=edit_form.author.data,
+            genre=edit_form.genre.data,
+            reading_status=edit_form.reading_status.data,
+        )
 
-        db.session.commit()
+        def write():
+            edited_book = db.session.get(Books, book_id)
+            old_status, old_values = edited_book.reading_status, sketches.book_values(edited_book)
+            edited_book.set_work(changes["title"], changes["author"], changes["genre"])
+            edited_book.reading_status = changes["reading_status"]
+            reading_log.status_changed(edited_book, old_status)
+            sketches.book_changed(old_values, edited_book)
+            profiles.books_changed([(old_values, edited_book)])
+            touch_user(edited_book.user_id)
+
+        run_write(write)
         return redirect(url_for("blueprint.home"))
     return render_template("add-books.html", form=edit_form, is_edit=True, logged_in=current_user.is_authenticated)
 
@@ -304,13 +383,84 @@ def edit_book(book_id):
 # user deletes a book
 @blueprint.route("/books/<int:book_id>/delete", methods=["GET", "POST"])
 @login_required
+@sharding.routed(lambda book_id: sharding.book_shard(book_id))
 def delete_book(book_id):
     book_to_delete = db.get_or_404(Books, book_id)
-    db.session.delete(book_to_delete)
-    db.session.commit()
+    owner_id = book_to_delete.user_id
+
+    def write():
+        reading_log.books_deleted(Books.id == book_id)
+        sketches.books_deleted(Books.id == book_id)
+        profiles.books_deleted(Books.id == book_id)
+        db.session.execute(db.delete(Books).where(Books.id == book_id))
+        touch_user(owner_id)
+
+    run_write(write)
     return redirect(url_for("blueprint.home"))
 
 
+# deletes non-admin users in one statement; their books go with them through ON DELETE CASCADE
+def delete_users(user_ids: list[int]) -> int:
+    ids = db.session.scalars(db.select(User.id).where(User.id.in_(user_ids), User.is_admin == False)).all()
+    if ids:
+        for shard, shard_ids in sharding.group_users(ids).items():
+            with sharding.use(shard):
+                reading_log.books_deleted(Books.user_id.in_(shard_ids))
+                sketches.books_deleted(Books.user_id.in_(shard_ids))
+                if shard:
+                    # the copies of the users on other shards are only deleted after the commit
+                    db.session.execute(db.delete(Books).where(Books.user_id.in_(shard_ids)))
+        db.session.execute(db.delete(User).where(User.id.in_(ids)))
+        bump_versions(*[user_scope(user_id) for user_id in ids])
+    return len(ids)
+
+
+# deletes books with one statement per shard, bumping the versions of every owner
+def delete_books(book_ids: list[int]) -> int:
+    deleted, owner_ids = 0, set()
+    for shard, shard_book_ids in sharding.locate_books(book_ids).items():
+        with sharding.use(shard):
+            owner_ids.update(db.session.scalars(db.select(Books.user_id).where(Books.id.in_(shard_book_ids))
+                                                .distinct()))
+            reading_log.books_deleted(Books.id.in_(shard_book_ids))
+            sketches.books_deleted(Books.id.in_(shard_book_ids))
+            profiles.books_deleted(Books.id.in_(shard_book_ids))
+            deleted += db.session.execute(db.delete(Books).where(Books.id.in_(shard_book_ids))).rowcount
+    if owner_ids:
+        bump_versions(*[user_scope(user_id) for user_id in owner_ids])
+    return deleted
+
+
+# admin deletes the selected books on /admin/books
+@blueprint.route("/admin/books/delete", methods=["POST"])
+@login_required
+@admin_only
+def admin_bulk_delete_books():
+    book_ids = request.form.getlist("book_ids", type=int)
+    if book_ids:
+        run_write(lambda: delete_books(book_ids))
+    return redirect(url_for("blueprint.manage_books"))
+
+
+
+# the reply refusing generated SQL that may not run (writes, other users' data for non-admins), or None
+def sql_refusal(sql_query: str, lower_user_message: str, is_admin: bool) -> str | None:
+    # used so that non-admin users cannot have information about other users
+    if not is_admin:
+        lowered_sql_query = (sql_query or "").lower()
+        if "from users" in lowered_sql_query or "join users" in lowered_sql_query:
+            return "You don't have permission."
+
+        if any(message in lower_user_message for message in
+               ["list all users", "show all users", "who are the users", "all users"]):
+            return "You don't have permission."
+
+    # block operations
+    forbidden = ["update", "delete", "insert", "alter", "drop", "truncate", "create"]
+    if any(word in sql_query.lower() for word in forbidden):
+        return "I only support read-only questions. I can't modify data."
+    return None
+
 
 """
 - can be used by both admins and users
@@ -321,6 +471,9 @@ def delete_book(book_id):
 """
 @blueprint.route("/ai-chat", methods=["POST"])
 @login_required
+@chat_log.logged
+@admission_controlled
+@cancellable
 def ai_chat():
     data = request.get_json() or {}
     user_message = (data.get("message") or "").strip()
@@ -340,12 +493,14 @@ def ai_chat():
             except ValueError:
                 user_id = None
 
+        chat_log.note(branch="insights")
         if user_id is not None:
             metrics = compute_user_metrics(user_id)
         else:
             metrics = compute_library_metrics()
 
-        summary = insights_summary(metrics)
+        with admission.slot("insights"):
+            summary = insights_summary(metrics)
         return jsonify({"reply": summary})
 
     #               BOOK RECOMMENDATIONS
@@ -355,6 +510,7 @@ def ai_chat():
     is_recommendation_query = any(word in lower_user_message for word in recommendation_keywords)
 
     if is_recommendation_query and "book" in lower_user_message:
+        chat_log.note(branch="recommendations")
         # checks if admin is asking for another user
         target_user = None
         target_user_name = None
@@ -381,34 +537,18 @@ def ai_chat():
                     target_user = User.query.filter(User.name.ilike(potential_name),
                                                     User.is_admin == False).first()
 
-        # determines whose books to analyze
+        # determines whose profile to base recommendations on
         if target_user:
             # admin asks for specific user
-            user_books = [
-                {
-                    "title": book.title,
-                    "author": book.author,
-                    "genre": book.genre,
-                    "reading_status": book.reading_status,
-                }
-                for book in target_user.books
-            ]
+            profile = profiles.get(target_user.id)
             target_user_name = target_user.name
         else:
             # regular user asking for themselves or admin asking for themselves
-            user_books = [
-                {
-                    "title": book.title,
-                    "author": book.author,
-                    "genre": book.genre,
-                    "reading_status": book.reading_status,
-                }
-                for book in current_user.books
-            ]
+            profile = profiles.get(current_user.id)
             target_user_name = current_user.name
 
         # checks if user has books to base recommendations on
-        if not user_books:
+        if not profile["total_books"]:
             if current_user.is_admin:
                 if target_user:
                     # admin asks about a specific user
@@ -422,14 +562,18 @@ def ai_chat():
                 # regular user asking about themselves
                 return jsonify({"reply": "You don't have any books yet. Add some books to your library first!"})
 
-        try:
-            reply_text = recommend_books(requester_name=current_user.name,
-                                         target_user_name=target_user_name,
-                                         user_books=user_books,
-                                         is_admin=current_user.is_admin)
-        except Exception as e:
-            print("Recommendation error:", repr(e))
-            reply_text = ("I had trouble generating recommendations right now. Please try again in a moment.")
+        with admission.slot("recommendations"):
+            try:
+                reply_text = recommend_books(requester_name=current_user.name,
+                                             target_user_name=target_user_name,
+                                             profile=profiles.for_prompt(profile),
+                                             is_admin=current_user.is_admin)
+                target_id = target_user.id if target_user else current_user.id
+                reply_text = drop_owned_recommendations(
+                    reply_text, lambda titles: profiles.owned_titles(target_id, titles))
+            except Exception as e:
+                print("Recommendation error:", repr(e))
+                reply_text = ("I had trouble generating recommendations right now. Please try again in a moment.")
 
         return jsonify({"reply": reply_text})
 
@@ -440,6 +584,7 @@ def ai_chat():
 
     # if web search is required goes directly to web search path
     if web_required:
+        chat_log.note(branch="web")
         # detects if admin is asking about a specific user
         target_user = None
         target_user_name = None
@@ -465,17 +610,15 @@ def ai_chat():
         # gets books based on target
         if target_user:
             # admin asking about specific user
-            user_books = [
-                {"title": book.title, "author": book.author, "genre": book.genre}
-                for book in target_user.books
-            ]
+            with sharding.use_user(target_user.id):
+                user_books = [
+                    {"title": book.title, "author": book.author, "genre": book.genre}
+                    for book in target_user.books
+                ]
             target_user_name = target_user.name
         elif current_user.is_admin:
             # admin asking about library in general
-            all_books = db.session.execute(
-                db.select(Books).join(User)
-                .where(User.is_admin == False).order_by(Books.title)
-            ).scalars().all()
+            all_books = _library_books()
             user_books = [
                 {"title": book.title, "author": book.author, "genre": book.genre}
                 for book in all_books
@@ -495,15 +638,23 @@ def ai_chat():
                 "reply": f"{target_user_name} doesn't have any books yet. Add some books to their library first."
             })
 
-        try:
-            reply_text = answers_from_web(
-                user_question=user_message,
-                user_books=user_books,
-                is_admin=current_user.is_admin
-            )
-        except Exception as e2:
-            print("Web-answer error:", repr(e2))
-            reply_text = "I tried looking this up on the internet, but something went wrong. Please try again later."
+        # answered from stored book metadata when we already looked these books up
+        reply_text = metadata.answer_from_metadata(user_message, user_books)
+        chat_log.cache_status("metadata", reply_text is not None)
+        if reply_text is not None:
+            return jsonify({"reply": reply_text})
+
+        with admission.slot("web"):
+            try:
+                reply_text = answers_from_web(
+                    user_question=user_message,
+                    user_books=user_books,
+                    is_admin=current_user.is_admin
+                )
+            except Exception as e2:
+                print("Web-answer error:", repr(e2))
+                reply_text = ("I tried looking this up on the internet, but something went wrong. "
+                              "Please try again later.")
 
         return jsonify({"reply": reply_text})
 
@@ -540,6 +691,7 @@ def ai_chat():
     )
 
     if is_habit_query:
+        chat_log.note(branch="habits")
 
         # checks if asking about a specific user (admin only)
         target_user = None
@@ -563,33 +715,17 @@ def ai_chat():
 
         # determines whose habits to analyze
         if target_user:
-            user_books = [
-                {
-                    "title": book.title,
-                    "author": book.author,
-                    "genre": book.genre,
-                    "reading_status": book.reading_status,
-                }
-                for book in target_user.books
-            ]
+            profile = profiles.get(target_user.id)
             target_user_name = target_user.name
         elif current_user.is_admin and not target_user and any(char.isupper() for char in user_message):
             # if admin asks about a user and the user is not found
             return jsonify({"reply": "I couldn't find that user. Please check the name and try again."})
         else:
-            user_books = [
-                {
-                    "title": book.title,
-                    "author": book.author,
-                    "genre": book.genre,
-                    "reading_status": book.reading_status,
-                }
-                for book in current_user.books
-            ]
+            profile = profiles.get(current_user.id)
             target_user_name = current_user.name
 
         # checks if user has books
-        if not user_books:
+        if not profile["total_books"]:
             if current_user.is_admin:
                 if target_user:
                     # admin asks about a specific user
@@ -603,102 +739,178 @@ def ai_chat():
                 # regular user asking about themselves
                 return jsonify({"reply": "You don't have any books yet. Add some books to your library first!"})
 
-        try:
-            reply_text = analyze_reading_habits(
-                requester_name=current_user.name,
-                target_user_name=target_user_name,
-                user_books=user_books
-            )
-        except Exception as e:
-            print("Reading habits analysis error:", repr(e))
-            reply_text = "I had trouble analyzing reading habits. Please try again."
+        with admission.slot("habits"):
+            try:
+                reply_text = analyze_reading_habits(
+                    requester_name=current_user.name,
+                    target_user_name=target_user_name,
+                    profile=profiles.for_prompt(profile)
+                )
+            except Exception as e:
+                print("Reading habits analysis error:", repr(e))
+                reply_text = "I had trouble analyzing reading habits. Please try again."
 
         return jsonify({"reply": reply_text})
 
 
 
     #                  SQL-BASED QUERIES
-    sql_query = ai_to_sql(user_message, current_user.id, is_admin=current_user.is_admin)
+    # one call returns the SQL and an answer template, the answer is filled in locally from the rows
+    chat_log.note(branch="sql")
+    with admission.slot("sql"):
+        plan = ai_to_sql_with_answer(user_message, current_user.id, is_admin=current_user.is_admin)
+    sql_query = plan["sql"]
     print("AI-generated SQL:", sql_query)
 
-    # used so that non-admin users cannot have information about other users
-    if not current_user.is_admin:
-        lowered_sql_query = (sql_query or "").lower()
-        if "from users" in lowered_sql_query or "join users" in lowered_sql_query:
-            return jsonify({"reply": "You don't have permission."})
-
-        if any(message in lower_user_message for message in
-               ["list all users", "show all users", "who are the users", "all users"]):
-            return jsonify({"reply": "You don't have permission."})
-
-    # block operations
-    forbidden = ["update", "delete", "insert", "alter", "drop", "truncate", "create"]
-    if any(word in sql_query.lower() for word in forbidden):
-        return jsonify({"reply": "I only support read-only questions. I can't modify data."})
+    refusal = sql_refusal(sql_query, lower_user_message, current_user.is_admin)
+    if refusal is not None:
+        return jsonify({"reply": refusal})
 
-    # executes sql
+    # executes sql, or reuses the rows of the same query while the data it reads is unchanged;
+    # an admin's SQL sees every shard
     try:
-        result = db.session.execute(text(sql_query)).fetchall()
+        session = sharding.library_session() if current_user.is_admin else read_session()
+        rows = sql_cache.execute(session, sql_query)
     except Exception as e:
         print("SQL/AI error:", repr(e))
         return jsonify({"reply": "I couldn't understand that question. Try rephrasing it."})
+    chat_log.note(sql=sql_query)
 
-    # convert rows to dictionaries
-    rows = [dict(row._mapping) for row in result]
+    reply_text = fill_answer_template(plan, rows)
+    if reply_text is not None:
+        chat_log.note(answer="template")
+        return jsonify({"reply": reply_text})
 
-    # generates natural language answer
-    try:
-        reply_text = generate_natural_answer(
-            user_question=user_message,
-            sql_query=sql_query,
-            rows=rows,
-            user_name=current_user.name,
-            is_admin=current_user.is_admin,
-        )
-    except Exception as e:
-        print("Answer generation error:", repr(e))
-        if not rows:
-            reply_text = "I couldn't find any matching records."
-        else:
-            sample = rows[0]
-            if {"title", "author", "genre", "reading_status"} <= set(sample.keys()):
-                lines = [
-                    f"- {row['title']} by {row['author']} ({row['genre']}, {row['reading_status']})"
-                    for row in rows
-                ]
-                reply_text = "Here's what I found:\n" + "\n".join(lines)
+    # common result shapes (counts, book lists, rankings) are phrased locally
+    reply_text = answers.render_answer(rows, is_admin=current_user.is_admin, sql=sql_query)
+    if reply_text is not None:
+        chat_log.note(answer="local")
+        return jsonify({"reply": reply_text})
+
+    chat_log.note(answer="llm")
+
+    # unusual shapes need a second call to phrase the answer
+    with admission.slot("sql"):
+        try:
+            reply_text = generate_natural_answer(
+                user_question=user_message,
+                sql_query=sql_query,
+                rows=rows,
+                user_name=current_user.name,
+                is_admin=current_user.is_admin,
+            )
+        except Exception as e:
+            print("Answer generation error:", repr(e))
+            if not rows:
+                reply_text = "I couldn't find any matching records."
             else:
-                lines = []
-                for row in rows:
-                    parts = [f"{k}: {v}" for k, v in row.items()]
-                    lines.append("- " + ", ".join(parts))
-                reply_text = "Here are the results:\n" + "\n".join(lines)
+                sample = rows[0]
+                if {"title", "author", "genre", "reading_status"} <= set(sample.keys()):
+                    lines = [
+                        f"- {row['title']} by {row['author']} ({row['genre']}, {row['reading_status']})"
+                        for row in rows
+                    ]
+                    reply_text = "Here's what I found:\n" + "\n".join(lines)
+                else:
+                    lines = []
+                    for row in rows:
+                        parts = [f"{k}: {v}" for k, v in row.items()]
+                        lines.append("- " + ", ".join(parts))
+                    reply_text = "Here are the results:\n" + "\n".join(lines)
 
     return jsonify({"reply": reply_text})
 
 
 
+# the chat panel aborted a request (closed, or superseded by a new message); the running request stops early
+@blueprint.route("/ai-chat/cancel", methods=["POST"])
+@login_required
+def ai_chat_cancel():
+    request_id = (request.get_json(silent=True) or {}).get("request_id")
+    if not cancellation.cancel(current_user.id, str(request_id or "")):
+        return jsonify({"cancelled": False}), 400
+    return jsonify({"cancelled": True})
+
+
+
 # shows insights for whole library or a selected user
 @blueprint.route("/admin/insights")
 @login_required
 @admin_only
+@conditional_page(lambda: [LIBRARY_SCOPE])
 def admin_insights():
     user_id = request.args.get("user_id", type=int)
+    approximate = request.args.get("approximate", type=int) == 1
     users = User.query.filter(User.is_admin == False).order_by(User.name.asc()).all()
 
     if user_id:
         metrics = compute_user_metrics(user_id)
     else:
-        metrics = compute_library_metrics()
+        metrics = compute_library_metrics(approximate=approximate)
 
     summary = insights_summary(metrics)
 
     return render_template("admin-insights.html", metrics=metrics,
-                           summary=summary,users=users,selected_user_id=user_id
+                           summary=summary,users=users,selected_user_id=user_id, approximate=approximate
                            , logged_in=current_user.is_authenticated)
 
 
 
+# runtime metrics for monitoring (cache hit rates and sizes, connection pools)
+@blueprint.route("/admin/metrics")
+@login_required
+@admin_only
+def admin_metrics():
+    write_queues = current_app.extensions.get("write_queues")
+    return jsonify({
+        "db_pools": pool_metrics(),
+        "shard_replication": sharding.replication_stats() if sharding.enabled() else None,
+        "write_queues": [write_queue.stats() for write_queue in write_queues] if write_queues else None,
+        "llm_singleflight": singleflight.flights().stats(),
+        "local_answers": answers.stats(),
+        "web_cache": web_cache().stats() if web_cache() else None,
+        "book_metadata": metadata.stats(),
+        "page_cache": current_app.extensions["page_cache"].stats(),
+        "fragment_cache": current_app.extensions["fragment_cache"].stats(),
+        "l1_cache": cache_bus.bus().stats(),
+        "ai_sql_results": sql_cache.stats(),
+        "ai_admission": admission.controller().stats(),
+        "chat_log": chat_log.log().stats() if chat_log.log() else None,
+    })
+
+
+
+# request profiles captured with ?profile=1 / ?profile=cprofile or the X-Profile header
+@blueprint.route("/admin/profiles")
+@login_required
+@admin_only
+def admin_profiles():
+    return render_template("admin-profiles.html", captures=profiler.list_captures(), capture=None,
+                           logged_in=current_user.is_authenticated)
+
+
+@blueprint.route("/admin/profiles/<capture_id>")
+@login_required
+@admin_only
+def admin_profile(capture_id):
+    capture = profiler.load_capture(capture_id)
+    if capture is None:
+        abort(404)
+    return render_template("admin-profiles.html", captures=None, capture=capture,
+                           logged_in=current_user.is_authenticated)
+
+
+@blueprint.route("/admin/profiles/<capture_id>/download")
+@login_required
+@admin_only
+def admin_profile_download(capture_id):
+    capture = profiler.load_capture(capture_id)
+    if capture is None:
+        abort(404)
+    return send_file(profiler.profile_path(capture), as_attachment=True, download_name=capture["profile_file"])
+
+
+
 # admin edits a user
 @blueprint.route("/admin/users/<int:user_id>/edit", methods=["GET", "POST"])
 @login_required
@@ -716,8 +928,9 @@ def admin_edit_user(user_id):
 
         # only updates the password if admin typed one
         if form.password.data:
-            user.password = generate_password_hash(form.password.data)
+            user.password = hash_password(form.password.data)
 
+        touch_user(user.id)
         db.session.commit()
         return redirect(url_for("blueprint.manage_users"))
 
@@ -730,6 +943,7 @@ def admin_edit_user(user_id):
 @blueprint.route("/admin/users/<int:user_id>/books/add", methods=["GET", "POST"])
 @login_required
 @admin_only
+@sharding.routed(lambda user_id: sharding.shard_for(user_id))
 def admin_add_book(user_id):
     user = db.get_or_404(User, user_id)
 
@@ -738,16 +952,24 @@ def admin_add_book(user_id):
 
     form = AddBooks()
     if form.validate_on_submit():
-        new_book = Books(
+        new_book = dict(
             title=form.title.data.title().strip().title(),
             author=form.author.data.title(),
             genre=form.genre.data.title(),
             reading_status=form.reading_status.data,
-            user=user
         )
 
-        db.session.add(new_book)
-        db.session.commit()
+        def write():
+            book = Books(user_id=user_id, **new_book)
+            db.session.add(book)
+            db.session.flush()
+            reading_log.book_added(book)
+            sketches.book_added(book)
+            profiles.books_added([book])
+            touch_user(user_id)
+
+        run_write(write)
+        metadata.enrich_later(new_book["title"], new_book["author"])
 
         return redirect(url_for("blueprint.view_books", user_id=user.id))
     return render_template("add-books.html", form=form, is_edit=False,
@@ -765,6 +987,16 @@ def admin_delete_user(user_id):
     if user.is_admin:
         abort(403)    # can't delete admin users
 
-    db.session.delete(user)
-    db.session.commit()
+    run_write(lambda: delete_users([user_id]))
+    return redirect(url_for("blueprint.manage_users"))
+
+
+# admin deletes the selected users on /admin/users (admins among them are skipped)
+@blueprint.route("/admin/users/delete", methods=["POST"])
+@login_required
+@admin_only
+def admin_bulk_delete_users():
+    user_ids = request.form.getlist("user_ids", type=int)
+    if user_ids:
+        run_write(lambda: delete_users(user_ids))
     return redirect(url_for("blueprint.manage_users"))
@@ -0,0 +1,788 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+import click
+from flask import current_app, g, has_app_context, request
+from flask.cli import AppGroup
+from flask_login import current_user
+from sqlalchemy import Table, create_engine, delete, event, func, inspect, insert, select, text, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+from app_factory import db, RoutingSession, User, Books, Work, UserShard, ShardSequence, ReplicationRetry
+from database import dialect_insert, engine_options, read_session
+
+
+"""
+optional horizontal sharding of the user libraries (DB_SHARDS).
+shard 0 is the main database (SQLALCHEMY_DATABASE_URI); DB_SHARDS lists the others, comma-separated:
+SQLite URIs, or with a Postgres main database the names of schemas inside it.
+- each user's books, reading history and profile live on one shard, recorded in user_shards (users without
+  a row, and admins, are on shard 0); a new user goes to the shard with the fewest users
+- users and book_metadata are written on shard 0 and copied to the other shards after every commit, so
+  queries on a shard can still join them; user_shards, analytics_sketches and replication_retries only live
+  on shard 0, while data_versions and cache_invalidations are kept per shard (see cache.read_versions)
+- every shard keeps its own works catalog, and new rows of the id tables get ids from a range per shard
+  (ID_RANGE), so a book id is unique across shards and a moved book keeps its id
+- db.session routes each statement: the per-user tables (and raw SQL) go to the current shard, which is the
+  logged-in user's during a request and is switched with `use()`; statements on users/book_metadata alone or
+  on a shard-0-only table go to shard 0. loaded and added rows are flushed back to the shard they belong to.
+- library-wide reads run on every shard in parallel (`gather`) and merge the results; the admin's ad-hoc
+  AI SQL runs on `library_session()`, where the sharded tables are UNION ALL views over all shards
+a commit that touches several shards is one transaction per shard, committed one after the other.
+`flask shards status|move|rebalance|sync` inspects and changes the placement.
+"""
+ID_RANGE = 100_000_000
+GLOBAL_TABLES = {"user_shards", "analytics_sketches", "replication_retries"}
+REPLICATED_TABLES = ("users", "book_metadata")
+RANGED_TABLES = {"works", "user_books", "reading_events"}
+FEDERATED_TABLES = ("works", "user_books", "reading_events", "reading_rollups", "reader_profiles")
+USER_TABLES = ("user_books", "reading_events", "reading_rollups", "reader_profiles")
+LIBRARY_SCHEMA = "library"
+MAX_SQLITE_SHARDS = 10    # SQLite attaches at most 10 databases to one connection
+CHUNK = 500
+_SCHEMA_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+_shard = contextvars.ContextVar("shard", default=0)
+
+
+def shard_bind(shard: int) -> str:
+    return f"shard{shard}"
+
+
+"""
+adds one bind per DB_SHARDS entry to the app config; must run before db.init_app(app).
+a Postgres schema shard is the main database with its search_path set to the schema.
+"""
+def configure(app) -> None:
+    entries = app.config.get("DB_SHARDS", os.getenv("DB_SHARDS", ""))
+    if isinstance(entries, str):
+        entries = [entry.strip() for entry in entries.split(",") if entry.strip()]
+    app.config["DB_SHARDS"] = list(entries)
+    if not entries:
+        return
+    if app.config.get("DB_REPLICA_URI") or os.getenv("DB_REPLICA_URI"):
+        raise ValueError("DB_SHARDS cannot be combined with DB_REPLICA_URI")
+
+    profile = app.config.get("DB_POOL_PROFILE") or os.getenv("DB_POOL_PROFILE", "development")
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    for shard, entry in enumerate(entries, start=1):
+        if uri.startswith("postgresql") and _SCHEMA_NAME.match(entry):
+            binds[shard_bind(shard)] = {"url": uri, **engine_options(uri, profile),
+                                        "connect_args": {"options": f"-csearch_path={entry}"}}
+        elif uri.startswith("sqlite") and entry.startswith("sqlite:///") and ":memory:" not in entry:
+            binds[shard_bind(shard)] = {"url": entry, **engine_options(entry, profile)}
+        else:
+            raise ValueError(f"DB_SHARDS entry {entry!r}: expected a SQLite file URI with a SQLite database, "
+                             f"or a schema name with a Postgres database")
+    if uri.startswith("sqlite") and len(entries) >= MAX_SQLITE_SHARDS:
+        raise ValueError(f"at most {MAX_SQLITE_SHARDS - 1} SQLite shards besides the main database")
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+
+# the engines of every shard and how statements, flushed rows and library-wide reads are spread over them
+class ShardRouter:
+    def __init__(self, engines: list, schemas: dict[int, str]):
+        self.engines = engines
+        self.schemas = schemas    # shard -> Postgres schema
+        self.sharded = set(db.metadata.tables) - GLOBAL_TABLES - set(REPLICATED_TABLES)
+        self._library_engine = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # the engine for a statement (or for a mapper's rows when there is no statement)
+    def bind_for(self, mapper, clause):
+        if clause is not None:
+            tables = {table.name for table in find_tables(clause, include_crud=True, include_joins=True)
+                      if isinstance(table, Table)}
+        else:
+            tables = {inspect(mapper).local_table.name} if mapper is not None else set()
+
+        if not tables or (tables & self.sharded and not tables & GLOBAL_TABLES):
+            return self.engines[current()]
+        return self.engines[0]
+
+    def connection_for(self, session, mapper, instance):
+        shard = shard_of(instance) if mapper.local_table.name in self.sharded else 0
+        return session.connection(bind_arguments={"bind": self.engines[shard]})
+
+    # fn(session) on every shard at once, each with its own session; the results in shard order
+    def gather(self, fn) -> list:
+        def run(engine):
+            with Session(bind=engine) as session:
+                return fn(session)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=len(self.engines), thread_name_prefix="shard-gather")
+        return list(self._executor.map(run, self.engines))
+
+    # engine on shard 0 whose connections see the sharded tables of all shards as one
+    def library_engine(self):
+        with self._lock:
+            if self._library_engine is None:
+                primary = self.engines[0]
+                if primary.dialect.name == "sqlite":
+                    engine = create_engine(primary.url)
+                    files = [shard_engine.url.database for shard_engine in self.engines[1:]]
+                    event.listen(engine, "connect", lambda dbapi_connection, record: _attach(dbapi_connection, files))
+                else:
+                    engine = create_engine(primary.url, connect_args={
+                        "options": f"-csearch_path={LIBRARY_SCHEMA},{self.primary_schema()}"})
+                self._library_engine = engine
+            return self._library_engine
+
+    def primary_schema(self) -> str:
+        with self.engines[0].connect() as connection:
+            return connection.scalar(text("SELECT current_schema()"))
+
+    # Postgres: the `library` schema of UNION ALL views over the shard schemas
+    def create_library_views(self) -> None:
+        schemas = [self.primary_schema(), *[self.schemas[shard] for shard in range(1, len(self.engines))]]
+        with self.engines[0].begin() as connection:
+            connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {LIBRARY_SCHEMA}"))
+            for table in (*FEDERATED_TABLES, "books"):
+                union = " UNION ALL ".join(f'SELECT * FROM "{schema}".{table}' for schema in schemas)
+                connection.execute(text(f"CREATE OR REPLACE VIEW {LIBRARY_SCHEMA}.{table} AS {union}"))
+
+
+# SQLite: every connection of the library engine attaches the shard files and shadows the sharded tables
+def _attach(dbapi_connection, files: list[str]) -> None:
+    cursor = dbapi_connection.cursor()
+    schemas = ["main"]
+    for shard, path in enumerate(files, start=1):
+        cursor.execute(f"ATTACH DATABASE ? AS {shard_bind(shard)}", (path,))
+        schemas.append(shard_bind(shard))
+    for table in (*FEDERATED_TABLES, "books"):
+        union = " UNION ALL ".join(f"SELECT * FROM {schema}.{table}" for schema in schemas)
+        cursor.execute(f"CREATE TEMP VIEW {table} AS {union}")
+    cursor.close()
+
+
+def init_app(app) -> None:
+    app.cli.add_command(shards_cli)
+    entries = app.config["DB_SHARDS"]
+    if not entries:
+        return
+
+    with app.app_context():
+        engines = [db.engine, *[db.engines[shard_bind(shard)] for shard in range(1, len(entries) + 1)]]
+    # the shards get db.metadata through create_all(); the empty metadata Flask-SQLAlchemy keeps per bind
+    # (on the db object, shared by every app) would make db.create_all() expect these binds in other apps
+    for shard in range(1, len(entries) + 1):
+        db.metadatas.pop(shard_bind(shard), None)
+    schemas = {shard: entry for shard, entry in enumerate(entries, start=1) if "://" not in entry}
+    app.extensions["sharding"] = ShardRouter(engines, schemas)
+    # REPLICATION_RETRY_INTERVAL=0 leaves missed replications to `flask shards sync`
+    interval = float(app.config.get("REPLICATION_RETRY_INTERVAL", os.getenv("REPLICATION_RETRY_INTERVAL", 30)))
+    if interval > 0:
+        app.extensions["replication_retrier"] = ReplicationRetrier(app, interval)
+    app.before_request(_enter_user_shard)
+    app.teardown_request(_leave_user_shard)
+    app.teardown_appcontext(close_library_session)
+
+
+def router() -> ShardRouter | None:
+    return current_app.extensions.get("sharding") if has_app_context() else None
+
+
+def enabled() -> bool:
+    return router() is not None
+
+
+def shards() -> range:
+    return range(len(router().engines)) if enabled() else range(1)
+
+
+# the shard db.session sends the per-user tables to
+def current() -> int:
+    return _shard.get()
+
+
+# switches the current shard for the block; write jobs queued inside it run on that shard too
+@contextmanager
+def use(shard: int):
+    token = _shard.set(shard)
+    try:
+        yield shard
+    finally:
+        _shard.reset(token)
+
+
+# the job with the current shard, for running it on another thread (the SQLite write queue)
+def bound(job):
+    shard = current()
+
+    def run():
+        with use(shard):
+            return job()
+
+    return run
+
+
+def shard_of(instance) -> int:
+    return inspect(instance).info.get("shard", current())
+
+
+# the shard of a user, looked up once per request
+def shard_for(user_id: int) -> int:
+    if not enabled():
+        return 0
+    known = g.setdefault("user_shards", {})
+    if user_id not in known:
+        known[user_id] = db.session.scalar(select(UserShard.shard).where(UserShard.user_id == user_id)) or 0
+    return known[user_id]
+
+
+def use_user(user_id: int):
+    return use(shard_for(user_id))
+
+
+# {shard: user ids} for the given users
+def group_users(user_ids) -> dict[int, list[int]]:
+    user_ids = list(user_ids)
+    if not enabled():
+        return {0: user_ids} if user_ids else {}
+    placed = dict(db.session.execute(select(UserShard.user_id, UserShard.shard)
+                                     .where(UserShard.user_id.in_(user_ids))).all())
+    groups = defaultdict(list)
+    for user_id in user_ids:
+        groups[placed.get(user_id, 0)].append(user_id)
+    return dict(groups)
+
+
+# {shard: book ids} for the books that exist, looking on the current shard first
+def locate_books(book_ids) -> dict[int, list[int]]:
+    remaining = set(book_ids)
+    if not enabled():
+        return {0: list(book_ids)} if remaining else {}
+    found = {}
+    for shard in sorted(shards(), key=lambda shard: shard != current()):
+        if not remaining:
+            break
+        with use(shard):
+            ids = db.session.scalars(select(Books.id).where(Books.id.in_(remaining))).all()
+        if ids:
+            found[shard] = ids
+            remaining -= set(ids)
+    return found
+
+
+def book_shard(book_id: int) -> int:
+    return next(iter(locate_books([book_id])), current())
+
+
+# puts a new (flushed) user on the shard with the fewest users
+def place_user(user: User) -> int:
+    if not enabled() or user.is_admin:
+        return 0
+    counts = Counter(dict(db.session.execute(select(UserShard.shard, func.count())
+                                             .group_by(UserShard.shard)).all()))
+    counts[0] += db.session.scalar(select(func.count(User.id)).where(
+        User.is_admin == False, User.id != user.id, User.id.not_in(select(UserShard.user_id))))
+    shard = min(shards(), key=lambda shard: (counts[shard], shard))
+    db.session.add(UserShard(user_id=user.id, shard=shard))
+    g.setdefault("user_shards", {})[user.id] = shard
+    return shard
+
+
+"""
+view decorator running the view on the shard `shard_of(**kwargs)` returns:
+
+    @routed(lambda user_id: sharding.shard_for(user_id))
+"""
+def routed(shard_of):
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if not enabled():
+                return view(*args, **kwargs)
+            with use(shard_of(**kwargs)):
+                return view(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+def _enter_user_shard() -> None:
+    if request.endpoint != "static" and current_user.is_authenticated:
+        _shard.set(shard_for(current_user.id))
+
+
+def _leave_user_shard(exception=None) -> None:
+    _shard.set(0)
+
+
+"""
+runs fn(session) on every shard in parallel and returns the results in shard order; fn must only use
+the session it is given. without shards it is [fn(read_session())].
+"""
+def gather(fn) -> list:
+    shard_router = router()
+    if shard_router is None:
+        return [fn(read_session())]
+    return shard_router.gather(fn)
+
+
+# read-only session over the whole library, for the admin's ad-hoc SQL; read_session() without shards
+def library_session():
+    shard_router = router()
+    if shard_router is None:
+        return read_session()
+    if "library_session" not in g:
+        g.library_session = Session(bind=shard_router.library_engine(), info={"source": "library"})
+    return g.library_session
+
+
+def close_library_session(exception=None) -> None:
+    session = g.pop("library_session", None)
+    if session is not None:
+        session.close()
+
+
+# which data a session reads, for cache keys: "" without shards, "library" or the current shard
+def source(session) -> str:
+    if not enabled():
+        return ""
+    return session.info.get("source") or shard_bind(current())
+
+
+"""
+reserves `count` ids of a table on a shard and returns the first one. ids come from the shard's range
+(shard * ID_RANGE and up); the counter starts after the highest id already in that range.
+"""
+def allocate_ids(connection, shard: int, table_name: str, count: int) -> int:
+    sequences = ShardSequence.__table__
+    bump = (update(sequences).where(sequences.c.name == table_name)
+            .values(next_id=sequences.c.next_id + count).returning(sequences.c.next_id))
+    next_id = connection.scalar(bump)
+    if next_id is None:
+        table = db.metadata.tables[table_name]
+        low = max(shard * ID_RANGE, 1)
+        highest = connection.scalar(select(func.max(table.c.id))
+                                    .where(table.c.id >= low, table.c.id < (shard + 1) * ID_RANGE))
+        connection.execute(dialect_insert(connection)(sequences).values(name=table_name, next_id=(highest or low - 1) + 1)
+                           .on_conflict_do_nothing())
+        next_id = connection.scalar(bump)
+    return next_id - count
+
+
+def _upsert(connection, table, rows: list[dict]) -> None:
+    for start in range(0, len(rows), CHUNK):
+        statement = dialect_insert(connection)(table).values(rows[start:start + CHUNK])
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={column.name: statement.excluded[column.name] for column in table.columns if not column.primary_key},
+        ))
+
+
+def _row(instance) -> dict:
+    mapper = inspect(instance).mapper
+    return {prop.columns[0].name: getattr(instance, prop.key) for prop in mapper.column_attrs}
+
+
+# rows are added on the current shard; loaded rows belong to the shard they came from
+@event.listens_for(RoutingSession, "transient_to_pending")
+@event.listens_for(RoutingSession, "loaded_as_persistent")
+def _remember_shard(session, instance) -> None:
+    if session._router() is not None:
+        inspect(instance).info.setdefault("shard", current())
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def _allocate_ids(session, flush_context, instances) -> None:
+    shard_router = session._router()
+    if shard_router is None:
+        return
+    pending = defaultdict(list)
+    for instance in session.new:
+        table = inspect(instance).mapper.local_table
+        if table.name in RANGED_TABLES and instance.id is None:
+            pending[(shard_of(instance), table.name)].append(instance)
+
+    for (shard, table_name), instances in pending.items():
+        connection = session.connection(bind_arguments={"bind": shard_router.engines[shard]})
+        first = allocate_ids(connection, shard, table_name, len(instances))
+        for offset, instance in enumerate(instances):
+            instance.id = first + offset
+
+
+def _replication(session) -> dict:
+    return session.info.setdefault("replicate", {"rows": defaultdict(dict), "deleted": defaultdict(set),
+                                                 "statements": []})
+
+
+# changed users/book_metadata rows, and statements writing those tables, are replayed on the shards after commit
+@event.listens_for(RoutingSession, "after_flush")
+def _track_replicated_rows(session, flush_context) -> None:
+    if session._router() is None:
+        return
+    for instance in [*session.new, *session.dirty, *session.deleted]:
+        table_name = inspect(instance).mapper.local_table.name
+        if table_name not in REPLICATED_TABLES:
+            continue
+        if instance in session.deleted:
+            _replication(session)["deleted"][table_name].add(instance.id)
+        else:
+            _replication(session)["rows"][table_name][instance.id] = _row(instance)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _track_replicated_statements(orm_execute_state) -> None:
+    session = orm_execute_state.session
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if session._router() is not None and getattr(table, "name", None) in REPLICATED_TABLES:
+        _replication(session)["statements"].append((orm_execute_state.statement, orm_execute_state.parameters))
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _replicate(session) -> None:
+    pending = session.info.pop("replicate", None)
+    shard_router = session._router()
+    if not pending or shard_router is None:
+        return
+    for shard, engine in enumerate(shard_router.engines[1:], start=1):
+        try:
+            with engine.begin() as connection:
+                for table_name, rows in pending["rows"].items():
+                    _upsert(connection, db.metadata.tables[table_name], list(rows.values()))
+                for table_name, ids in pending["deleted"].items():
+                    table = db.metadata.tables[table_name]
+                    connection.execute(delete(table).where(table.c.id.in_(ids)))
+                for statement, parameters in pending["statements"]:
+                    connection.execute(statement, parameters or {})
+        except Exception as e:
+            print("Shard replication error:", repr(e))
+            _record_retries(shard_router, shard, pending)
+
+
+# remembers what a shard missed in replication_retries, drained by the retrier and `flask shards sync`
+def _record_retries(shard_router, shard: int, pending: dict) -> None:
+    now = time.time()
+    retries = [{"shard": shard, "table_name": table_name, "row_id": row_id, "created_at": now}
+               for table_name, rows in pending["rows"].items() for row_id in rows]
+    retries += [{"shard": shard, "table_name": table_name, "row_id": row_id, "created_at": now}
+                for table_name, ids in pending["deleted"].items() for row_id in ids]
+    if pending["statements"]:
+        retries.append({"shard": shard, "table_name": None, "row_id": None, "created_at": now})
+    try:
+        with shard_router.engines[0].begin() as connection:
+            connection.execute(insert(ReplicationRetry.__table__), retries)
+    except Exception as e:
+        print("Shard replication retry error:", repr(e))
+        return
+    retrier = current_app.extensions.get("replication_retrier") if has_app_context() else None
+    if retrier is not None:
+        retrier.start()
+
+
+"""
+copies the rows a shard missed again, as they are now on shard 0 (rows gone there are deleted), and
+removes the retries it handled; a shard that missed a statement is synced as a whole.
+returns how many retries were handled, a shard that fails again keeps its retries for the next run.
+"""
+def retry_replication() -> int:
+    shard_router = router()
+    retries = ReplicationRetry.__table__
+    with shard_router.engines[0].connect() as connection:
+        pending = connection.execute(select(retries.c.id, retries.c.shard, retries.c.table_name,
+                                            retries.c.row_id).order_by(retries.c.id)).all()
+    by_shard = defaultdict(list)
+    for row in pending:
+        by_shard[row.shard].append(row)
+
+    handled = 0
+    for shard, rows in by_shard.items():
+        try:
+            if any(row.table_name is None for row in rows):
+                sync_replicated([shard])
+            else:
+                _copy_rows(shard_router, shard, rows)
+            with shard_router.engines[0].begin() as connection:
+                connection.execute(delete(retries).where(retries.c.shard == shard,
+                                                         retries.c.id <= rows[-1].id))
+            handled += len(rows)
+        except Exception as e:
+            print("Shard replication retry error:", repr(e))
+    return handled
+
+
+def _copy_rows(shard_router, shard: int, rows) -> None:
+    ids = defaultdict(set)
+    for row in rows:
+        ids[row.table_name].add(row.row_id)
+    with shard_router.engines[0].connect() as source, shard_router.engines[shard].begin() as connection:
+        for table_name, row_ids in ids.items():
+            table = db.metadata.tables[table_name]
+            current = [dict(row) for row in source.execute(select(table).where(table.c.id.in_(row_ids))).mappings()]
+            gone = row_ids - {row["id"] for row in current}
+            if gone:
+                connection.execute(delete(table).where(table.c.id.in_(gone)))
+            if current:
+                _upsert(connection, table, current)
+
+
+# backlog of replication_retries, for /admin/metrics
+def replication_stats() -> dict:
+    retries = ReplicationRetry.__table__
+    with router().engines[0].connect() as connection:
+        rows = connection.execute(select(retries.c.shard, func.count(), func.min(retries.c.created_at))
+                                  .group_by(retries.c.shard)).all()
+    oldest = min((row[2] for row in rows), default=None)
+    return {"pending": sum(row[1] for row in rows), "by_shard": {row[0]: row[1] for row in rows},
+            "oldest_seconds": round(time.time() - oldest, 1) if oldest is not None else None}
+
+
+# drains replication_retries in the background every `interval` seconds while there is a backlog
+class ReplicationRetrier:
+    def __init__(self, app, interval: float):
+        self.app = app
+        self.interval = interval
+        self.retried = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="shard-replication-retry", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.retried += retry_replication()
+                    if not replication_stats()["pending"]:
+                        return
+                except Exception as e:
+                    print("Shard replication retry error:", repr(e))
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_replication(session) -> None:
+    session.info.pop("replicate", None)
+
+
+# copies users and book_metadata from shard 0 to the other shards (all by default), dropping the rows
+# deleted there; the replication retries of those shards are covered by it and removed
+def sync_replicated(shards: list[int] | None = None) -> None:
+    shard_router = router()
+    shards = shards or list(range(1, len(shard_router.engines)))
+    retries = ReplicationRetry.__table__
+    with shard_router.engines[0].connect() as connection:
+        last_retry = connection.scalar(select(func.max(retries.c.id)).where(retries.c.shard.in_(shards)))
+        tables = {table_name: [dict(row) for row in connection.execute(
+            select(db.metadata.tables[table_name])).mappings()] for table_name in REPLICATED_TABLES}
+
+    for engine in [shard_router.engines[shard] for shard in shards]:
+        with engine.begin() as connection:
+            for table_name, rows in tables.items():
+                table = db.metadata.tables[table_name]
+                stale = sorted(set(connection.scalars(select(table.c.id))) - {row["id"] for row in rows})
+                for start in range(0, len(stale), CHUNK):
+                    connection.execute(delete(table).where(table.c.id.in_(stale[start:start + CHUNK])))
+                _upsert(connection, table, rows)
+
+    if last_retry is not None:
+        with shard_router.engines[0].begin() as connection:
+            connection.execute(delete(retries).where(retries.c.shard.in_(shards), retries.c.id <= last_retry))
+
+
+# creates the schema on every shard, brings the copied tables up to date and (Postgres) the library views
+def create_all() -> None:
+    shard_router = router()
+    if shard_router is None:
+        return
+    for shard, engine in enumerate(shard_router.engines[1:], start=1):
+        if shard in shard_router.schemas:
+            with engine.begin() as connection:
+                connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {shard_router.schemas[shard]}"))
+        db.metadata.create_all(engine)
+    sync_replicated()
+    if shard_router.engines[0].dialect.name == "postgresql":
+        shard_router.create_library_views()
+
+
+# {shard: {user id: books}} of the non-admin users
+def loads() -> dict[int, dict[int, int]]:
+    placement = dict(db.session.execute(select(UserShard.user_id, UserShard.shard)).all())
+    users = db.session.scalars(select(User.id).where(User.is_admin == False)).all()
+    result = {shard: {} for shard in shards()}
+    for user_id in users:
+        result[placement.get(user_id, 0)][user_id] = 0
+
+    counts = gather(lambda session: session.execute(select(Books.user_id, func.count(Books.id))
+                                                    .group_by(Books.user_id)).all())
+    for user_id, books in (row for rows in counts for row in rows):
+        shard = placement.get(user_id, 0)
+        if user_id in result[shard]:
+            result[shard][user_id] = books
+    return result
+
+
+"""
+moves (user id, from shard, to shard) that even out the books per shard: each move takes the library from
+the fullest shard that brings it closest to the emptiest one, until no move narrows the gap.
+"""
+def plan_rebalance(loads: dict[int, dict[int, int]], max_moves: int | None = None) -> list[tuple[int, int, int]]:
+    loads = {shard: dict(users) for shard, users in loads.items()}
+    moves = []
+    while len(loads) > 1 and (max_moves is None or len(moves) < max_moves):
+        totals = {shard: sum(users.values()) for shard, users in loads.items()}
+        source = max(totals, key=lambda shard: (totals[shard], -shard))
+        target = min(totals, key=lambda shard: (totals[shard], shard))
+        gap = totals[source] - totals[target]
+        candidates = [(abs(gap - 2 * books), user_id) for user_id, books in loads[source].items() if 0 < books < gap]
+        if not candidates:
+            break
+        _, user_id = min(candidates)
+        loads[target][user_id] = loads[source].pop(user_id)
+        moves.append((user_id, source, target))
+    return moves
+
+
+# genre stored on a copy: only what differs from its work's genre (NULL shows the work's)
+def _own_genre(genre: str | None, work_genre: str | None) -> str | None:
+    return genre if genre and genre != work_genre else None
+
+
+"""
+moves one user's books and reading history to another shard: copies them (books keep their ids, works are
+matched by title and author in the target catalog), points user_shards at the new shard, then deletes the
+old copy. the profile is rebuilt on first use. writes the user makes during the move can be lost, so move
+users in a maintenance window. returns the number of books moved.
+"""
+def move_user(user_id: int, target: int) -> int:
+    from cache import bump_versions, user_scope
+
+    shard_router = router()
+    source = shard_for(user_id)
+    if target not in shards():
+        raise ValueError(f"unknown shard {target}")
+    if source == target:
+        return 0
+
+    tables = db.metadata.tables
+    books, works = tables["user_books"], tables["works"]
+    with shard_router.engines[source].connect() as source_connection, \
+            shard_router.engines[target].begin() as connection:
+        # leftovers of an interrupted move
+        for table_name in USER_TABLES:
+            connection.execute(delete(tables[table_name]).where(tables[table_name].c.user_id == user_id))
+
+        rows = source_connection.execute(
+            select(books.c.id, books.c.work_id, books.c.reading_status, books.c.genre.label("own_genre"),
+                   works.c.title_key, works.c.author_key, works.c.title, works.c.author, works.c.genre)
+            .join(works, works.c.id == books.c.work_id).where(books.c.user_id == user_id)
+        ).all()
+        target_works = {}
+        for row in rows:
+            if row.work_id in target_works:
+                continue
+            work = connection.execute(select(works.c.id, works.c.genre).where(
+                works.c.title_key == row.title_key, works.c.author_key == row.author_key)).first()
+            if work is None:
+                work_id = allocate_ids(connection, target, "works", 1)
+                connection.execute(insert(works).values(id=work_id, title_key=row.title_key,
+                                                        author_key=row.author_key, title=row.title,
+                                                        author=row.author, genre=row.genre))
+                work = (work_id, row.genre)
+            target_works[row.work_id] = tuple(work)
+        if rows:
+            # the copy keeps the genre it showed before, even where the target's work is genred differently
+            connection.execute(insert(books), [
+                {"id": row.id, "user_id": user_id, "work_id": target_works[row.work_id][0],
+                 "reading_status": row.reading_status,
+                 "genre": _own_genre(row.own_genre or row.genre, target_works[row.work_id][1])}
+                for row in rows])
+
+        events = tables["reading_events"]
+        copied = [dict(row) for row in source_connection.execute(
+            select(events).where(events.c.user_id == user_id)).mappings()]
+        if copied:
+            first = allocate_ids(connection, target, "reading_events", len(copied))
+            for offset, row in enumerate(copied):
+                row["id"] = first + offset
+            connection.execute(insert(events), copied)
+
+        # rollups are upserted on their (period, period_start, user_id) key, so their ids are the shard's own
+        rollups = tables["reading_rollups"]
+        copied = [{key: value for key, value in row.items() if key != "id"} for row in source_connection.execute(
+            select(rollups).where(rollups.c.user_id == user_id)).mappings()]
+        if copied:
+            connection.execute(insert(rollups), copied)
+
+    placement = db.session.get(UserShard, user_id)
+    if placement is None:
+        db.session.add(UserShard(user_id=user_id, shard=target))
+    else:
+        placement.shard = target
+    bump_versions(user_scope(user_id))
+    db.session.commit()
+    g.setdefault("user_shards", {})[user_id] = target
+
+    with shard_router.engines[source].begin() as connection:
+        for table_name in USER_TABLES:
+            connection.execute(delete(tables[table_name]).where(tables[table_name].c.user_id == user_id))
+    return len(rows)
+
+
+shards_cli = AppGroup("shards", help="Inspect and rebalance the user shards (DB_SHARDS).")
+
+
+def _require_shards() -> None:
+    if not enabled():
+        raise click.ClickException("sharding is not configured (DB_SHARDS is empty)")
+
+
+@shards_cli.command("status")
+def status():
+    """Users and books per shard."""
+    _require_shards()
+    for shard, users in loads().items():
+        click.echo(f"shard {shard}: {len(users)} users, {sum(users.values())} books")
+
+
+@shards_cli.command("move")
+@click.argument("user_id", type=int)
+@click.argument("shard", type=int)
+def move(user_id, shard):
+    """Move one user's library to SHARD."""
+    _require_shards()
+    click.echo(f"moved {move_user(user_id, shard)} books of user {user_id} to shard {shard}")
+
+
+@shards_cli.command("rebalance")
+@click.option("--dry-run", is_flag=True, help="Only print the planned moves.")
+@click.option("--max-moves", type=int, default=None, help="Stop after this many moves.")
+def rebalance(dry_run, max_moves):
+    """Move libraries from the fullest shards to the emptiest ones."""
+    _require_shards()
+    moves = plan_rebalance(loads(), max_moves=max_moves)
+    for user_id, source, target in moves:
+        if dry_run:
+            click.echo(f"user {user_id}: shard {source} -> {target}")
+        else:
+            click.echo(f"user {user_id}: shard {source} -> {target}, {move_user(user_id, target)} books")
+    click.echo(f"{len(moves)} moves" + (" planned" if dry_run else ""))
+
+
+@shards_cli.command("sync")
+def sync():
+    """Copy users and book_metadata from shard 0 to every other shard again (clears the retry backlog)."""
+    _require_shards()
+    sync_replicated()
+    click.echo("Shards are in sync.")
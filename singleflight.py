@@ -0,0 +1,203 @@
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from functools import wraps
+from flask import current_app, has_app_context
+from cancellation import Cancelled
+
+try:
+    import fcntl
+except ImportError:    # Windows: coalescing stays within one process
+    fcntl = None
+
+
+_MISSING = object()
+PRUNE_EVERY = 200
+
+
+# the argument holding the user's question; it is the only one normalized for the key
+QUESTION_ARGUMENT = "user_question"
+
+
+def _encode(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    return str(value)
+
+
+"""
+key of a call: the question is lower-cased and whitespace-collapsed, so trivially different questions
+share a key; every other argument (rows, book lists, profiles) is kept exactly as given, with sets in a
+fixed order, so distinct inputs never share a key and equal inputs always do.
+"""
+def call_key(name: str, arguments: dict) -> str:
+    arguments = dict(arguments)
+    if isinstance(arguments.get(QUESTION_ARGUMENT), str):
+        arguments[QUESTION_ARGUMENT] = " ".join(arguments[QUESTION_ARGUMENT].lower().split())
+    return name + ":" + json.dumps(arguments, sort_keys=True, default=_encode)
+
+
+"""
+single-flight execution: concurrent calls with the same key share one upstream call.
+- threads of one worker wait on the leader's Future
+- other gunicorn workers wait on a per-key lock file, then read the leader's result file
+results must be JSON-serializable to be shared across workers. they can hold users' book data,
+so the lock directory is only accessible to the app's own user (0700) and result files are 0600.
+"""
+class SingleFlight:
+    def __init__(self, lock_dir: str | None = None):
+        self.lock_dir = lock_dir
+        self.counts = Counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._dir_ready = False
+
+    def do(self, key: str, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not is_leader:
+            self._count("coalesced_in_worker")
+            try:
+                return future.result()
+            except Cancelled:
+                # the leader's client went away, but this caller still wants the answer
+                return self.do(key, fn)
+
+        try:
+            result = self._run_across_workers(key, fn)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def _run_across_workers(self, key: str, fn):
+        if not self.lock_dir or fcntl is None:
+            self._count("executed")
+            return fn()
+
+        self._ensure_dir()
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        lock_path = os.path.join(self.lock_dir, digest + ".lock")
+        result_path = os.path.join(self.lock_dir, digest + ".json")
+        waiting_since = time.time()
+
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            os.utime(lock_path)    # keeps a lock in use from being pruned
+            try:
+                # another worker finished the same call while we were waiting for the lock
+                result = self._read_result(result_path, waiting_since)
+                if result is not _MISSING:
+                    self._count("coalesced_across_workers")
+                    return result
+
+                self._count("executed")
+                result = fn()
+                self._write_result(result_path, result)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        if self.counts["executed"] % PRUNE_EVERY == 0:
+            self._prune()
+        return result
+
+    # created on first use, so an app that never calls the LLM leaves nothing behind
+    def _ensure_dir(self) -> None:
+        if not self._dir_ready:
+            os.makedirs(self.lock_dir, mode=0o700, exist_ok=True)
+            os.chmod(self.lock_dir, 0o700)    # makedirs leaves an existing directory (and the umask) alone
+            self._dir_ready = True
+
+    # result files are only read by callers that were already waiting, so old ones can go
+    def _prune(self, max_age: float = 3600) -> None:
+        cutoff = time.time() - max_age
+        for entry in os.scandir(self.lock_dir):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_result(result_path: str, not_before: float):
+        try:
+            if os.path.getmtime(result_path) < not_before:
+                return _MISSING
+            with open(result_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return _MISSING
+
+    @staticmethod
+    def _write_result(result_path: str, result) -> None:
+        try:
+            payload = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return    # not shareable across workers, followers will call upstream themselves
+
+        tmp_path = f"{result_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, result_path)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        saved = counts.get("coalesced_in_worker", 0) + counts.get("coalesced_across_workers", 0)
+        return {
+            "executed": counts.get("executed", 0),
+            "coalesced_in_worker": counts.get("coalesced_in_worker", 0),
+            "coalesced_across_workers": counts.get("coalesced_across_workers", 0),
+            "saved_calls": saved,
+        }
+
+
+_process_flights = SingleFlight()    # in-process coalescing for calls made outside an app
+
+
+"""
+one SingleFlight per app, shared by all of its coalesced functions; result files go to SINGLEFLIGHT_DIR
+(default <instance>/singleflight, "" disables cross-worker coalescing).
+"""
+def init_app(app) -> None:
+    lock_dir = app.config.get("SINGLEFLIGHT_DIR",
+                              os.getenv("SINGLEFLIGHT_DIR", os.path.join(app.instance_path, "singleflight")))
+    app.extensions["singleflight"] = SingleFlight(lock_dir or None)
+
+
+def flights() -> SingleFlight:
+    if has_app_context() and "singleflight" in current_app.extensions:
+        return current_app.extensions["singleflight"]
+    return _process_flights
+
+
+# decorator: identical concurrent calls (same function, same arguments, same question) run once
+def coalesced(func):
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return flights().do(call_key(func.__name__, bound.arguments), lambda: func(*args, **kwargs))
+
+    return decorated_function
@@ -0,0 +1,424 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+from app_factory import db, User, Books, Work, AnalyticsSketch, SketchDelta, book_genre, catalog_key
+from database import run_write
+import sharding
+
+
+"""
+approximate library analytics in fixed memory, for libraries too large to scan on every insights request.
+- HeavyHitters: a Count-Min sketch plus a bounded set of candidates, for top genres/authors/titles/readers.
+  counts are over-estimates by at most `error_bound()` with probability `confidence()`
+- HyperLogLog: distinct readers and titles with a relative error of about 1.04 / sqrt(2 ** precision).
+  it only ever grows, so readers and titles that were deleted are still counted
+the sketches are built by `flask migrate` and stored in analytics_sketches. book writes only append
+sketch_deltas rows on their own shard; a background job folds them into the stored sketches and the
+metrics add the ones not folded yet (a backlog longer than REPLAY_LIMIT is folded by the read first).
+"""
+COUNT_WIDTH = 2048
+COUNT_DEPTH = 4
+CANDIDATES = 64
+HLL_PRECISION = 12
+FOLDED = "folded"    # analytics_sketches row with the last folded delta id per shard
+FORMAT = "format"    # analytics_sketches row with the FORMAT_VERSION the sketches were built with
+FORMAT_VERSION = b"2"    # 2: distinct titles are catalog keys, work ids differ between shards
+FOLD_BATCH = 10_000
+REPLAY_LIMIT = 1_000    # pending deltas per shard a read adds by itself; a longer backlog is folded first
+
+
+def _hash(item: str, size: int) -> int:
+    return int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=size).digest(), "big")
+
+
+class HeavyHitters:
+    def __init__(self, width: int = COUNT_WIDTH, depth: int = COUNT_DEPTH, capacity: int = CANDIDATES):
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity
+        self.total = 0
+        self.counters = array("i", bytes(4 * width * depth))
+        self.candidates = {}    # item -> estimated count, the items that can be reported as top
+
+    def _cells(self, item: str) -> list[int]:
+        digest = _hash(item, 16)
+        h1, h2 = digest >> 64, (digest & (2 ** 64 - 1)) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    # `count` may be negative when books are removed
+    def add(self, item: str, count: int = 1) -> None:
+        cells = self._cells(item)
+        for cell in cells:
+            self.counters[cell] += count
+        self.total += count
+
+        estimate = min(self.counters[cell] for cell in cells)
+        if estimate <= 0:
+            self.candidates.pop(item, None)
+        elif item in self.candidates or len(self.candidates) < self.capacity:
+            self.candidates[item] = estimate
+        else:
+            smallest = min(self.candidates, key=self.candidates.get)
+            if estimate > self.candidates[smallest]:
+                del self.candidates[smallest]
+                self.candidates[item] = estimate
+
+    def estimate(self, item: str) -> int:
+        return max(0, min(self.counters[cell] for cell in self._cells(item)))
+
+    def top(self, k: int) -> list[tuple[str, int]]:
+        estimates = [(item, self.estimate(item)) for item in self.candidates]
+        return sorted(estimates, key=lambda pair: (-pair[1], pair[0]))[:k]
+
+    def error_bound(self) -> int:
+        return math.ceil(math.e / self.width * self.total)
+
+    def confidence(self) -> float:
+        return round(1 - math.exp(-self.depth), 3)
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps({"width": self.width, "depth": self.depth, "capacity": self.capacity,
+                             "total": self.total, "candidates": self.candidates}).encode("utf-8")
+        return zlib.compress(len(header).to_bytes(4, "big") + header + self.counters.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HeavyHitters":
+        raw = zlib.decompress(data)
+        size = int.from_bytes(raw[:4], "big")
+        header = json.loads(raw[4:4 + size])
+        sketch = cls(header["width"], header["depth"], header["capacity"])
+        sketch.total = header["total"]
+        sketch.candidates = header["candidates"]
+        sketch.counters = array("i")
+        sketch.counters.frombytes(raw[4 + size:])
+        return sketch
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item: str) -> None:
+        digest = _hash(item, 8)
+        index = digest >> (64 - self.precision)
+        rest = (digest << self.precision) & (2 ** 64 - 1)
+        rank = 64 - rest.bit_length() + 1 if rest else 64 - self.precision + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)    # small cardinalities: linear counting is more accurate
+        return round(estimate)
+
+    def relative_error(self) -> float:
+        return round(1.04 / math.sqrt(len(self.registers)), 4)
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(bytes([self.precision]) + bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        raw = zlib.decompress(data)
+        sketch = cls(raw[0])
+        sketch.registers = bytearray(raw[1:])
+        return sketch
+
+
+# what each sketch counts, as a column of a book row
+HEAVY_HITTERS = {
+    "genres": book_genre(),
+    "authors": Work.author,
+    "titles": Work.title,
+    "statuses": Books.reading_status,
+    "readers": Books.user_id,
+}
+DISTINCT = {
+    "distinct_readers": Books.user_id,
+    "distinct_titles": Work.title_key + "\n" + Work.author_key,    # the same book has a work on every shard
+}
+
+
+def _new(name: str):
+    return HeavyHitters() if name in HEAVY_HITTERS else HyperLogLog()
+
+
+def _decode(name: str, data: bytes):
+    return HeavyHitters.from_bytes(data) if name in HEAVY_HITTERS else HyperLogLog.from_bytes(data)
+
+
+"""
+stored sketches by name and the last delta id folded into them per shard, None when they have not been built.
+for_update locks them, which only the fold and the rebuild do.
+"""
+def load(for_update: bool = False) -> tuple[dict, dict[int, int]] | None:
+    query = select(AnalyticsSketch)
+    if for_update:
+        query = query.with_for_update()
+    rows = {row.name: row.data for row in db.session.scalars(query)}
+    if not rows:
+        return None
+    sketches = {name: _decode(name, rows[name]) if name in rows else _new(name)
+                for name in [*HEAVY_HITTERS, *DISTINCT]}
+    folded = {int(shard): delta_id for shard, delta_id in json.loads(rows.get(FOLDED, b"{}")).items()}
+    return sketches, folded
+
+
+def save(sketches: dict, folded: dict[int, int]) -> None:
+    for name, sketch in sketches.items():
+        db.session.merge(AnalyticsSketch(name=name, data=sketch.to_bytes()))
+    db.session.merge(AnalyticsSketch(name=FOLDED, data=json.dumps(folded).encode("utf-8")))
+    db.session.merge(AnalyticsSketch(name=FORMAT, data=FORMAT_VERSION))
+
+
+# the values a book contributes to each sketch; taken before an edit and passed to book_changed afterwards
+def book_values(book: Books) -> dict:
+    return {"genres": book.genre, "authors": book.author, "titles": book.title, "statuses": book.reading_status,
+            "readers": book.user_id, "distinct_readers": book.user_id,
+            "distinct_titles": f"{catalog_key(book.title)}\n{catalog_key(book.author)}"}
+
+
+# appends the change as delta rows on the current shard; a write never reads or locks the stored sketches
+def _apply(counts: dict[str, Counter], distinct: dict[str, set]) -> None:
+    rows = [{"sketch": name, "item": str(item), "count": count}
+            for name, counter in counts.items() for item, count in counter.items() if count]
+    rows += [{"sketch": name, "item": str(item), "count": 1} for name, items in distinct.items() for item in items]
+    if not rows:
+        return
+    db.session.execute(insert(SketchDelta.__table__), rows)    # Core insert: ORM bulk inserts skip the shard routing
+
+    folder = current_app.extensions.get("sketch_folder")
+    if folder is not None:
+        folder.start()
+
+
+def _add(sketches: dict, rows) -> None:
+    for _, name, item, count in rows:
+        if name in HEAVY_HITTERS:
+            sketches[name].add(item, count)
+        else:
+            sketches[name].add(item)
+
+
+def _deltas(after: int, limit: int | None = None):
+    query = select(SketchDelta.id, SketchDelta.sketch, SketchDelta.item, SketchDelta.count) \
+        .where(SketchDelta.id > after).order_by(SketchDelta.id)
+    return db.session.execute(query.limit(limit) if limit else query).all()
+
+
+def _admins(user_ids) -> set[int]:
+    return set(db.session.scalars(select(User.id).where(User.id.in_(set(user_ids)), User.is_admin == True)))
+
+
+def book_added(book: Books) -> None:
+    books_added([book])
+
+
+# several new books, applied to the sketches at once
+def books_added(books: list[Books]) -> None:
+    admins = _admins(book.user_id for book in books)
+    counts = {name: Counter() for name in HEAVY_HITTERS}
+    distinct = {name: set() for name in DISTINCT}
+    for book in books:
+        if book.user_id in admins:
+            continue
+        values = book_values(book)
+        for name in HEAVY_HITTERS:
+            counts[name][values[name]] += 1
+        for name in DISTINCT:
+            distinct[name].add(values[name])
+    _apply(counts, distinct)
+
+
+def book_changed(old_values: dict, book: Books) -> None:
+    books_changed([(old_values, book)])
+
+
+# several edits as (book_values() before the edit, edited book) pairs
+def books_changed(changes: list[tuple[dict, Books]]) -> None:
+    admins = _admins(book.user_id for _, book in changes)
+    counts = {name: Counter() for name in HEAVY_HITTERS}
+    distinct = {name: set() for name in DISTINCT}
+    for old_values, book in changes:
+        new_values = book_values(book)
+        if new_values == old_values or book.user_id in admins:
+            continue
+        for name in HEAVY_HITTERS:
+            counts[name][new_values[name]] += 1
+            counts[name][old_values[name]] -= 1
+        for name in DISTINCT:
+            distinct[name].add(new_values[name])
+    _apply(counts, distinct)
+
+
+# removes every book matching `where` (a condition on Books); call it before the DELETE
+def books_deleted(where) -> None:
+    counts = {}
+    for name, column in HEAVY_HITTERS.items():
+        rows = db.session.execute(
+            select(column, func.count(Books.id)).select_from(Books).join(Work).join(User)
+            .where(where, User.is_admin == False).group_by(column)
+        ).all()
+        counts[name] = Counter({value: -count for value, count in rows})
+    _apply(counts, {})
+
+
+# every sketch from a scan of the non-admin books of every shard, with the delta ids that scan already covers
+def _build() -> tuple[dict, dict[int, int]]:
+    sketches = {name: _new(name) for name in [*HEAVY_HITTERS, *DISTINCT]}
+    folded = {}
+    books = select(Books).join(Work).join(User).where(User.is_admin == False)
+
+    for shard in sharding.shards():
+        with sharding.use(shard):
+            folded[shard] = db.session.scalar(select(func.max(SketchDelta.id))) or 0
+            for name, column in HEAVY_HITTERS.items():
+                rows = db.session.execute(
+                    select(column, func.count(Books.id)).select_from(Books).join(Work).join(User)
+                    .where(User.is_admin == False).group_by(column)
+                )
+                for value, count in rows:
+                    sketches[name].add(str(value), count)
+
+            for name, column in DISTINCT.items():
+                for (value,) in db.session.execute(books.with_only_columns(column).distinct()).yield_per(10_000):
+                    sketches[name].add(str(value))
+    return sketches, folded
+
+
+# builds every sketch from the tables, replacing what is stored
+def rebuild() -> dict:
+    sketches, folded = _build()
+    save(sketches, folded)
+    return sketches
+
+
+# run by `flask migrate` (and the auto-migration at boot): builds the sketches once, so no request has to,
+# and again when they were built in an older format
+def ensure_built() -> None:
+    if db.session.scalar(select(AnalyticsSketch.data).where(AnalyticsSketch.name == FORMAT)) != FORMAT_VERSION:
+        rebuild()
+        db.session.commit()
+
+
+"""
+write job that folds the pending deltas of every shard into the stored sketches and returns how many it folded.
+deltas are pruned one fold later, once the ids that covered them are committed on shard 0, so a fold that
+commits on some shards only never loses or double-counts a delta.
+"""
+def fold(limit: int = FOLD_BATCH) -> int:
+    stored = load(for_update=True)
+    if stored is None:
+        return 0    # ensure_built() covers every delta written so far
+    sketches, folded = stored
+
+    count = 0
+    for shard in sharding.shards():
+        with sharding.use(shard):
+            db.session.execute(delete(SketchDelta).where(SketchDelta.id <= folded.get(shard, 0)))
+            rows = _deltas(folded.get(shard, 0), limit)
+            if rows:
+                _add(sketches, rows)
+                folded[shard] = rows[-1][0]
+                count += len(rows)
+    if count:
+        save(sketches, folded)
+    return count
+
+
+# folds the deltas in the background every `interval` seconds, started by the first delta
+class SketchFolder:
+    def __init__(self, app, interval: float):
+        self.app = app
+        self.interval = interval
+        self.folded = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sketch-folder", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    while (folded := run_write(fold)) >= FOLD_BATCH:
+                        self.folded += folded
+                    self.folded += folded
+                except Exception as e:
+                    db.session.rollback()
+                    print("Sketch fold error:", repr(e))
+                finally:
+                    db.session.remove()
+
+
+# SKETCH_FOLD_INTERVAL=0 turns the background fold off (a read then folds the backlog once it passes REPLAY_LIMIT)
+def init_app(app) -> None:
+    interval = float(app.config.get("SKETCH_FOLD_INTERVAL", os.getenv("SKETCH_FOLD_INTERVAL", 60)))
+    if interval > 0:
+        app.extensions["sketch_folder"] = SketchFolder(app, interval)
+
+
+# the deltas not folded yet, per shard, at most REPLAY_LIMIT + 1 of each
+def _pending(folded: dict[int, int]) -> list:
+    pending = []
+    for shard in sharding.shards():
+        with sharding.use(shard):
+            pending.append(_deltas(folded.get(shard, 0), REPLAY_LIMIT + 1))
+    return pending
+
+
+# approximate counterpart of routes.compute_library_metrics, reading only the sketches
+def library_metrics(top: int = 8) -> dict:
+    stored = load()
+    # not built yet (DB_AUTO_MIGRATE=0 and no `flask migrate`): computed from the tables, stored by nothing
+    sketches, folded = stored if stored is not None else _build()
+    pending = _pending(folded)
+    if stored is not None and any(len(rows) > REPLAY_LIMIT for rows in pending):
+        # too much to replay on every read (no background fold, or it fell behind): folded once for every reader
+        while run_write(fold) >= FOLD_BATCH:
+            pass
+        sketches, folded = load()
+        pending = _pending(folded)
+    for rows in pending:
+        _add(sketches, rows[:REPLAY_LIMIT])
+
+    genres, readers, statuses = sketches["genres"], sketches["readers"], sketches["statuses"]
+    top_readers = readers.top(1)
+    top_user = db.session.get(User, int(top_readers[0][0])) if top_readers else None
+    top_genres = genres.top(top)
+
+    return {
+        "scope": "library",
+        "approximate": True,
+        "totals": {"readers": sketches["distinct_readers"].count(), "books": genres.total,
+                   "titles": sketches["distinct_titles"].count()},
+        "top_user": {"name": top_user.name, "count": top_readers[0][1]} if top_user else None,
+        "top_genre": {"genre": top_genres[0][0], "count": top_genres[0][1]} if top_genres else None,
+        "status_breakdown": dict(statuses.top(top)),
+        "top_genres": top_genres,
+        "top_authors": sketches["authors"].top(top),
+        "top_titles": sketches["titles"].top(top),
+        "error": {
+            "count_error": genres.error_bound(),
+            "count_confidence": genres.confidence(),
+            "distinct_relative_error": sketches["distinct_readers"].relative_error(),
+            "stored_bytes": sum(len(sketch.to_bytes()) for sketch in sketches.values()),
+        },
+    }
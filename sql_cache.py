@@ -0,0 +1,111 @@
+import hashlib
+import os
+import pickle
+import re
+import threading
+from flask import current_app
+from sqlalchemy import text
+from cache import LRUCache, LIBRARY_SCOPE, read_versions, user_scope
+from database import execute_cancellable
+import chat_log
+import sharding
+
+
+"""
+shared result cache for the read-only SQL generated by the AI chat.
+identical questions from different users often produce identical SQL ("most popular genre overall"),
+and the rows of a query depend only on its text and the data, so one cached result serves everyone.
+the key is the normalized SQL plus the versions of the scopes the query reads:
+- a query that reads one per-user table filtered to one user (`user_id = 5`: a single SELECT, no OR, no
+  negation, nothing from users or the catalog) depends on user:5 only, so other users' writes leave it cached
+- anything else reads the library scope, which every write bumps
+the versions are read through the same session as the rows (the replica when there is one), so a cached
+result is never newer or older than the versions it is stored under.
+results over SQL_CACHE_MAX_ROWS rows or SQL_CACHE_MAX_ENTRY_BYTES bytes are not cached.
+with DB_SHARDS the key also names what the session reads (a shard, or the whole library for admins).
+"""
+_LITERAL = re.compile(r"('(?:[^']|'')*')")
+_USER_FILTER = re.compile(r"\buser_id\s*=\s*(\d+)\b")
+_TABLE = re.compile(r"\b(?:from|join)\s+(\w+)")
+_FROM_CLAUSE = re.compile(r"\bfrom\b(.*?)(?:\bwhere\b|\bgroup\b|\border\b|\blimit\b|$)")
+_WIDENING = re.compile(r"\bnot\b|<>|!=|\busers\b")
+# tables whose rows all belong to one user, so `user_id = 5` covers everything read from them
+PER_USER_TABLES = {"books", "user_books", "reading_events", "reading_rollups", "reader_profiles"}
+
+
+# lower-cased, whitespace collapsed and trailing semicolons dropped, string literals left as they are
+def normalize_sql(sql: str) -> str:
+    parts = _LITERAL.split(sql.strip().rstrip(";").strip())
+    return "".join(part if index % 2 else re.sub(r"\s+", " ", part.lower())
+                   for index, part in enumerate(parts)).strip()
+
+
+# the user scope only when the query provably reads one user's rows, the library scope otherwise
+def scopes_for(normalized_sql: str) -> list[str]:
+    code = _LITERAL.sub("''", normalized_sql)
+    user_ids = set(_USER_FILTER.findall(code))
+    tables = _TABLE.findall(code)
+    from_clause = _FROM_CLAUSE.search(code)
+    if (len(user_ids) != 1 or code.count("select") != 1 or " or " in code or _WIDENING.search(code)
+            or len(tables) != 1 or tables[0] not in PER_USER_TABLES or "," in from_clause.group(1)):
+        return [LIBRARY_SCOPE]
+    return [user_scope(int(user_ids.pop()))]
+
+
+class SQLResultCache:
+    def __init__(self, max_rows: int, max_entry_bytes: int, max_bytes: int, max_entries: int):
+        self.max_rows = max_rows
+        self.max_entry_bytes = max_entry_bytes
+        self.results = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.too_large = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "SQLResultCache":
+        def setting(name, default):
+            return int(config.get(name, os.getenv(name, default)))
+
+        return cls(max_rows=setting("SQL_CACHE_MAX_ROWS", 1000),
+                   max_entry_bytes=setting("SQL_CACHE_MAX_ENTRY_BYTES", 256 * 1024),
+                   max_bytes=setting("SQL_CACHE_BYTES", 16 * 1024 * 1024),
+                   max_entries=setting("SQL_CACHE_SIZE", 1024))
+
+    # rows of `sql` as dicts, from the cache while the scopes it reads are unchanged
+    def execute(self, session, sql: str) -> list[dict]:
+        normalized = normalize_sql(sql)
+        scopes = scopes_for(normalized)
+        versions = read_versions(scopes, session)
+        stamp = "|".join(f"{scope}={versions.get(scope, 0)}" for scope in scopes)
+        if source := sharding.source(session):
+            stamp += f"|{source}"    # the same SQL reads different rows on another shard
+        key = hashlib.sha256(f"{normalized}\n{stamp}".encode("utf-8")).hexdigest()
+
+        cached = self.results.get(key)
+        chat_log.cache_status("sql", cached is not None)
+        if cached is not None:
+            return pickle.loads(cached)
+
+        rows = [dict(row._mapping) for row in execute_cancellable(session, text(sql))]
+        data = pickle.dumps(rows) if len(rows) <= self.max_rows else None
+        if data is None or len(data) > self.max_entry_bytes:
+            with self._lock:
+                self.too_large += 1
+        else:
+            self.results.set(key, data)
+        return rows
+
+    def stats(self) -> dict:
+        return {**self.results.stats(), "too_large": self.too_large, "max_rows": self.max_rows,
+                "max_entry_bytes": self.max_entry_bytes}
+
+
+def init_app(app) -> None:
+    app.extensions["sql_cache"] = SQLResultCache.from_config(app.config)
+
+
+def execute(session, sql: str) -> list[dict]:
+    return current_app.extensions["sql_cache"].execute(session, sql)
+
+
+def stats() -> dict:
+    return current_app.extensions["sql_cache"].stats()
@@ -1,5 +1,8 @@
 let chatOpen = false;
 
+// the chat request still waiting for a reply, so it can be aborted when it is no longer wanted
+let pendingChat = null;
+
 // opens/closes the chatbot panel
 
 function toggleChat() {
@@ -7,6 +10,11 @@ function toggleChat() {
   chatOpen = !chatOpen;
   panel.style.display = chatOpen ? "flex" : "none";
 
+  // nobody will read the answer of a closed panel
+  if (!chatOpen) {
+    cancelPendingChat();
+  }
+
   // focuses the input for faster typing when opening
   if (chatOpen) {
     const input = document.getElementById("chatbot-input");
@@ -35,6 +43,23 @@ function appendMessage(text, who) {
 }
 
 
+// aborts the pending request and tells the server to stop working on it
+function cancelPendingChat() {
+  if (!pendingChat) return;
+
+  pendingChat.controller.abort();
+  const body = new Blob([JSON.stringify({ request_id: pendingChat.id })], { type: "application/json" });
+  navigator.sendBeacon("/ai-chat/cancel", body);
+  pendingChat = null;
+}
+
+
+function newRequestId() {
+  if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+  return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2);
+}
+
+
 // sends the user's message to the backend (/ai-chat) and displays the reply
 async function sendChat() {
   const input = document.getElementById("chatbot-input");
@@ -46,13 +71,26 @@ async function sendChat() {
   appendMessage(text, "user");
   input.value = "";
 
+  // a new message supersedes the one still waiting for its reply
+  cancelPendingChat();
+  const chat = { id: newRequestId(), controller: new AbortController() };
+  pendingChat = chat;
+
   try {
     const res = await fetch("/ai-chat", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ message: text })
+      body: JSON.stringify({ message: text, request_id: chat.id }),
+      signal: chat.controller.signal
     });
 
+    // too many questions at once: the server explains and says when to retry
+    if (res.status === 429) {
+      const data = await res.json();
+      appendMessage(data.reply, "bot");
+      return;
+    }
+
     // non-200 response: shows status code/text for debugging
     if (!res.ok) {
       const errText = await res.text();
@@ -66,11 +104,17 @@ async function sendChat() {
     const reply = data.reply || "Sorry, something went wrong.";
     appendMessage(reply, "bot");
   } catch (err) {
+    if (err.name === "AbortError") return; // cancelled on purpose
     console.error(err);
     appendMessage("Network error. Please try again.", "bot");
+  } finally {
+    if (pendingChat === chat) pendingChat = null;
   }
 }
 
+// leaving the page abandons the pending question too
+window.addEventListener("pagehide", cancelPendingChat);
+
 // sends message when enter is pressed while the chatbot input is focused
 document.addEventListener("keydown", function (e) {
   if (
@@ -6,7 +6,7 @@ from app_factory import create_app, db, User, Books
 
 
 @pytest.fixture
-def client():
+def client(tmp_path):
     # creates a temporary DB file path for each test run
     db_fd, db_path = tempfile.mkstemp()
     os.close(db_fd) # closes the OS-level file descriptor; SQLite will open it itself
@@ -15,6 +15,12 @@ def client():
         "TESTING": True,             # enables Flask testing mode
         "WTF_CSRF_ENABLED": False,   # disable CSRF for form posts in tests
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path,
+        "LLM_PROVIDER": "fake",      # deterministic offline LLM, tests never call OpenAI
+        "METADATA_SOURCE": "",       # no background web lookups for book metadata
+        "WEB_CACHE_PATH": str(tmp_path / "web_cache.db"),    # a fresh web cache per test
+        "SINGLEFLIGHT_DIR": "",      # coalesce LLM calls in-process only, no result files on disk
+        "SKETCH_FOLD_INTERVAL": 0,   # tests fold the analytics sketches themselves
+        "CHAT_LOG_PATH": "",         # no chat log written into the instance folder
     })
 
     # safety check that ensures tests never touch the real database
@@ -1,5 +1,32 @@
 import json
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import pytest
+from flask import g
+from sqlalchemy import inspect, text
+from werkzeug.security import generate_password_hash
+from app_factory import create_app, db, User, Books, Work, ReadingEvent, ReadingRollup, AnalyticsSketch, SketchDelta, \
+    BookMetadata
+from passwords import hash_method, needs_rehash
+from llm import get_provider
+import reading_log
+import sql_cache
+import profiles
+import sharding
+import sketches
+import profiler
+import chat_log
+import warmup
+from metadata import EnrichmentWorker, FileMetadataSource, answer_from_metadata, enrich, metadata_key
 from conftest import login
+from routes import compute_library_metrics
+from admission import AdmissionController
+from cancellation import CancelToken, Cancelled
+from database import execute_cancellable, run_write
 
 
 """
@@ -40,3 +67,784 @@ def test_ai_chat_returns_json(client):
     assert r.status_code == 200
     data = r.get_json()
     assert "reply" in data
+
+
+# repeat views of an unchanged page are answered with 304 using the ETag from the first response
+def test_admin_books_returns_304_for_matching_etag(client):
+    login(client, "admin@test.com", "adminpass")
+    first = client.get("/admin/books")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    second = client.get("/admin/books", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+
+
+# adding a book bumps the user's version, so the home page ETag changes and the new book shows up
+def test_home_etag_changes_after_adding_book(client):
+    login(client, "user@test.com", "userpass")
+    etag = client.get("/").headers["ETag"]
+
+    client.post("/books/create", data={"title": "dune", "author": "frank herbert", "genre": "sci-fi",
+                                       "reading_status": "Reading"})
+
+    r = client.get("/", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    assert b"Dune" in r.data
+
+
+# a second view renders the manage-books rows from the fragment cache instead of rebuilding them
+def test_manage_books_rows_come_from_fragment_cache(client):
+    login(client, "admin@test.com", "adminpass")
+    first = client.get("/admin/books")
+    assert b"The Shining" in first.data
+
+    # a different query string is a new page, but the table body fragment is unchanged
+    second = client.get("/admin/books?refresh=1")
+    assert b"The Shining" in second.data
+
+    stats = client.get("/admin/metrics").get_json()["fragment_cache"]
+    assert stats["hits"] >= 1
+
+
+# pool metrics of the primary engine are exposed for monitoring
+def test_admin_metrics_include_pool_stats(client):
+    login(client, "admin@test.com", "adminpass")
+    pools = client.get("/admin/metrics").get_json()["db_pools"]
+    assert {"checked_out", "overflow", "wait_avg_ms"} <= set(pools["primary"].keys())
+
+
+# a page cached by version reads the primary, a lagging replica's copy is never stored under the new version
+def test_version_cached_pages_ignore_lagging_replica(tmp_path):
+    primary, replica = tmp_path / "primary.db", tmp_path / "replica.db"
+    app = create_app({
+        "TESTING": True,
+        "WTF_CSRF_ENABLED": False,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(primary),
+        "DB_REPLICA_URI": "sqlite:///" + str(replica),
+        "LLM_PROVIDER": "fake",
+        "METADATA_SOURCE": "",
+    })
+    with app.app_context():
+        db.session.add(User(name="Admin", email="admin@test.com", password=generate_password_hash("adminpass"),
+                            is_admin=True))
+        db.session.commit()
+        with sqlite3.connect(primary) as source, sqlite3.connect(replica) as target:
+            source.backup(target)    # the replica stops here
+        user = User(name="Dana", email="dana@test.com", password=generate_password_hash("danapass"))
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Books(user_id=user.id, title="Dune", author="Frank Herbert", genre="Sci-Fi",
+                             reading_status="Reading"))
+        db.session.commit()
+
+    with app.test_client() as client:
+        login(client, "admin@test.com", "adminpass")
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+# in SQLite performance mode connections use WAL and book writes go through the single-writer queue,
+# where a profiled request still sees its own statements
+def test_sqlite_performance_mode_uses_wal_and_write_queue(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "WTF_CSRF_ENABLED": False,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "perf.db"),
+        "SQLITE_PERFORMANCE_MODE": True,
+        "METADATA_SOURCE": "",
+        "WEB_CACHE_PATH": str(tmp_path / "web_cache.db"),
+        "PROFILE_DIR": str(tmp_path / "profiles"),
+    })
+
+    with app.app_context():
+        assert db.session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        db.session.add(User(name="Perf", email="perf@test.com", password=generate_password_hash("perfpass"),
+                            is_admin=True))
+        db.session.commit()
+
+    with app.test_client() as client:
+        login(client, "perf@test.com", "perfpass")
+        r = client.post("/books/create?profile=1", data={"title": "dune", "author": "frank herbert",
+                                                         "genre": "sci-fi", "reading_status": "Reading"})
+
+    assert app.extensions["write_queues"][0].stats()["jobs"] == 1
+
+    # metadata enrichment writes through the same queue instead of committing on its own thread
+    records = tmp_path / "metadata.json"
+    records.write_text(json.dumps([{"title": "Dune", "author": "Frank Herbert", "pages": 412}]))
+    with app.app_context():
+        enrich("Dune", "Frank Herbert", FileMetadataSource(str(records)))
+    assert app.extensions["write_queues"][0].stats()["jobs"] == 2
+
+    with app.app_context():
+        assert db.session.scalars(db.select(Work.title)).all() == ["Dune"]
+        assert db.session.scalar(db.select(BookMetadata.pages)) == 412
+        statements = profiler.load_capture(r.headers["X-Profile-Id"])["statements"]
+        assert any(statement["sql"].startswith("INSERT INTO user_books") for statement in statements)
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+# logging in with a hash made under an older policy upgrades it to the current one
+def test_login_rehashes_legacy_password(client):
+    with client.application.app_context():
+        user = db.session.execute(db.select(User).where(User.email == "user@test.com")).scalar()
+        user.password = generate_password_hash("userpass", method="pbkdf2:sha256:1000", salt_length=4)
+        db.session.commit()
+
+    r = login(client, "user@test.com", "userpass")
+    assert b"Library" in r.data
+
+    with client.application.app_context():
+        user = db.session.execute(db.select(User).where(User.email == "user@test.com")).scalar()
+        assert user.password.startswith(hash_method() + "$")
+        assert not needs_rehash(user.password)
+
+
+# SQL questions are answered from the one-shot plan, without a second LLM round trip
+def test_ai_chat_sql_path_uses_one_llm_call(client):
+    login(client, "user@test.com", "userpass")
+    with client.application.app_context():
+        provider = get_provider()
+        calls_before = provider.calls
+
+    r = client.post("/ai-chat", json={"message": "Which books do I have?"})
+    assert "The Shining by Stephen King" in r.get_json()["reply"]
+    assert provider.calls == calls_before + 1
+
+
+# once a book has been enriched, web-style questions about it are answered from book_metadata
+def test_web_question_answered_from_book_metadata(client, tmp_path):
+    records = tmp_path / "metadata.json"
+    records.write_text(json.dumps([{"title": "The Shining", "author": "Stephen King", "pages": 447}]))
+    worker = EnrichmentWorker(client.application, FileMetadataSource(str(records)))
+    client.application.extensions["metadata_worker"] = worker
+
+    login(client, "user@test.com", "userpass")
+    payload = {"message": "How many pages does The Shining have?"}
+
+    with client.application.app_context():
+        assert answer_from_metadata(payload["message"], [{"title": "The Shining", "author": "Stephen King"}]) is None
+    worker.join()
+
+    r = client.post("/ai-chat", json=payload)
+    assert r.get_json()["reply"] == "The Shining has 447 pages."
+
+    # a book the user doesn't own goes to the web, a superlative over their own books is answered locally
+    books = [{"title": "The Shining", "author": "Stephen King"}]
+    with client.application.app_context():
+        assert answer_from_metadata("How many pages is The Hobbit?", books) is None
+        assert answer_from_metadata("Which of my books is the longest?", books) == "The Shining has 447 pages."
+
+
+# a title only counts when the question names all of it, and a longer named title wins over one inside it
+def test_metadata_answers_match_whole_titles(client):
+    books = [{"title": "It", "author": "Stephen King"}, {"title": "Dune", "author": "Frank Herbert"},
+             {"title": "Dune Messiah", "author": "Frank Herbert"}, {"title": "Emma", "author": "Jane Austen"},
+             {"title": "Emma", "author": "Emma Tennant"}]
+    with client.application.app_context():
+        for book, pages in zip(books, (1138, 412, 256, 474, 220)):
+            title_key, author_key = metadata_key(book["title"], book["author"])
+            db.session.add(BookMetadata(title_key=title_key, author_key=author_key, title=book["title"],
+                                        author=book["author"], pages=pages, source="file", fetched_at=time.time()))
+        db.session.commit()
+
+        assert answer_from_metadata("How many pages does the witcher have?", books) is None
+        assert answer_from_metadata("How many pages does Dune Messiah have?", books) == "Dune Messiah has 256 pages."
+        assert answer_from_metadata("How many pages does Dune have?", books) == "Dune has 412 pages."
+        assert answer_from_metadata("How many pages does Emma have?", books) is None    # two different Emmas
+
+
+# an old database with one wide books table is moved onto the works catalog, one work per distinct book
+def test_legacy_books_table_migrates_to_works(tmp_path):
+    db_path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR(100), email VARCHAR(100) UNIQUE,
+                            password VARCHAR(100), is_admin BOOLEAN);
+        CREATE TABLE books (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users(id), author VARCHAR(100),
+                            title VARCHAR(100), genre VARCHAR(100), reading_status VARCHAR(100));
+        INSERT INTO users VALUES (1, 'A', 'a@test.com', 'x', 0), (2, 'B', 'b@test.com', 'x', 0);
+        INSERT INTO books VALUES (7, 1, 'Frank Herbert', 'Dune', 'Sci-Fi', 'Reading'),
+                                 (8, 2, 'frank herbert ', ' dune', 'Science Fiction', 'Completed'),
+                                 (9, 2, 'Stephen King', 'It', 'Horror', 'Reading');
+    """)
+    conn.commit()
+    conn.close()
+
+    app = create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(db_path)})
+    with app.app_context():
+        assert db.session.execute(text("SELECT COUNT(*) FROM works")).scalar() == 2
+        rows = db.session.execute(text("SELECT id, title, genre, work_id FROM books ORDER BY id")).all()
+        assert [(row.id, row.title, row.genre) for row in rows] == [
+            (7, "Dune", "Sci-Fi"), (8, "Dune", "Science Fiction"), (9, "It", "Horror")]
+        assert rows[0].work_id == rows[1].work_id
+
+        # new copies of a known book join the existing work
+        db.session.add(Books(user_id=1, title="DUNE", author="Frank Herbert", genre="Sci-Fi",
+                             reading_status="Reading"))
+        db.session.commit()
+        assert db.session.execute(text("SELECT COUNT(*) FROM works")).scalar() == 2
+        db.engine.dispose()
+
+
+# deleting users is one set-based statement; SQLite foreign keys cascade it to their books
+def test_admin_bulk_delete_users_cascades_to_books(client):
+    login(client, "admin@test.com", "adminpass")
+    with client.application.app_context():
+        assert db.session.execute(text("PRAGMA foreign_keys")).scalar() == 1
+        user_id = db.session.scalar(db.select(User.id).where(User.email == "user@test.com"))
+        admin_id = db.session.scalar(db.select(User.id).where(User.email == "admin@test.com"))
+
+    client.post("/admin/users/delete", data={"user_ids": [user_id, admin_id]})
+
+    with client.application.app_context():
+        assert db.session.scalars(db.select(User.email)).all() == ["admin@test.com"]
+        assert db.session.scalar(db.select(db.func.count(Books.id))) == 0
+
+
+# adding, finishing and deleting a book is logged and rolled up into the library trends;
+# a book added as finished counts as completed, finishing a book again does not count it twice
+def test_reading_events_feed_trend_rollups(client):
+    login(client, "user@test.com", "userpass")
+    client.post("/books/create", data={"title": "dune", "author": "frank herbert", "genre": "sci-fi",
+                                       "reading_status": "Reading"})
+    with client.application.app_context():
+        book_id = db.session.scalar(db.select(Books.id).join(Books.work).where(Work.title == "Dune"))
+
+    client.post(f"/books/{book_id}/edit", data={"title": "Dune", "author": "Frank Herbert", "genre": "Sci-Fi",
+                                                "reading_status": "Completed"})
+    for status in ("Reading", "Completed"):
+        client.post(f"/books/{book_id}/edit", data={"title": "Dune", "author": "Frank Herbert", "genre": "Sci-Fi",
+                                                    "reading_status": status})
+    client.post("/books/create", data={"title": "emma", "author": "jane austen", "genre": "classic",
+                                       "reading_status": "Completed"})
+    client.post(f"/books/{book_id}/delete")
+
+    with client.application.app_context():
+        events = db.session.scalars(db.select(ReadingEvent.event_type).where(ReadingEvent.book_id == book_id)
+                                    .order_by(ReadingEvent.id)).all()
+        assert events == ["added", "status_changed", "status_changed", "status_changed", "deleted"]
+        # every write landed on the same row of each period
+        user_id = db.session.scalar(db.select(User.id).where(User.email == "user@test.com"))
+        rollups = db.session.execute(db.select(ReadingRollup.period, ReadingRollup.added, ReadingRollup.completed,
+                                               ReadingRollup.deleted).where(ReadingRollup.user_id == user_id)).all()
+        assert sorted(rollups) == [("day", 2, 2, 1), ("month", 2, 2, 1), ("week", 2, 2, 1)]
+
+        trends = reading_log.library_trends()
+        assert trends["completed_per_month"][-1][1] == 2
+        assert trends["avg_days_to_complete"] == 0
+        assert trends["active_readers_per_week"][-1][1] == 1
+
+    client.get("/logout")
+    login(client, "admin@test.com", "adminpass")
+    assert b"Reading Trends" in client.get("/admin/insights").data
+
+
+# the approximate library metrics are built from the tables once, then follow every book write through deltas
+def test_approximate_library_metrics_follow_writes(client, monkeypatch):
+    login(client, "admin@test.com", "adminpass")
+    with client.application.app_context():
+        assert compute_library_metrics(approximate=True)["top_genres"] == [("Fantasy", 1), ("Horror", 1)]
+        assert db.session.scalar(db.select(db.func.count()).select_from(AnalyticsSketch)) == 0    # reads never build
+        sketches.ensure_built()
+        user_id = db.session.scalar(db.select(User.id).where(User.email == "user@test.com"))
+        # sketches of an older format are rebuilt by the next migrate
+        db.session.get(AnalyticsSketch, sketches.FORMAT).data = b"1"
+        db.session.commit()
+        sketches.ensure_built()
+        assert db.session.get(AnalyticsSketch, sketches.FORMAT).data == sketches.FORMAT_VERSION
+
+    for title in ("It", "Carrie"):
+        client.post(f"/admin/users/{user_id}/books/add", data={"title": title, "author": "Stephen King",
+                                                                "genre": "Horror", "reading_status": "Reading"})
+
+    with client.application.app_context():
+        metrics = compute_library_metrics(approximate=True)
+        assert metrics["top_genre"] == {"genre": "Horror", "count": 3}
+        assert metrics["totals"] == {"readers": 1, "books": 4, "titles": 4}
+        assert metrics["top_authors"][0] == ("Stephen King", 3)
+        assert metrics["error"]["count_error"] >= 0
+
+        # each book appended 7 deltas; folding them leaves the metrics as they were
+        assert run_write(sketches.fold) == 14
+        assert run_write(sketches.fold) == 0
+        assert db.session.scalar(db.select(db.func.count()).select_from(SketchDelta)) == 0
+        assert compute_library_metrics(approximate=True) == metrics
+
+    r = client.get("/admin/insights?approximate=1")
+    assert b"count_error" in r.data
+
+    # without the background fold, a read folds a backlog it would otherwise replay every time
+    monkeypatch.setattr(sketches, "REPLAY_LIMIT", 5)
+    client.post(f"/admin/users/{user_id}/books/add", data={"title": "Misery", "author": "Stephen King",
+                                                            "genre": "Horror", "reading_status": "Reading"})
+    with client.application.app_context():
+        assert compute_library_metrics(approximate=True)["totals"] == {"readers": 1, "books": 5, "titles": 5}
+        assert run_write(sketches.fold) == 0
+
+
+# ?profile=1 / X-Profile store a capture with the SQL statements and LLM calls, for admins only
+def test_admin_request_profiles(client, tmp_path):
+    client.application.config["PROFILE_DIR"] = str(tmp_path / "profiles")
+
+    login(client, "user@test.com", "userpass")
+    assert "X-Profile-Id" not in client.get("/?profile=1").headers
+    client.get("/logout")
+
+    login(client, "admin@test.com", "adminpass")
+    client.get("/admin/books")    # warms the page cache, which a profiled request bypasses
+    r = client.get("/admin/books?profile=1")
+    capture_id = r.headers["X-Profile-Id"]
+    r = client.post("/ai-chat", json={"message": "what are my books?"}, headers={"X-Profile": "cprofile"})
+    chat_id = r.headers["X-Profile-Id"]
+
+    page = client.get("/admin/profiles").data
+    assert capture_id.encode() in page and chat_id.encode() in page
+
+    capture = client.get(f"/admin/profiles/{capture_id}").data
+    assert b"user_books" in capture and b"Hottest stacks" in capture
+    assert client.get(f"/admin/profiles/{capture_id}/download").status_code == 200
+    assert b"LLM calls" in client.get(f"/admin/profiles/{chat_id}").data
+    assert client.get("/admin/profiles/missing").status_code == 404
+
+
+# one "gunicorn worker": its own app and L1 cache on the shared database, driven through a pipe
+def _cache_worker(conn, db_uri):
+    app = create_app({"TESTING": True, "WTF_CSRF_ENABLED": False, "SQLALCHEMY_DATABASE_URI": db_uri,
+                      "LLM_PROVIDER": "fake", "METADATA_SOURCE": "", "DB_AUTO_MIGRATE": False,
+                      "CACHE_BUS_INTERVAL": 3600})
+    client = app.test_client()
+    while (command := conn.recv())[0] != "stop":
+        name, *args = command
+        if name == "login":
+            login(client, *args)
+        elif name == "add_book":
+            user_id, title = args
+            client.post(f"/admin/users/{user_id}/books/add", data={"title": title, "author": "Stephen King",
+                                                                    "genre": "Horror", "reading_status": "Reading"})
+        elif name == "poll_every_read":
+            app.extensions["cache_bus"].interval = 0
+
+        if name == "library_books":
+            cookie = args[0]
+            headers = {"Cookie": f"session={cookie}"} if cookie else {}
+            with app.test_request_context(headers=headers):
+                conn.send(compute_library_metrics()["totals"]["books"])
+        else:
+            session_cookie = client.get_cookie("session")
+            conn.send(session_cookie.value if session_cookie else None)
+
+
+# writes in one worker process invalidate the L1 caches of the others, and the writer always reads its writes
+def test_l1_cache_coherent_across_worker_processes(client):
+    with client.application.app_context():
+        user_id = db.session.scalar(db.select(User.id).where(User.email == "user@test.com"))
+        db_uri = client.application.config["SQLALCHEMY_DATABASE_URI"]
+
+    context = multiprocessing.get_context("spawn")    # a clean interpreter per worker, like gunicorn without preload
+    workers = []
+    for _ in range(2):
+        parent, child = context.Pipe()
+        process = context.Process(target=_cache_worker, args=(child, db_uri), daemon=True)
+        process.start()
+        workers.append((parent, process))
+
+    def ask(worker, *command):
+        conn = workers[worker][0]
+        conn.send(command)
+        assert conn.poll(60), f"worker {worker} did not answer {command}"
+        return conn.recv()
+
+    try:
+        assert ask(0, "library_books", None) == 2
+        ask(1, "login", "admin@test.com", "adminpass")
+        cookie = ask(1, "add_book", user_id, "It")
+        assert ask(1, "library_books", None) == 3      # the writer knows its own commit right away
+
+        assert ask(0, "library_books", None) == 2      # other workers serve their L1 until they read the log,
+        assert ask(0, "library_books", cookie) == 3    # unless the session shows a newer write
+
+        ask(0, "poll_every_read")
+        ask(1, "add_book", user_id, "Carrie")
+        assert ask(0, "library_books", None) == 4
+    finally:
+        for conn, process in workers:
+            conn.send(("stop",))
+            process.join(10)
+
+
+# the JSON API pages with a cursor, selects fields, filters, and answers 401 without a session
+def test_api_lists_books_with_cursor_fields_and_filters(client):
+    assert client.get("/api/v1/books").status_code == 401
+
+    login(client, "user@test.com", "userpass")
+    r = client.post("/api/v1/books", json=[
+        {"title": "it", "author": "stephen king", "genre": "horror", "reading_status": "Reading"},
+        {"title": "carrie", "author": "stephen king", "genre": "horror", "reading_status": "Completed"},
+    ])
+    assert r.status_code == 201 and len(r.get_json()["data"]) == 2
+
+    titles, cursor = [], None
+    while True:
+        page = client.get("/api/v1/books", query_string={"limit": 3, "fields": "title", **(
+            {"cursor": cursor} if cursor else {})}).get_json()
+        assert all(list(book) == ["title"] for book in page["data"])
+        titles += [book["title"] for book in page["data"]]
+        if not (cursor := page["next_cursor"]):
+            break
+    assert titles == ["The Shining", "Harry Potter", "It", "Carrie"]
+
+    horror = client.get("/api/v1/books?genre=horror&status=Completed&fields=title,author").get_json()["data"]
+    assert horror == [{"title": "The Shining", "author": "Stephen King"}, {"title": "Carrie", "author": "Stephen King"}]
+    assert client.get("/api/v1/books?fields=password").status_code == 400
+    assert client.get("/api/v1/books?cursor=nope").status_code == 400
+    assert client.get("/api/v1/users").status_code == 403
+    assert client.get("/api/v1/users/me?fields=name,book_count").get_json()["data"] == {"name": "User", "book_count": 4}
+
+
+# bulk updates and deletes run as one transaction and only touch the caller's books
+def test_api_bulk_update_and_delete(client):
+    login(client, "admin@test.com", "adminpass")
+    users = client.get("/api/v1/users?fields=id,email").get_json()["data"]
+    assert [user["email"] for user in users] == ["user@test.com"]
+    books = client.get("/api/v1/books?fields=id,title").get_json()["data"]
+    ids = {book["title"]: book["id"] for book in books}
+
+    r = client.patch("/api/v1/books", json=[{"id": ids["Harry Potter"], "reading_status": "Completed"},
+                                            {"id": 9999, "reading_status": "Completed"}])
+    assert r.status_code == 404
+    assert client.get(f"/api/v1/books/{ids['Harry Potter']}").get_json()["data"]["reading_status"] == "Reading"
+
+    r = client.patch("/api/v1/books", json=[{"id": ids["Harry Potter"], "reading_status": "Completed",
+                                             "genre": "fantasy"}])
+    assert r.get_json() == {"updated": 1}
+    assert client.get("/api/v1/books?status=Reading").get_json()["data"] == []
+    assert client.get("/admin/insights").status_code == 200
+
+    r = client.delete("/api/v1/books", json={"ids": list(ids.values())})
+    assert r.get_json() == {"deleted": 2}
+    assert client.get("/api/v1/books").get_json() == {"data": [], "next_cursor": None}
+    assert client.post("/api/v1/books", json=[{"title": "It", "author": "King", "genre": "Horror",
+                                               "reading_status": "Reading"}]).status_code == 400
+
+
+# AI SQL results are reused until a write touches the scopes the query reads
+def test_ai_sql_results_cached_until_their_scopes_change(client):
+    login(client, "admin@test.com", "adminpass")
+    with client.application.app_context():
+        user_id = db.session.scalar(db.select(User.id).where(User.email == "user@test.com"))
+    library_sql = "SELECT genre, COUNT(*) AS n FROM books GROUP BY genre ORDER BY genre"
+    user_sql = f"SELECT title, genre FROM books WHERE user_id = {user_id} ORDER BY title"
+
+    def run(sql):
+        with client.application.app_context():
+            cache = client.application.extensions["sql_cache"]
+            hits = cache.results.hits
+            rows = sql_cache.execute(db.session, sql)
+            return rows, cache.results.hits > hits
+
+    assert run(library_sql) == ([{"genre": "Fantasy", "n": 1}, {"genre": "Horror", "n": 1}], False)
+    assert run(library_sql.lower() + ";")[1]
+    assert not run(user_sql)[1]
+
+    # another user's book changes the library aggregate but not this user's list
+    client.post("/books/create", data={"title": "Dune", "author": "Frank Herbert", "genre": "Sci-Fi",
+                                       "reading_status": "Reading"})
+    assert run(library_sql) == ([{"genre": "Fantasy", "n": 1}, {"genre": "Horror", "n": 1},
+                                 {"genre": "Sci-Fi", "n": 1}], False)
+    assert run(user_sql)[1]
+
+    # another copy of a shared work with its own genre leaves this user's copy (and list) alone
+    client.post("/books/create", data={"title": "The Shining", "author": "Stephen King", "genre": "Thriller",
+                                       "reading_status": "Reading"})
+    rows, hit = run(user_sql)
+    assert hit and {"title": "The Shining", "genre": "Horror"} in rows
+    assert {"genre": "Thriller", "n": 1} in run(library_sql)[0]
+
+
+# recommendations of books the reader already owns are dropped, also when they are older than the prompt shows
+def test_recommendations_skip_owned_books(client, monkeypatch):
+    reply = ("You might enjoy:\n- **the shining** by Stephen King — more King\n"
+             "- **Misery** by Stephen King — a classic\nHappy reading!")
+    monkeypatch.setattr("routes.recommend_books", lambda **kwargs: reply)
+    login(client, "user@test.com", "userpass")
+
+    r = client.post("/ai-chat", json={"message": "Can you recommend some books?"})
+    assert r.get_json()["reply"] == "You might enjoy:\n- **Misery** by Stephen King — a classic\nHappy reading!"
+
+
+# reader profiles follow every book write and always match a rebuild from the tables
+def test_reader_profiles_follow_book_writes(client):
+    login(client, "user@test.com", "userpass")
+    with client.application.app_context():
+        user_id = db.session.scalar(db.select(User.id).where(User.email == "user@test.com"))
+        assert profiles.get(user_id)["top_genres"] == [("Horror", 1), ("Fantasy", 1)]
+
+    client.post("/api/v1/books", json=[
+        {"title": "It", "author": "Stephen King", "genre": "Horror", "reading_status": "Reading"},
+        {"title": "Dune", "author": "Frank Herbert", "genre": "Sci-Fi", "reading_status": "Completed"},
+    ])
+    books = {book["title"]: book["id"] for book in client.get("/api/v1/books?fields=id,title").get_json()["data"]}
+    client.post(f"/books/{books['It']}/edit", data={"title": "It", "author": "Stephen King", "genre": "Horror",
+                                                    "reading_status": "Completed"})
+    client.post(f"/books/{books['Harry Potter']}/delete")
+    client.get("/logout")
+
+    # another reader genres their copy of a shared work differently, which leaves this reader's copy alone
+    login(client, "admin@test.com", "adminpass")
+    client.post("/books/create", data={"title": "Dune", "author": "Frank Herbert", "genre": "Science Fiction",
+                                       "reading_status": "Reading"})
+
+    with client.application.app_context():
+        profile = profiles.get(user_id)
+        assert profile["total_books"] == 3 and profile["completion_rate"] == 100.0
+        assert dict(profile["top_genres"]) == {"Horror": 2, "Sci-Fi": 1}
+        assert profile["top_authors"][0] == ("Stephen King", 2)
+        assert [book["title"] for book in profile["recent_books"]] == ["Dune", "It", "The Shining"]
+        assert 0 < profile["genre_diversity"] < 1 and len(profile["features"]) == profiles.FEATURE_BUCKETS + 4
+
+        incremental = {key: value for key, value in profile.items() if key != "recent_books"}
+        rebuilt = profiles.export(profiles.rebuild(user_id))
+        db.session.rollback()
+        assert incremental == {key: value for key, value in rebuilt.items() if key != "recent_books"}
+
+    r = client.get(f"/admin/insights?user_id={user_id}")
+    assert b"Reader Profile" in r.data and b"100.0% completed" in r.data
+
+
+# chat questions are logged off the request path, mined by `flask chat-report` and replayed by the warm-up
+def test_chat_log_report_and_cache_warmup(client, tmp_path):
+    app = client.application
+    app.extensions["chat_log"] = chat_log.ChatLog(str(tmp_path / "chat_log.jsonl"))
+    login(client, "user@test.com", "userpass")
+
+    for message in ["What books am I reading?", "what books am I  reading", "Summarize my reading habits"]:
+        assert client.post("/ai-chat", json={"message": message}).status_code == 200
+    app.extensions["chat_log"].flush()
+
+    entries = list(chat_log.read_entries(str(tmp_path / "chat_log.jsonl")))
+    assert [entry["branch"] for entry in entries] == ["sql", "sql", "habits"]
+    assert [entry["cache"].get("sql") for entry in entries] == ["miss", "hit", None]
+    assert entries[0]["question"] == "what books am i reading" and entries[0]["sql"].startswith("SELECT")
+    assert all(entry["status"] == 200 and entry["ms"] > 0 and entry["tokens"][0] > 0 for entry in entries)
+
+    report = chat_log.analyze(entries)
+    assert report["questions"] == 3 and report["branches"]["sql"]["count"] == 2
+    assert report["top_shapes"][0]["shape"] == "what books am i reading" and report["top_shapes"][0]["count"] == 2
+    assert report["top_sql"][0]["count"] == 2 and report["caches"]["sql"]["hit_rate"] == 50.0
+
+    output = app.test_cli_runner().invoke(args=["chat-report"]).output
+    assert "3 questions" in output and "what books am i reading" in output
+
+    # a restarted worker starts with empty caches; the warm-up replays the logged SQL without the LLM
+    app.extensions["sql_cache"] = sql_cache.SQLResultCache.from_config(app.config)
+    llm_calls = get_provider().calls
+    with app.app_context():
+        warmed = warmup.warm()
+    assert warmed["sql_results"] == 1 and warmed["user_metrics"] == 1 and warmed["library_metrics"] == 1
+    assert warmed["failed"] == 0 and get_provider().calls == llm_calls
+
+    client.post("/ai-chat", json={"message": "What books am I reading?"})
+    app.extensions["chat_log"].flush()
+    assert list(chat_log.read_entries(str(tmp_path / "chat_log.jsonl")))[-1]["cache"]["sql"] == "hit"
+
+
+# with DB_SHARDS each library lives on one shard; admin pages, metrics, the API and admin SQL see all of them
+def test_sharded_libraries_and_rebalancing(tmp_path, monkeypatch):
+    shard_files = [tmp_path / "shard1.db", tmp_path / "shard2.db"]
+    app = create_app({"TESTING": True, "WTF_CSRF_ENABLED": False, "LLM_PROVIDER": "fake", "METADATA_SOURCE": "",
+                      "CHAT_LOG_PATH": "", "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "main.db"),
+                      "REPLICATION_RETRY_INTERVAL": 0, "SQLITE_PERFORMANCE_MODE": True,
+                      "DB_SHARDS": ",".join("sqlite:///" + str(path) for path in shard_files)})
+    with app.app_context():
+        db.session.add(User(name="Admin", email="admin@test.com", password=generate_password_hash("adminpass"),
+                            is_admin=True))
+        db.session.commit()
+
+    def shard_rows(path, sql):
+        with sqlite3.connect(path) as connection:
+            return connection.execute(sql).fetchall()
+
+    book_ids = {}
+    with app.test_client() as client:
+        # new users are spread over the shards: Ann on 0, Bob on 1, Cat on 2
+        for name, books in (("Ann", ["Dune", "Emma"]), ("Bob", ["Dune", "Ulysses", "Hamlet"]), ("Cat", ["Beloved"])):
+            client.post("/register", data={"name": name, "email": f"{name.lower()}@test.com", "password": "pass"})
+            r = client.post("/api/v1/books", json=[{"title": title, "author": "Someone", "genre": "Classic",
+                                                    "reading_status": "Reading"} for title in books])
+            assert r.status_code == 201
+            book_ids[name] = [item["id"] for item in r.get_json()["data"]]
+            assert books[0].encode() in client.get("/").data
+            client.get("/logout")
+
+        assert shard_rows(shard_files[0], "SELECT COUNT(*) FROM user_books") == [(3,)]
+        assert shard_rows(shard_files[1], "SELECT COUNT(*) FROM user_books") == [(1,)]
+        assert shard_rows(shard_files[0], "SELECT name FROM users ORDER BY id") == [("Admin",), ("Ann",), ("Bob",), ("Cat",)]
+        assert all(book_id >= sharding.ID_RANGE for book_id in book_ids["Bob"])
+        # each shard's writes went through that shard's own write queue
+        assert [queue.stats()["jobs"] for queue in app.extensions["write_queues"]] == [1, 1, 1]
+        assert len({book_id for ids in book_ids.values() for book_id in ids}) == 6
+
+        # a copy the shards miss is recorded, reported in the metrics and retried
+        def shards_down(*args):
+            raise ConnectionError("shard unreachable")
+
+        monkeypatch.setattr(sharding, "_upsert", shards_down)
+        with app.app_context():
+            db.session.scalar(db.select(User).where(User.name == "Ann")).name = "Annie"
+            db.session.commit()
+        monkeypatch.undo()
+        assert shard_rows(shard_files[0], "SELECT COUNT(*) FROM users WHERE name = 'Annie'") == [(0,)]
+        login(client, "admin@test.com", "adminpass")
+        backlog = client.get("/admin/metrics").get_json()["shard_replication"]
+        assert backlog["pending"] == 2 and backlog["by_shard"] == {"1": 1, "2": 1}
+        client.get("/logout")
+        with app.app_context():
+            assert sharding.retry_replication() == 2 and sharding.replication_stats()["pending"] == 0
+        assert shard_rows(shard_files[1], "SELECT COUNT(*) FROM users WHERE name = 'Annie'") == [(1,)]
+
+        # Bob edits his own book on his shard
+        client.post("/login", data={"email": "bob@test.com", "password": "pass"})
+        client.post(f"/books/{book_ids['Bob'][1]}/edit", data={"title": "Ulysses", "author": "James Joyce",
+                                                               "genre": "Modernist", "reading_status": "Completed"})
+        assert shard_rows(shard_files[0], "SELECT reading_status FROM user_books WHERE id = "
+                                          f"{book_ids['Bob'][1]}") == [("Completed",)]
+        # the cache versions are bumped on his shard, and his pages still see the change
+        assert shard_rows(shard_files[0], "SELECT COUNT(*) FROM cache_invalidations WHERE scope = 'library'") \
+            == [(2,)]
+        assert b"Modernist" in client.get("/").data
+        client.get("/logout")
+
+        login(client, "admin@test.com", "adminpass")
+        assert b"Bob" in client.get("/").data
+        assert b"<td>3</td>" in client.get("/admin/users").data
+        assert all(title.encode() in client.get("/admin/books").data for title in ("Dune", "Emma", "Hamlet", "Beloved"))
+        with app.test_request_context():
+            metrics = compute_library_metrics()
+            assert metrics["totals"] == {"users": 3, "books": 6}
+            assert metrics["top_user"] == {"name": "Bob", "count": 3}
+            assert dict(metrics["top_genres"]) == {"Classic": 5, "Modernist": 1}
+            assert dict(compute_library_metrics(approximate=True)["top_genres"]) == {"Classic": 5, "Modernist": 1}
+            assert shard_rows(shard_files[0], "SELECT COUNT(DISTINCT item) FROM sketch_deltas WHERE sketch = 'titles'") \
+                == [(3,)]    # Bob's books wrote their deltas on his shard
+            assert run_write(sketches.fold) > 0
+            approximate = compute_library_metrics(approximate=True)
+            assert dict(approximate["top_genres"]) == {"Classic": 5, "Modernist": 1}
+            # Dune has a work on two shards and counts once; Ulysses counts by both its authors, the sketch only grows
+            assert approximate["totals"]["titles"] == 6
+            assert sharding.library_session().execute(text("SELECT COUNT(*) FROM books")).scalar() == 6
+
+        pages, cursor = [], None
+        while True:
+            page = client.get("/api/v1/books", query_string={"limit": 4, "fields": "id", **(
+                {"cursor": cursor} if cursor else {})}).get_json()
+            pages += [row["id"] for row in page["data"]]
+            if not (cursor := page["next_cursor"]):
+                break
+        assert pages == sorted(book_id for ids in book_ids.values() for book_id in ids)
+
+        # the admin edits Cat's book, then moves Bob to shard 0 and deletes Cat
+        client.post(f"/books/{book_ids['Cat'][0]}/edit", data={"title": "Beloved", "author": "Toni Morrison",
+                                                               "genre": "Classic", "reading_status": "Completed"})
+        assert shard_rows(shard_files[1], "SELECT reading_status FROM user_books") == [("Completed",)]
+
+        runner = app.test_cli_runner()
+        with app.app_context():
+            bob_id = db.session.scalar(db.select(User.id).where(User.name == "Bob"))
+            cat_id = db.session.scalar(db.select(User.id).where(User.name == "Cat"))
+            assert {shard: sum(users.values()) for shard, users in sharding.loads().items()} == {0: 2, 1: 3, 2: 1}
+        result = runner.invoke(args=["shards", "move", str(bob_id), "0"])
+        assert result.exit_code == 0 and "moved 3 books" in result.output
+        assert shard_rows(shard_files[0], "SELECT COUNT(*) FROM user_books") == [(0,)]
+        assert "shard 0: 2 users, 5 books" in runner.invoke(args=["shards", "status"]).output
+
+        assert b"Ulysses" in client.get(f"/admin/users/{bob_id}/books").data
+        client.post(f"/admin/users/{cat_id}/delete")
+        assert shard_rows(shard_files[1], "SELECT COUNT(*) FROM user_books") == [(0,)]
+        assert shard_rows(shard_files[1], f"SELECT COUNT(*) FROM users WHERE id = {cat_id}") == [(0,)]
+        client.get("/logout")
+
+        client.post("/login", data={"email": "bob@test.com", "password": "pass"})
+        assert b"Ulysses" in client.get("/").data
+        with app.test_request_context():
+            assert profiles.get(bob_id)["total_books"] == 3
+
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+# with DB_AUTO_MIGRATE off the app boots without touching the schema, and `flask migrate` creates it
+def test_migrate_command_creates_schema(tmp_path):
+    app = create_app({"TESTING": True, "DB_AUTO_MIGRATE": False, "METADATA_SOURCE": "",
+                      "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "fresh.db")})
+    with app.app_context():
+        assert "users" not in inspect(db.engine).get_table_names()
+
+    result = app.test_cli_runner().invoke(args=["migrate"])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        inspector = inspect(db.engine)
+        assert {"users", "user_books", "works"} <= set(inspector.get_table_names())
+        assert "books" in inspector.get_view_names()
+        db.engine.dispose()
+
+
+# the AI and HTTP client libraries are only imported when they are first used
+def test_startup_does_not_import_lazy_modules(tmp_path):
+    env = dict(os.environ, DB_AUTO_MIGRATE="0", DB_URI="sqlite:///" + str(tmp_path / "boot.db"))
+    probe = "import sys, main; print(sorted(m for m in ('requests', 'openai') if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", probe], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+# a user over their chat rate gets a fast 429 with Retry-After instead of another LLM call
+def test_ai_chat_rate_limited_with_retry_after(client):
+    client.application.extensions["admission"] = AdmissionController(
+        user_rate=0.01, user_burst=1, global_rate=100, global_burst=100,
+        branch_limits={"sql": 4}, admin_slots=1, queue_timeout=0, max_queue=1)
+    login(client, "user@test.com", "userpass")
+
+    assert client.post("/ai-chat", json={"message": "Which books do I have?"}).status_code == 200
+    r = client.post("/ai-chat", json={"message": "Which books do I have?"})
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+
+    client.get("/logout")
+    login(client, "admin@test.com", "adminpass")
+    assert client.get("/admin/metrics").get_json()["ai_admission"]["rejected"] == {"user_rate": 1}
+
+
+# a chat request cancelled by the client stops before calling the LLM
+def test_cancelled_ai_chat_skips_llm_call(client):
+    login(client, "user@test.com", "userpass")
+    with client.application.app_context():
+        provider = get_provider()
+        calls_before = provider.calls
+
+    assert client.post("/ai-chat/cancel", json={"request_id": "abc-123"}).get_json() == {"cancelled": True}
+    r = client.post("/ai-chat", json={"message": "Which books do I have?", "request_id": "abc-123"})
+    assert r.status_code == 499
+    assert provider.calls == calls_before
+
+
+# long AI-generated SQL is interrupted once its request is cancelled
+def test_execute_cancellable_interrupts_sqlite_query(client, tmp_path):
+    marker = tmp_path / "cancelled"
+    marker.write_text("")
+    long_query = text("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) "
+                      "SELECT COUNT(*) FROM n")
+
+    with client.application.test_request_context():
+        g.cancel_token = CancelToken(str(marker), {})
+        with pytest.raises(Cancelled):
+            execute_cancellable(db.session, long_query)
@@ -1,4 +1,19 @@
-from ai_agent import _clean_sql
+import json
+import os
+import threading
+import time
+import llm
+import answers
+import ai_agent
+from ai_agent import _clean_sql, fill_answer_template
+from cache import LRUCache
+from database import engine_options
+from singleflight import SingleFlight, call_key
+from disk_cache import DiskCache
+from sketches import HeavyHitters, HyperLogLog
+from admission import AdmissionController, Rejected
+from sql_cache import normalize_sql, scopes_for
+from sharding import plan_rebalance
 
 
 """
@@ -30,4 +45,234 @@ by wrapping the column in LOWER()
 def test_clean_sql_normalized_reading_status():
     raw = "SELECT * FROM books WHERE reading_status = 'reading'"
     cleaned = _clean_sql(raw)
-    assert "LOWER(reading_status) = 'reading'" in cleaned
\ No newline at end of file
+    assert "LOWER(reading_status) = 'reading'" in cleaned
+
+# the LRU cache evicts the least recently used entries once its byte budget is exceeded
+def test_lru_cache_respects_byte_bound():
+    cache = LRUCache(max_entries=10, max_bytes=10)
+    cache.set("a", "12345")
+    cache.set("b", "12345")
+    cache.get("a")
+    cache.set("c", "12345")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "12345"
+    assert cache.stats()["bytes"] <= 10
+
+
+# the chosen profile's pool settings are applied, and in-memory SQLite keeps its default pool
+def test_engine_options_follow_pool_profile():
+    options = engine_options("postgresql://db/library", "web")
+    assert options["pool_pre_ping"] is True
+    assert options["pool_recycle"] == 1800
+
+    assert engine_options("sqlite:///:memory:", "web") == {}
+
+
+# concurrent identical calls share one upstream call, inside one worker and across workers sharing a lock dir
+def test_singleflight_coalesces_concurrent_calls(tmp_path):
+    worker_a = SingleFlight(str(tmp_path))
+    worker_b = SingleFlight(str(tmp_path))
+    calls = []
+
+    def slow_llm_call():
+        calls.append(1)
+        time.sleep(0.3)
+        return "summary"
+
+    threads = [threading.Thread(target=worker.do, args=("insights:{}", slow_llm_call))
+               for worker in (worker_a, worker_a, worker_a, worker_b)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert worker_a.stats()["saved_calls"] + worker_b.stats()["saved_calls"] == 3
+
+
+# only the question is normalized: differently spelled questions share a key, different data never does
+def test_singleflight_keys_and_private_result_files(tmp_path):
+    question = call_key("answer", {"user_question": "Which  Book?", "rows": [{"title": "Dune"}]})
+    assert question == call_key("answer", {"user_question": "which book?", "rows": [{"title": "Dune"}]})
+    assert question != call_key("answer", {"user_question": "which book?", "rows": [{"title": "dune"}]})
+    assert call_key("f", {"ids": {3, 1, 2}}) == call_key("f", {"ids": {2, 3, 1}})
+
+    flights = SingleFlight(str(tmp_path / "flights"))
+    flights.do("answer:1", lambda: "private")
+    assert os.stat(tmp_path / "flights").st_mode & 0o777 == 0o700
+    assert {entry.stat().st_mode & 0o077 for entry in os.scandir(tmp_path / "flights")
+            if entry.name.endswith(".json")} == {0}
+
+
+# a failing primary model falls back to the next configured model for the task
+def test_complete_falls_back_to_next_model(monkeypatch):
+    used_models = []
+
+    class FlakyProvider:
+        name = "flaky"
+
+        def complete(self, task, model, messages, temperature, json_mode=False):
+            used_models.append(model)
+            if model == "small-model":
+                raise TimeoutError("upstream timeout")
+            return "SELECT 1;"
+
+    monkeypatch.setattr(llm, "get_provider", lambda: FlakyProvider())
+    monkeypatch.setenv("LLM_MODEL_SQL_ANSWER", "small-model, big-model")
+
+    assert llm.complete("sql_answer", [{"role": "user", "content": "hi"}]) == "SELECT 1;"
+    assert used_models == ["small-model", "big-model"]
+
+    # a setting without any model name falls back to the default models
+    monkeypatch.setenv("LLM_MODEL_SQL_ANSWER", " , ")
+    assert llm.models_for("sql_answer") == llm.TASK_MODELS["sql_answer"]
+
+
+# the fake provider replays recorded responses and answers everything else deterministically
+def test_fake_provider_replays_recorded_responses(tmp_path):
+    messages = [{"role": "user", "content": "CURRENT_USER_ID = 7\nQUESTION: what am I reading?"}]
+    replay_file = tmp_path / "replay.jsonl"
+    replay_file.write_text(json.dumps({"key": llm.request_key("answer", messages), "response": "Dune."}) + "\n")
+
+    provider = llm.FakeProvider(str(replay_file))
+    assert provider.complete("answer", "any-model", messages, 0) == "Dune."
+    assert "user_id = 7" in provider.complete("sql_answer", "any-model", messages, 0)
+
+
+# answer templates are filled from the result rows; unknown placeholders escalate to the LLM (None)
+def test_fill_answer_template():
+    plan = {"answer_template": "You're reading {row_count} books:\n{rows}", "row_template": "{title} by {author}",
+            "empty_answer": "Nothing found."}
+    rows = [{"title": "Dune", "author": "Frank Herbert"}, {"title": "Emma", "author": "Jane Austen"}]
+
+    assert fill_answer_template(plan, rows) == "You're reading 2 books:\n- Dune by Frank Herbert\n- Emma by Jane Austen"
+    assert fill_answer_template(plan, []) == "Nothing found."
+    assert fill_answer_template({"answer_template": "The top genre is {genre}."}, rows) is None
+
+
+# recommended books the reader owns are dropped from the reply, and only those
+def test_drop_owned_recommendations():
+    reply = "Try these:\n- **Dune** by Frank Herbert — epic\n1. **Emma** by Jane Austen — witty\nEnjoy!"
+    assert ai_agent.drop_owned_recommendations(reply, lambda titles: {"Dune"} & titles) == \
+        "Try these:\n1. **Emma** by Jane Austen — witty\nEnjoy!"
+    assert ai_agent.drop_owned_recommendations(reply, lambda titles: set()) == reply
+    assert "already in the library" in ai_agent.drop_owned_recommendations(reply, lambda titles: titles)
+
+
+# common result shapes are phrased locally, unusual ones are left to the LLM
+def test_render_answer_by_result_shape():
+    assert answers.render_answer([{"book_count": 3}], is_admin=False) == "That comes to 3 books."
+    ranked = "SELECT genre, COUNT(*) AS read_count FROM books GROUP BY genre ORDER BY read_count DESC LIMIT 1"
+    assert answers.render_answer([{"genre": "Horror", "read_count": 2}], is_admin=True, sql=ranked) == \
+        "Horror comes out on top with 2 reads."
+    # a filtered count is not a ranking
+    filtered = "SELECT genre, COUNT(*) AS book_count FROM books WHERE genre = 'Fantasy' GROUP BY genre"
+    assert answers.render_answer([{"genre": "Fantasy", "book_count": 4}], is_admin=False, sql=filtered) == \
+        "Fantasy: 4 books."
+    assert answers.render_answer([{"title": "Dune", "author": "Frank Herbert"}], is_admin=False) == \
+        "Here's the book I found in your library:\n- Dune by Frank Herbert"
+    assert answers.render_answer([{"a": 1, "b": 2, "c": 3}] * 3, is_admin=False) is None
+
+
+# entries expire after their TTL and the cache keeps at most max_entries
+def test_disk_cache_ttl_and_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.db"), max_entries=2)
+    cache.set("short", "gone soon", ttl=-1)
+    cache.set("a", "1", ttl=60)
+    cache.set("b", "2", ttl=120)
+    cache.set("c", "3", ttl=180)
+    cache.evict()
+
+    assert cache.get("short") is None
+    assert cache.get("a") is None    # closest to expiry, evicted first
+    assert cache.get("c") == "3"
+
+
+# repeated (normalized) searches and failed searches are served from the web cache
+def test_duckduckgo_search_uses_web_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("WEB_CACHE_PATH", str(tmp_path / "web_cache.db"))
+    requests_made = []
+
+    def failing_get(*args, **kwargs):
+        requests_made.append(kwargs["params"]["q"])
+        raise ConnectionError("offline")
+
+    monkeypatch.setattr("requests.get", failing_get)
+
+    first = ai_agent.duckduckgo_search("Price of The Shining?")
+    second = ai_agent.duckduckgo_search("price of the shining")
+
+    assert first == second
+    assert first.startswith("(Web search failed")
+    assert len(requests_made) == 1
+
+
+# heavy hitters stay within their error bound, follow removals and survive serialization
+def test_heavy_hitters_and_hyperloglog_estimates():
+    genres = HeavyHitters(width=256, depth=4, capacity=8)
+    for i in range(2000):
+        genres.add("Fantasy" if i % 4 == 0 else f"genre-{i % 300}")
+    genres.add("Fantasy", -100)
+
+    restored = HeavyHitters.from_bytes(genres.to_bytes())
+    top_genre, count = restored.top(1)[0]
+    assert top_genre == "Fantasy"
+    assert 400 <= count <= 400 + restored.error_bound()
+
+    readers = HyperLogLog(precision=10)
+    for i in range(5000):
+        readers.add(str(i % 3000))
+    estimate = HyperLogLog.from_bytes(readers.to_bytes()).count()
+    assert abs(estimate - 3000) <= 3000 * readers.relative_error() * 3
+
+
+# a full branch queues briefly then rejects, while admins still get their reserved slot
+def test_admission_branch_slots_and_admin_lane():
+    controller = AdmissionController(user_rate=1, user_burst=1, global_rate=100, global_burst=100,
+                                     branch_limits={"web": 1}, admin_slots=1, queue_timeout=0.05, max_queue=4)
+
+    with controller.slot("web", is_admin=False):
+        try:
+            with controller.slot("web", is_admin=False):
+                pass
+            assert False, "second web call should have been rejected"
+        except Rejected as e:
+            assert e.reason == "branch_busy"
+
+        with controller.slot("web", is_admin=True):
+            assert controller.stats()["in_flight"]["web"] == 2
+
+    controller.check_rate(1, is_admin=False)
+    try:
+        controller.check_rate(1, is_admin=False)
+        assert False, "user bucket should be empty"
+    except Rejected as e:
+        assert e.reason == "user_rate" and e.retry_after >= 1
+    assert controller.stats()["rejected"] == {"branch_busy": 1, "user_rate": 1}
+
+
+# equivalent SQL shares one key, and single-user queries depend on that user only
+def test_sql_cache_normalizes_and_scopes_queries():
+    assert normalize_sql("SELECT  genre\n FROM Books WHERE title = 'It  Ends';") == \
+        "select genre from books where title = 'It  Ends'"
+    assert scopes_for(normalize_sql("SELECT title FROM books WHERE user_id = 5")) == ["user:5"]
+    assert scopes_for(normalize_sql("SELECT COUNT(*) FROM reading_events WHERE user_id = 5")) == ["user:5"]
+    assert scopes_for(normalize_sql("SELECT genre, COUNT(*) FROM books GROUP BY genre")) == ["library"]
+    assert scopes_for(normalize_sql("SELECT title FROM books WHERE user_id = 5 OR user_id = 6")) == ["library"]
+    # other users' rows, or rows of the shared tables, make it a library query
+    for sql in ("SELECT title FROM books WHERE NOT user_id = 5", "SELECT title FROM books WHERE user_id = 5 AND "
+                "work_id IN (SELECT work_id FROM books)", "SELECT title FROM books WHERE user_id <> 5 AND user_id = 5",
+                "SELECT name FROM users WHERE user_id = 5", "SELECT title FROM works WHERE user_id = 5",
+                "SELECT b.title FROM books b JOIN books o ON o.work_id = b.work_id WHERE b.user_id = 5",
+                "SELECT b.title FROM books b, reading_events e WHERE b.user_id = 5"):
+        assert scopes_for(normalize_sql(sql)) == ["library"], sql
+
+
+# rebalancing moves whole libraries from the fullest shard to the emptiest until no move narrows the gap
+def test_plan_rebalance_evens_out_shards():
+    loads = {0: {1: 30, 2: 20, 3: 10}, 1: {}, 2: {}}
+    assert plan_rebalance(loads) == [(1, 0, 1), (2, 0, 2)]
+    assert plan_rebalance(loads, max_moves=1) == [(1, 0, 1)]
+    assert plan_rebalance({0: {1: 10}, 1: {}}) == []    # moving the only library just swaps the shards
+    assert loads[0] == {1: 30, 2: 20, 3: 10}
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+import click
+import chat_log
+import sharding
+import sql_cache
+from database import read_session
+from routes import compute_library_metrics, compute_user_metrics, sql_refusal
+
+
+"""
+pre-warms a worker's caches after a deploy, so the first users after a restart don't pay for cold caches:
+- the library metrics and the metrics (with the reader profiles) of the users who use the chat most
+- the results of the SQL the chat ran most often, into the AI SQL result cache; the SQL comes from the
+  chat log, so warming costs database reads but no LLM calls
+answers and insights summaries are not warmed: answer templates and local phrasing are computed from the
+(warmed) SQL rows on every request, and insights summaries are LLM calls that are only coalesced while in
+flight, never cached, so there is no answer or insights cache to fill.
+these caches live in each worker's memory, so CACHE_WARMUP=1 has gunicorn warm every worker right after it
+boots (in the background, the worker serves meanwhile); `flask warm-caches` runs the same warm-up in its
+own process, for `flask run` and to see what a deploy would warm.
+"""
+WARM_SQL = 50
+WARM_USERS = 20
+WARM_HOURS = 7 * 24
+
+
+# warms the caches of this process from the chat log of the last `hours`; returns what was warmed
+def warm(sql_limit: int = WARM_SQL, user_limit: int = WARM_USERS, hours: float = WARM_HOURS) -> dict:
+    started = time.perf_counter()
+    log = chat_log.log()
+    entries = chat_log.read_entries(log.path, since=time.time() - hours * 3600) if log else []
+    report = chat_log.analyze(entries, top=max(sql_limit, user_limit))
+    warmed = {"library_metrics": 0, "user_metrics": 0, "sql_results": 0, "failed": 0}
+
+    def attempt(name, fn):
+        try:
+            fn()
+            warmed[name] += 1
+        except Exception as e:
+            print("Warm-up error:", repr(e))
+            warmed["failed"] += 1
+
+    attempt("library_metrics", compute_library_metrics)
+    for user in report["top_users"][:user_limit]:
+        attempt("user_metrics", lambda: compute_user_metrics(user["user_id"]))
+
+    for run in report["top_sql"][:sql_limit]:
+        # the log is only a hint: what runs here passes the same checks as a chat question
+        if sql_refusal(run["sql"], "", run["admin"]) is None:
+            attempt("sql_results", lambda: _warm_sql(run))
+
+    warmed["seconds"] = round(time.perf_counter() - started, 2)
+    return warmed
+
+
+# the SQL runs where the chat ran it: over the whole library for admins, on the user's shard otherwise
+def _warm_sql(run: dict) -> None:
+    if run["admin"]:
+        sql_cache.execute(sharding.library_session(), run["sql"])
+        return
+    with sharding.use_user(run["user_id"]):
+        sql_cache.execute(read_session(), run["sql"])
+
+
+def warm_in_background(app) -> threading.Thread:
+    def run():
+        with app.app_context():
+            print("Cache warm-up:", warm())
+
+    thread = threading.Thread(target=run, name="cache-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+@click.command("warm-caches")
+@click.option("--sql", "sql_limit", default=WARM_SQL, show_default=True, help="Most frequent SQL queries to run.")
+@click.option("--users", "user_limit", default=WARM_USERS, show_default=True, help="Most active users to warm.")
+@click.option("--hours", default=WARM_HOURS, show_default=True, help="How far back to read the chat log.")
+def warm_caches(sql_limit, user_limit, hours):
+    """Pre-populate the metrics and AI SQL result caches from the chat log."""
+    click.echo(f"Cache warm-up: {warm(sql_limit, user_limit, hours)}")
+
+
+def init_app(app) -> None:
+    app.cli.add_command(warm_caches)